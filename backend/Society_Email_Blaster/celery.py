@@ -1,14 +1,76 @@
+import logging
 import os
 from celery import Celery
+from celery.signals import task_postrun, worker_process_init
+from kombu import Queue
 
 # Set the default Django settings module
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Society_Email_Blaster.settings")
 
+logger = logging.getLogger(__name__)
+
 app = Celery("Society_Email_Blaster")
 
 # Using a string here avoids the worker having to serialize
 # the configuration object to child processes.
 app.config_from_object("django.conf:settings", namespace="CELERY")
 
+# Campaign priority classes and the queue each of them is routed to. Every
+# queue has its own worker pool (see supervisord.conf), so a huge newsletter
+# never sits in front of a small transactional send.
+PRIORITY_QUEUES = {
+    "transactional": "mail_transactional",
+    "standard": "mail_standard",
+    "bulk": "mail_bulk",
+}
+
+
+def route_mailer_task(name, args, kwargs, options, task=None, **kw):
+    """Send mailer tasks to the queue matching their ``priority`` kwarg."""
+    priority = (kwargs or {}).get("priority")
+    if name.startswith("mailer.") and priority in PRIORITY_QUEUES:
+        return {"queue": PRIORITY_QUEUES[priority]}
+    return None
+
+
+app.conf.task_queues = [Queue("celery")] + [
+    Queue(queue) for queue in PRIORITY_QUEUES.values()
+]
+app.conf.task_routes = (route_mailer_task,)
+
+# Only reserve one message at a time and always drain the queues in the order
+# they were given to the worker, so a pool consuming several queues picks up
+# higher-priority work between two chunks of a bulk campaign.
+app.conf.worker_prefetch_multiplier = 1
+app.conf.broker_transport_options = {"queue_order_strategy": "priority"}
+
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def preload_send_path(**kwargs):
+    """
+    Task modules import pandas, pyarrow and the Gmail client lazily, so load
+    them (and the Gmail discovery document) in each pool process as it starts
+    instead of in its first task.
+    """
+    import pandas  # noqa: F401
+    import pyarrow  # noqa: F401
+    from mailer.memory import start_tracing
+    from mailer.utils import gmail_discovery_document
+
+    gmail_discovery_document()
+    start_tracing()
+
+
+@task_postrun.connect
+def sample_memory(sender=None, **kwargs):
+    """Publish the pool process' memory after every task (see mailer.memory)"""
+    from mailer.memory import record_sample
+
+    try:
+        record_sample(sender.request.hostname or "worker")
+    except Exception as e:
+        # Metrics must never fail a task
+        logger.warning(f"Could not record a memory sample: {e}")
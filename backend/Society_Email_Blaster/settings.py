@@ -60,7 +60,6 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -97,7 +96,9 @@ DATABASES = {
     )
 }
 # Authentication
-AUTHENTICATION_BACKENDS = ("oauth2.authentication.GoogleTokenAuthentication",)
+# Bearer tokens are handled by DRF (see REST_FRAMEWORK), Django's session login
+# needs a backend that can load the user back from the session
+AUTHENTICATION_BACKENDS = ("django.contrib.auth.backends.ModelBackend",)
 
 # Social Auth settings
 SOCIAL_AUTH_GOOGLE_OAUTH2_KEY = os.getenv("GOOGLE_CLIENT_ID")
@@ -122,12 +123,24 @@ SOCIAL_AUTH_PIPELINE = (
     "social_core.pipeline.user.user_details",
 )
 
+# Google access tokens are refreshed this many seconds before they expire
+GOOGLE_TOKEN_REFRESH_MARGIN = 600
+GOOGLE_TOKEN_CACHE_TIMEOUT = 86400
+
+# Cache shared by web processes and Celery workers
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("REDIS_CACHE_URL", "redis://localhost:6379/1"),
+    }
+}
+
 # Configure session settings
-SESSION_ENGINE = "django.contrib.sessions.backends.db"  # Use database-backed sessions
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"  # Read from the cache, written through to the database
 SESSION_COOKIE_SECURE = False if DEBUG else True  # Set to True in production with HTTPS
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_AGE = 1209600  # 2 weeks in seconds
-SESSION_SAVE_EVERY_REQUEST = True  # Save the session on every request
+SESSION_SAVE_EVERY_REQUEST = False  # Only save sessions that changed
 
 LOGIN_URL = "auth/login"
 LOGIN_REDIRECT_URL = "auth/profile"
@@ -187,6 +200,40 @@ CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = TIME_ZONE
+# KiB of resident memory after which a pool process is replaced. Celery waits
+# for the running task to return first, and send tasks checkpoint as they go
+# (see MAILER_CHECKPOINT_SIZE), so no campaign loses progress to recycling.
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = int(
+    os.getenv("CELERY_WORKER_MAX_MEMORY_PER_CHILD", 512000)
+)
+CELERY_BEAT_SCHEDULE = {
+    "refresh-sender-tokens": {
+        "task": "mailer.tasks.refresh_sender_tokens",
+        "schedule": 300.0,
+    },
+}
+
+# Mailer settings
+MAILER_CHUNK_SIZE = 500  # Rows sent per task before re-enqueueing the campaign
+MAILER_CHECKPOINT_SIZE = 100  # Rows rendered, sent and logged at a time within a chunk
+MAILER_LEASE_TIMEOUT = 600  # Seconds a chunk keeps its campaign without checkpointing, before another task may take over
+MAILER_BULK_THRESHOLD = 5000  # Standard campaigns this large go to the bulk pool
+MAILER_RENDER_PROCESSES = int(os.getenv("MAILER_RENDER_PROCESSES", 0))  # >1 renders in a process pool
+MAILER_RENDER_BLOCK_SIZE = 100  # Rows per block handed to a render process
+MAILER_STATS_CACHE_TIMEOUT = 10  # Seconds stats of unfinished campaigns stay cached
+MAILER_CIRCUIT_WINDOW = 50  # Recent sends the circuit breaker looks at
+MAILER_CIRCUIT_MIN_CALLS = 10  # Sends in the window before the failure rate counts
+MAILER_CIRCUIT_FAILURE_RATIO = 0.5  # Failure rate that takes a sender out of the pool
+MAILER_CIRCUIT_COOLDOWN = 300  # Seconds before a paused campaign is retried
+MAILER_SENDER_DAILY_LIMIT = int(os.getenv("MAILER_SENDER_DAILY_LIMIT", 2000))  # Gmail's per-account daily cap
+MAILER_EXPORT_CHUNK_SIZE = 2000  # Logs fetched per round trip when exporting a campaign
+MAILER_PREVIEW_ROWS = 3  # Rows previewed when none are chosen
+MAILER_PREVIEW_MAX_ROWS = 20  # Most rows previewed in one call
+MAILER_PREVIEW_CACHE_TIMEOUT = 600  # Seconds rendered previews stay cached
+MAILER_MAX_ATTACHMENTS_SIZE = 18 * 1024 * 1024  # Bytes of attachments per campaign, Gmail caps messages at 25 MB once encoded
+MAILER_RESUMABLE_UPLOAD_SIZE = 5 * 1024 * 1024  # Messages this large are sent through Gmail's resumable upload
+MAILER_TRACEMALLOC_INTERVAL = int(os.getenv("MAILER_TRACEMALLOC_INTERVAL", 0))  # >0 traces allocations, logging the top growth every that many tasks
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
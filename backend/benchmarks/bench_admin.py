@@ -0,0 +1,112 @@
+"""
+Queries and time per admin page with a large EmailLog table, with the admin
+as configured and as it was before (logs inlined in the campaign, COUNT(*)
+pagination, no list_select_related, substring search).
+
+    python benchmarks/bench_admin.py [logs] [campaigns]
+
+Runs against a throwaway test database created from the configured one, the
+estimated counts only kick in on PostgreSQL.
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Society_Email_Blaster.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib import admin  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.core.paginator import Paginator  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import CaptureQueriesContext, setup_test_environment  # noqa: E402
+
+from mailer.models import EmailCampaign, EmailLog  # noqa: E402
+
+
+class EmailLogInline(admin.TabularInline):
+    model = EmailLog
+    extra = 0
+    fields = ("recipient_email", "sent_at", "success", "error_text")
+    readonly_fields = fields
+    can_delete = False
+    max_num = 0
+
+
+def before():
+    """Put the admin back the way it was"""
+    log_admin = admin.site._registry[EmailLog]
+    log_admin.list_select_related = False
+    log_admin.search_fields = ("recipient_email", "campaign__name")
+    log_admin.paginator = Paginator
+    log_admin.show_full_result_count = True
+    campaign_admin = admin.site._registry[EmailCampaign]
+    campaign_admin.inlines = [*campaign_admin.inlines, EmailLogInline]
+
+
+def measure(client: Client, path: str) -> tuple[int, float]:
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        response = client.get(path)
+        elapsed = time.perf_counter() - started
+    assert response.status_code == 200, (path, response.status_code)
+    return len(queries), elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    campaigns = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        user = get_user_model().objects.create_superuser(
+            "bench", "bench@example.com", "bench"
+        )
+        campaign_ids = [
+            EmailCampaign.objects.create(
+                user=user, name=f"bench {i}", subject="s", html_template="x", excel_file="x.xlsx"
+            ).id
+            for i in range(campaigns)
+        ]
+        per_campaign = count // campaigns
+        for campaign_id in campaign_ids:
+            EmailLog.objects.bulk_create(
+                (
+                    EmailLog(campaign_id=campaign_id, recipient_email=f"member{i}@example.com")
+                    for i in range(per_campaign)
+                ),
+                batch_size=10000,
+            )
+        connection.cursor().execute("ANALYZE")
+
+        campaign_id = campaign_ids[-1]
+        pages = {
+            "log list": "/admin/mailer/emaillog/",
+            "campaign's logs": f"/admin/mailer/emaillog/?campaign__id__exact={campaign_id}",
+            "log search": "/admin/mailer/emaillog/?q=member4242",
+            "campaign page": f"/admin/mailer/emailcampaign/{campaign_id}/change/",
+        }
+        print(f"logs: {per_campaign * campaigns:,} in {campaigns} campaigns")
+        client = Client()
+        client.force_login(user)
+        client.get("/admin/")  # Warm up the session and URL resolver
+        for setup in ("current", "before"):
+            if setup == "before":
+                before()
+            print(setup)
+            for name, path in pages.items():
+                queries, elapsed = measure(client, path)
+                print(f"  {name:<16} {queries:6} queries  {elapsed:7.2f}s")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
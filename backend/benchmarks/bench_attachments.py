@@ -0,0 +1,86 @@
+"""
+Cost of building a message with an attachment of growing size.
+
+    python benchmarks/bench_attachments.py [messages]
+
+Compares attaching the file to each message and base64url-encoding the whole
+message, as a plain MIMEMultipart would be sent, with the encode-once parts
+of mailer.attachments spliced after each rendered head and joined into the
+bytes handed to the upload. The first grows with the attachment, the second
+should stay close to the cost of a message without one.
+"""
+
+import base64
+import os
+import sys
+import tempfile
+import time
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Society_Email_Blaster.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.files.uploadedfile import SimpleUploadedFile  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from mailer.attachments import encode_with_attachments, save_part  # noqa: E402
+from mailer.utils import encode_message  # noqa: E402
+
+SIZES = (100 * 1024, 1024 * 1024, 5 * 1024 * 1024, 15 * 1024 * 1024)
+HTML = "<p>Dear member,</p>" + "<p>News of the society.</p>" * 200
+
+
+def encode_each_time(email: str, pdf: bytes) -> str:
+    message = MIMEMultipart()
+    message["to"] = email
+    message["subject"] = "Brochure"
+    message.attach(MIMEText(HTML, "html"))
+    message.attach(MIMEApplication(pdf, "pdf", Name="brochure.pdf"))
+    return base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+
+def spliced(email: str, parts: tuple[str, ...]) -> bytes:
+    return b"".join(encode_with_attachments(email, "Brochure", HTML, parts))
+
+
+def per_message(count: int, build) -> float:
+    started = time.perf_counter()
+    for i in range(count):
+        build(f"member{i}@example.com")
+    return (time.perf_counter() - started) / count * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with tempfile.TemporaryDirectory() as media_root, override_settings(
+        MEDIA_ROOT=media_root
+    ):
+        baseline = per_message(
+            count, lambda email: encode_message(email, "Brochure", HTML)
+        )
+        print(f"messages: {count}, no attachment: {baseline:.3f} ms/message")
+        for size in SIZES:
+            pdf = os.urandom(size)
+            upload = SimpleUploadedFile("brochure.pdf", pdf)
+            parts = (
+                save_part(upload, f"bench-{size}", "brochure.pdf", "application/pdf"),
+            )
+            spliced(".", parts)  # Reads the part once, as the first chunk would
+
+            each_time = per_message(count, lambda email: encode_each_time(email, pdf))
+            once = per_message(count, lambda email: spliced(email, parts))
+            print(
+                f"{size / 1024:>8,.0f} KiB  encoded per message {each_time:8.3f} ms"
+                f"  spliced {once:7.3f} ms  ({each_time / once:5.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
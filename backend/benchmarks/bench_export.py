@@ -0,0 +1,101 @@
+"""
+Time to first byte, total time and peak Python memory of exporting a
+campaign's delivery logs, against serializing the campaign with its nested
+email_logs as the API did before.
+
+    python benchmarks/bench_export.py [logs]
+
+Runs against a throwaway test database created from the configured one. Peak
+memory is traced on a second run, as tracing slows the export down.
+"""
+
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Society_Email_Blaster.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+
+from mailer.export import csv_chunks, xlsx_chunks  # noqa: E402
+from mailer.models import EmailCampaign, EmailError, EmailLog  # noqa: E402
+from mailer.serializers import EmailCampaignSerializer  # noqa: E402
+
+
+async def consume(chunks) -> tuple[float, int]:
+    """Seconds to the first chunk, and bytes in total"""
+    started = time.perf_counter()
+    first = None
+    size = 0
+    async for chunk in chunks:
+        first = first or time.perf_counter() - started
+        size += len(chunk)
+    return first, size
+
+
+def measure(name: str, run) -> None:
+    # Timed without tracemalloc, which slows allocation-heavy code a lot
+    started = time.perf_counter()
+    first, size = run()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:<18} first byte {first * 1000:8.1f} ms  total {elapsed:6.2f}s"
+        f"  {size / 1e6:6.1f} MB out  peak {peak / 1e6:7.1f} MB"
+    )
+
+
+def serialize_nested(campaign) -> tuple[float, int]:
+    started = time.perf_counter()
+    campaign = EmailCampaign.objects.prefetch_related("email_logs__error").get(
+        id=campaign.id
+    )
+    data = EmailCampaignSerializer(campaign).data
+    return time.perf_counter() - started, len(str(data))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        user = get_user_model().objects.create_user("bench", "bench@example.com")
+        campaign = EmailCampaign.objects.create(
+            user=user, name="bench", subject="bench", html_template="x", excel_file="x.xlsx"
+        )
+        error_id = EmailError.intern("HttpError", "Invalid To header")
+        EmailLog.objects.bulk_create(
+            (
+                EmailLog(
+                    campaign=campaign,
+                    recipient_email=f"member{i}@example.com",
+                    success=i % 20 != 0,
+                    error_id=None if i % 20 else error_id,
+                )
+                for i in range(count)
+            ),
+            batch_size=5000,
+        )
+        print(f"logs: {count:,}")
+        measure("nested serializer", lambda: serialize_nested(campaign))
+        measure("csv export", lambda: asyncio.run(consume(csv_chunks(campaign.id))))
+        measure("xlsx export", lambda: asyncio.run(consume(xlsx_chunks(campaign.id))))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
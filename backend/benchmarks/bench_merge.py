@@ -0,0 +1,108 @@
+"""
+Rendering throughput of compiled merge templates against plain substitution.
+
+    python benchmarks/bench_merge.py [rows]
+
+The baseline fills {{tag}} placeholders from a template split once into
+literal text and tags. The compiled engine has to stay within 2x of it.
+"""
+
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mailer.merge import compile_template, template_tags  # noqa: E402
+
+COLUMNS = ["email", "name", "company", "city", "interests", "amount"]
+PLAIN_TEMPLATE = (
+    "<html><body><h1>Hello {{name}}</h1>"
+    "<p>Thanks for joining us from {{company}} in {{city}}.</p>"
+    "<p>Your interests: {{interests}}. Amount due: {{amount}}.</p>"
+    "<p>We will write to {{email}}.</p></body></html>"
+)
+RICH_TEMPLATE = (
+    "<html><body><h1>Hello {{name|title|there}}</h1>"
+    "{% if company %}<p>Thanks for joining us from {{company}} in {{city|upper}}.</p>"
+    "{% else %}<p>Thanks for joining us.</p>{% endif %}"
+    "<p>Your interests: {% for item in interests %}{{item}} {% endfor %}. "
+    "Amount due: {{amount|format:.2f}}.</p>"
+    "<p>We will write to {{email|lower}}.</p></body></html>"
+)
+MAX_RATIO = 2.0
+
+
+def plain_renderer(html_template: str):
+    parts = re.split(r"{{\s*(.*?)\s*}}", html_template)
+    positions = [COLUMNS.index(tag) for tag in parts[1::2]]
+
+    def render(values):
+        rendered = parts.copy()
+        for i, pos in enumerate(positions, start=1):
+            val = values[pos]
+            rendered[2 * i - 1] = "" if val is None else str(val)
+        return "".join(rendered)
+
+    return render
+
+
+def compiled_renderer(html_template: str):
+    tags = template_tags(html_template)
+    return compile_template(html_template, {tag: COLUMNS.index(tag) for tag in tags})
+
+
+def make_rows(count: int) -> list[tuple]:
+    return [
+        (
+            f"User{i}@Example.com",
+            f"user number {i}",
+            None if i % 3 == 0 else f"Company {i % 50}",
+            f"city {i % 20}",
+            "music, books, travel",
+            i * 1.5,
+        )
+        for i in range(count)
+    ]
+
+
+def measure(render, rows, repeat: int = 3) -> float:
+    """Best of a few runs, to keep scheduler noise out of the ratio"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for values in rows:
+            render(values)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rows = make_rows(count)
+
+    baseline = measure(plain_renderer(PLAIN_TEMPLATE), rows)
+    compiled_plain = measure(compiled_renderer(PLAIN_TEMPLATE), rows)
+    compiled_rich = measure(compiled_renderer(RICH_TEMPLATE), rows)
+
+    print(f"rows: {count}")
+    for label, elapsed in (
+        ("plain substitution", baseline),
+        ("compiled, plain template", compiled_plain),
+        ("compiled, rich template", compiled_rich),
+    ):
+        print(
+            f"{label:<26} {elapsed:7.3f}s  {count / elapsed:>10,.0f} rows/s"
+            f"  {elapsed / baseline:4.2f}x"
+        )
+
+    worst = max(compiled_plain, compiled_rich) / baseline
+    if worst > MAX_RATIO:
+        print(f"FAIL: compiled rendering is {worst:.2f}x plain substitution")
+        sys.exit(1)
+    print(f"OK: compiled rendering within {MAX_RATIO:.0f}x of plain substitution")
+
+
+if __name__ == "__main__":
+    main()
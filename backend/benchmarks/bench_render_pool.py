@@ -0,0 +1,91 @@
+"""
+Render + encode throughput of the render pool at 1/2/4/8 processes.
+
+    python benchmarks/bench_render_pool.py [rows]
+
+Uses a large HTML template with many tags so the work is CPU-bound, the
+way it is for heavy newsletters. Scaling is bounded by the number of cores
+on the machine running it (os.cpu_count() is printed with the results).
+The last line renders chunks of two campaigns taking turns, as they do on a
+worker, through the same pool.
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mailer.render_pool import RenderContext, render_payloads, shutdown_pool  # noqa: E402
+
+TAGS = [f"field{i}" for i in range(40)]
+COLUMNS = ("email", *TAGS)
+SECTION = "".join(
+    f"<tr><td style='padding:4px'>{tag}</td><td>{{{{{tag}|trim}}}}</td></tr>"
+    for tag in TAGS
+)
+TEMPLATE = "<html><body>" + f"<table>{SECTION}</table><p>{'lorem ipsum ' * 200}</p>" * 10 + "</body></html>"
+PROCESS_COUNTS = (1, 2, 4, 8)
+CHUNK_SIZE = 500
+
+
+def make_rows(count: int) -> list[tuple]:
+    return [
+        (f"user{i}@example.com", *(f"value {i}-{j}" for j in range(len(TAGS))))
+        for i in range(count)
+    ]
+
+
+def run(context: RenderContext, rows: list[tuple], processes: int) -> float:
+    # Warm the pool up first so process start-up isn't part of the timing
+    for _ in render_payloads(context, rows[:processes], processes=processes, block_size=1):
+        pass
+    started = time.perf_counter()
+    for _ in render_payloads(context, rows, processes=processes, block_size=100):
+        pass
+    return time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    rows = make_rows(count)
+    context = RenderContext(
+        html_template=TEMPLATE,
+        subject="Benchmark",
+        columns=COLUMNS,
+        tag_mappings=(),
+        email_pos=0,
+    )
+
+    print(f"rows: {count}, template: {len(TEMPLATE) // 1024} KiB, cpus: {os.cpu_count()}")
+    baseline = None
+    for processes in PROCESS_COUNTS:
+        elapsed = run(context, rows, processes)
+        baseline = baseline or elapsed
+        print(
+            f"{processes} process(es): {elapsed:7.2f}s  {count / elapsed:>8,.0f} rows/s"
+            f"  speed-up {baseline / elapsed:4.2f}x"
+        )
+        shutdown_pool()
+
+    processes = PROCESS_COUNTS[-1]
+    other = context._replace(subject="Other campaign")
+    run(context, rows, processes)
+    started = time.perf_counter()
+    for i, start in enumerate(range(0, count, CHUNK_SIZE)):
+        chunk = rows[start : start + CHUNK_SIZE]
+        for _ in render_payloads(
+            (context, other)[i % 2], chunk, processes=processes, block_size=100
+        ):
+            pass
+    elapsed = time.perf_counter() - started
+    print(
+        f"{processes} process(es), 2 campaigns interleaved by chunks of {CHUNK_SIZE}: "
+        f"{elapsed:7.2f}s  {count / elapsed:>8,.0f} rows/s"
+    )
+    shutdown_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Database queries and time per request for a client with a session, under the
+old session setup (db engine, saved on every request) and the current one.
+
+    python benchmarks/bench_request_queries.py [requests]
+
+Runs against a throwaway test database created from the configured one, and
+needs the configured cache (Redis) for the cached_db engine.
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Society_Email_Blaster.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+from django.test.utils import CaptureQueriesContext, setup_test_environment  # noqa: E402
+
+PATHS = ("/admin/", "/test/")
+SETUPS = {
+    "db, save every request": {
+        "SESSION_ENGINE": "django.contrib.sessions.backends.db",
+        "SESSION_SAVE_EVERY_REQUEST": True,
+    },
+    "current settings": {
+        "SESSION_ENGINE": settings.SESSION_ENGINE,
+        "SESSION_SAVE_EVERY_REQUEST": settings.SESSION_SAVE_EVERY_REQUEST,
+    },
+}
+
+
+def measure(user, path: str, count: int) -> tuple[float, float]:
+    client = Client()
+    client.force_login(user)
+    client.get(path)  # Fill the session cache
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        for _ in range(count):
+            client.get(path)
+        elapsed = time.perf_counter() - started
+    return len(queries) / count, elapsed / count * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        user = get_user_model().objects.create_superuser(
+            "bench", "bench@example.com", "bench"
+        )
+        for name, overrides in SETUPS.items():
+            with override_settings(**overrides):
+                print(name)
+                for path in PATHS:
+                    queries, ms = measure(user, path, count)
+                    print(f"  {path:<10} {queries:5.2f} queries/request  {ms:6.2f} ms/request")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Aggregate send throughput of a campaign with 1/2/4/8 sender accounts.
+
+    python benchmarks/bench_sender_pool.py [messages] [latency_ms]
+
+Gmail calls are replaced by a client that sleeps for the given latency, as
+sending is bound by the round trip of each account's API calls. Throughput
+should grow linearly with the number of senders.
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Society_Email_Blaster.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from mailer.circuit import CircuitBreaker  # noqa: E402
+from mailer.senders import allocate, send_batches  # noqa: E402
+
+SENDER_COUNTS = (1, 2, 4, 8)
+
+
+class FakeGmail:
+    """Just enough of the Gmail client for send_encoded_email"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body):
+        return self
+
+    def execute(self):
+        time.sleep(self.latency)
+        return {"id": "fake"}
+
+
+def run(jobs: list[tuple], senders: int, latency: float) -> float:
+    shares = allocate(len(jobs), {sender_id: len(jobs) for sender_id in range(senders)})
+    batches = {}
+    offset = 0
+    for sender_id, share in shares.items():
+        breaker = CircuitBreaker(window=50, min_calls=10, failure_ratio=0.5)
+        batches[sender_id] = (FakeGmail(latency), jobs[offset : offset + share], breaker)
+        offset += share
+
+    started = time.perf_counter()
+    send_batches(batches)
+    return time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+    jobs = [(i, f"user{i}@example.com", "raw") for i in range(count)]
+
+    print(f"messages: {count}, latency per send: {latency * 1000:.0f} ms")
+    baseline = None
+    for senders in SENDER_COUNTS:
+        elapsed = run(jobs, senders, latency)
+        baseline = baseline or elapsed
+        print(
+            f"{senders} sender(s): {elapsed:6.2f}s  {count / elapsed:>7,.0f} msgs/s"
+            f"  speed-up {baseline / elapsed:4.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
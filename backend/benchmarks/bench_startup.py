@@ -0,0 +1,64 @@
+"""
+Import cost of starting a web process and a Celery worker, from python -X importtime.
+
+    python benchmarks/bench_startup.py [runs]
+
+web:    manage.py check, which loads the apps and the URL conf like a web process
+worker: the Celery app with its task modules imported, like a worker at boot
+Prints the best total import time of the runs and the heaviest top-level
+imports of the last one.
+"""
+
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND = Path(__file__).resolve().parent.parent
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+COMMANDS = {
+    "web": ["manage.py", "check"],
+    "worker": [
+        "-c",
+        "from Society_Email_Blaster.celery import app; app.loader.import_default_modules()",
+    ],
+}
+WATCHED = ("pandas", "pyarrow", "googleapiclient", "google.oauth2", "google_auth_oauthlib")
+
+
+def import_times(args: list[str]) -> tuple[dict[str, int], set[str]]:
+    """Cumulative microseconds of every top-level import, and every module imported"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=BACKEND,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    modules = set()
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            modules.add(match[4])
+            if not match[3]:
+                times[match[4]] = int(match[2])
+    return times, modules
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for name, args in COMMANDS.items():
+        results = [import_times(args) for _ in range(runs)]
+        best = min(sum(times.values()) for times, _ in results)
+        times, modules = results[-1]
+        loaded = [module for module in WATCHED if module in modules]
+        print(f"{name}: {best / 1000:7.1f} ms of imports, loads {', '.join(loaded) or 'none of ' + ', '.join(WATCHED)}")
+        for module, us in sorted(times.items(), key=lambda item: -item[1])[:5]:
+            print(f"    {us / 1000:7.1f} ms  {module}")
+
+
+if __name__ == "__main__":
+    main()
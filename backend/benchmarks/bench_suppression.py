@@ -0,0 +1,70 @@
+"""
+Cost of checking a recipient list against a suppression list.
+
+    python benchmarks/bench_suppression.py [rows]
+
+Checks a recipient column (an Arrow-backed string column, as read from a
+snapshot) against suppression lists of growing size, per chunk as
+send_campaign_chunk does and over the whole list at once, with
+suppressed_mask and with Series.isin for comparison.
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Society_Email_Blaster.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import pandas as pd  # noqa: E402
+import pyarrow as pa  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from mailer.suppression import suppressed_mask  # noqa: E402
+
+LIST_SIZES = (1_000, 100_000, 1_000_000)
+
+
+def best_of(runs: int, func) -> float:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    emails = pd.Series(
+        [f"Member{i}@Example.com" for i in range(rows)], dtype=pd.ArrowDtype(pa.string())
+    )
+    chunk = emails.iloc[: settings.MAILER_CHUNK_SIZE]
+    print(f"recipients: {rows:,}, chunk: {len(chunk)} rows")
+
+    for size in LIST_SIZES:
+        addresses = frozenset(f"member{i * 3}@example.com" for i in range(size))
+        mask = suppressed_mask(emails, addresses)
+        isin = emails.str.strip().str.lower().isin(addresses)
+        assert (mask == isin.to_numpy(dtype=bool, na_value=False)).all()
+
+        per_chunk = best_of(20, lambda: suppressed_mask(chunk, addresses))
+        per_chunk_isin = best_of(
+            20, lambda: chunk.str.strip().str.lower().isin(addresses)
+        )
+        whole = best_of(3, lambda: suppressed_mask(emails, addresses))
+        whole_isin = best_of(3, lambda: emails.str.strip().str.lower().isin(addresses))
+        print(
+            f"{size:>9,} suppressed ({mask.sum():,} hits)"
+            f"  per chunk {per_chunk * 1000:6.2f} ms (isin {per_chunk_isin * 1000:7.2f} ms)"
+            f"  whole list {whole * 1000:7.1f} ms (isin {whole_isin * 1000:7.1f} ms)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Concurrent request load against a running server.
+
+    python benchmarks/load_test.py URL [--token TOKEN] [-c CONCURRENCY] [-n REQUESTS]
+
+Compare the sync DRF detail view with the async progress view of the same
+campaign, with the server running as in supervisord.conf:
+
+    gunicorn Society_Email_Blaster.asgi:application -k uvicorn.workers.UvicornWorker -w 1
+    python benchmarks/load_test.py http://localhost:8000/mailer/campaigns/1/ --token ...
+    python benchmarks/load_test.py http://localhost:8000/mailer/campaigns/1/progress/ --token ...
+
+Use a single worker so the numbers are per process.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def worker(client: httpx.AsyncClient, url: str, remaining: list, latencies: list, errors: list):
+    while remaining:
+        remaining.pop()
+        started = time.perf_counter()
+        try:
+            response = await client.get(url)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(url: str, token: str | None, concurrency: int, requests: int):
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    remaining = list(range(requests))
+    latencies: list[float] = []
+    errors: list = []
+
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=60) as client:
+        await client.get(url)  # Warm up connections and caches
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(worker(client, url, remaining, latencies, errors) for _ in range(concurrency))
+        )
+        elapsed = time.perf_counter() - started
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{url}  concurrency={concurrency} requests={requests}")
+    print(f"  {requests / elapsed:8,.0f} req/s  total {elapsed:.2f}s  errors {len(errors)}")
+    print(
+        f"  latency p50 {quantiles[49] * 1000:.1f}ms  p95 {quantiles[94] * 1000:.1f}ms"
+        f"  p99 {quantiles[98] * 1000:.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("url")
+    parser.add_argument("--token", help="Google access token sent as a Bearer token")
+    parser.add_argument("-c", "--concurrency", type=int, default=100)
+    parser.add_argument("-n", "--requests", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.token, args.concurrency, args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Memory of a worker process sending a long campaign, chunk after chunk.
+
+    python benchmarks/soak_memory.py [recipients] [chunk_size]
+
+Runs send_campaign_chunk in-process for every chunk of a campaign against a
+throwaway test database, with Gmail replaced by a client that accepts every
+message. The process' RSS is sampled after each chunk as the worker does
+(mailer.memory.record_sample); once warmed up it should stay flat, growth
+that keeps going with the number of chunks is a leak. SQLite keeps its test
+database in memory, which grows with the logs, run it against PostgreSQL.
+"""
+
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Society_Email_Blaster.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import pandas as pd  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from mailer import tasks  # noqa: E402
+from mailer.memory import record_sample  # noqa: E402
+from mailer.models import EmailCampaign  # noqa: E402
+from mailer.snapshot import build_recipient_snapshot  # noqa: E402
+from oauth2.models import GoogleCredential  # noqa: E402
+
+WARM_UP = 0.1  # Share of the chunks left out of the growth figure
+
+
+class FakeGmail:
+    """Just enough of the Gmail client for send_encoded_email"""
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body):
+        return self
+
+    def execute(self):
+        return {"id": "fake"}
+
+
+def create_campaign(recipients: int) -> EmailCampaign:
+    user = get_user_model().objects.create_user("bench", "bench@example.com")
+    GoogleCredential.objects.create(
+        user=user,
+        access_token="bench",
+        refresh_token="bench",
+        token_expiry=timezone.now() + timedelta(days=1),
+    )
+    campaign = EmailCampaign.objects.create(
+        user=user,
+        name="soak",
+        subject="Hello {{name}}",
+        html_template="<p>Dear {{name}},</p>" + "<p>News of the society.</p>" * 50,
+        excel_file="soak.xlsx",
+        status="processing",
+        total_emails=recipients,
+    )
+    campaign.tag_mappings.create(template_tag="name", excel_header="Full Name")
+    build_recipient_snapshot(
+        campaign,
+        pd.DataFrame(
+            {
+                "Email": [f"member{i}@example.com" for i in range(recipients)],
+                "Full Name": [f"Member {i}" for i in range(recipients)],
+            }
+        ),
+    )
+    return campaign
+
+
+def main():
+    recipients = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    with (
+        tempfile.TemporaryDirectory() as media_root,
+        override_settings(
+            # As in production, DEBUG keeps the last 9000 queries around
+            DEBUG=False,
+            MEDIA_ROOT=media_root,
+            MAILER_CHUNK_SIZE=chunk_size,
+            # One account sends the whole campaign
+            MAILER_SENDER_DAILY_LIMIT=recipients,
+        ),
+        mock.patch("mailer.senders.build_gmail_service", return_value=FakeGmail()),
+        # Chunks are run one after the other below instead of re-enqueued
+        mock.patch.object(tasks.send_campaign_chunk, "delay"),
+    ):
+        try:
+            campaign = create_campaign(recipients)
+            print(f"recipients: {recipients:,}, chunk: {chunk_size} rows")
+
+            rss = []
+            started = time.perf_counter()
+            for start in range(0, recipients, chunk_size):
+                tasks.send_campaign_chunk.run(campaign.id, start)
+                rss.append(record_sample("soak")["rss"])
+            elapsed = time.perf_counter() - started
+
+            campaign.refresh_from_db()
+            warm = rss[int(len(rss) * WARM_UP)]
+            print(
+                f"{len(rss)} chunks in {elapsed:.1f}s, {campaign.status}: "
+                f"sent={campaign.sent_emails}, failed={campaign.failed_emails}"
+            )
+            print(
+                f"rss first {rss[0] / 2**20:7.1f} MiB  warm {warm / 2**20:7.1f} MiB"
+                f"  last {rss[-1] / 2**20:7.1f} MiB  max {max(rss) / 2**20:7.1f} MiB"
+            )
+            print(
+                f"growth after warm-up: {(rss[-1] - warm) / 2**20:+.1f} MiB over "
+                f"{len(rss) - int(len(rss) * WARM_UP) - 1} chunks"
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
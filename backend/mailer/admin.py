@@ -1,5 +1,20 @@
 from django.contrib import admin
-from .models import EmailCampaign, TagMapping, EmailLog
+from django.core.paginator import Paginator
+from django.db import connections
+from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+
+from .models import (
+    CampaignAttachment,
+    EmailCampaign,
+    EmailError,
+    EmailLog,
+    RecipientList,
+    SenderDelegation,
+    SuppressedAddress,
+    TagMapping,
+)
 
 
 class TagMappingInline(admin.TabularInline):
@@ -7,12 +22,42 @@ class TagMappingInline(admin.TabularInline):
     extra = 1
 
 
-class EmailLogInline(admin.TabularInline):
-    model = EmailLog
+class CampaignAttachmentInline(admin.TabularInline):
+    model = CampaignAttachment
     extra = 0
-    readonly_fields = ("recipient_email", "sent_at", "success", "error_message")
-    can_delete = False
-    max_num = 0
+    fields = ("filename", "content_type", "size", "created_at")
+    readonly_fields = fields
+
+    def has_add_permission(self, request, obj=None):
+        # Uploaded through the API, which encodes the part
+        return False
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for tables too big to COUNT(*) on every page load. Unfiltered
+    lists use PostgreSQL's row estimate, filtered ones stop counting at
+    COUNT_LIMIT rows, so pages past that aren't linked (but still load).
+    """
+
+    ESTIMATE_THRESHOLD = 100_000  # Below this the exact count is cheap enough
+    COUNT_LIMIT = 100_000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if not queryset.query.where and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                    [queryset.model._meta.db_table],
+                )
+                estimate = int(cursor.fetchone()[0])
+            # -1 when the table was never analyzed
+            if estimate >= self.ESTIMATE_THRESHOLD:
+                return estimate
+        return queryset[: self.COUNT_LIMIT].count()
 
 
 @admin.register(EmailCampaign)
@@ -27,27 +72,87 @@ class EmailCampaignAdmin(admin.ModelAdmin):
         "created_at",
     )
     list_filter = ("status", "created_at")
+    list_select_related = ("user",)
     search_fields = ("name", "user__email", "user__username")
-    inlines = [TagMappingInline, EmailLogInline]
+    inlines = [TagMappingInline, CampaignAttachmentInline]
+    filter_horizontal = ("senders",)
     readonly_fields = (
         "status",
         "total_emails",
         "sent_emails",
         "failed_emails",
+        "email_logs_link",
+        "version",
+        "lease_owner",
+        "lease_expires",
         "created_at",
         "updated_at",
     )
 
+    @admin.display(description="Email logs")
+    def email_logs_link(self, campaign):
+        # Logs are listed (and paginated) on their own page, not inline
+        url = reverse("admin:mailer_emaillog_changelist")
+        return format_html(
+            '<a href="{}?campaign__id__exact={}">{} sent, {} failed</a>',
+            url,
+            campaign.id,
+            campaign.sent_emails,
+            campaign.failed_emails,
+        )
+
 
 @admin.register(EmailLog)
 class EmailLogAdmin(admin.ModelAdmin):
     list_display = ("recipient_email", "campaign", "sent_at", "success")
     list_filter = ("success", "sent_at")
-    search_fields = ("recipient_email", "campaign__name")
+    list_select_related = ("campaign",)
+    # Case-sensitive prefix search, served by the recipient_email index
+    search_fields = ("recipient_email__startswith",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     readonly_fields = (
         "campaign",
         "recipient_email",
         "sent_at",
         "success",
+        "error",
         "error_message",
     )
+
+
+@admin.register(EmailError)
+class EmailErrorAdmin(admin.ModelAdmin):
+    list_display = ("error_class", "message", "first_seen")
+    search_fields = ("error_class",)
+    readonly_fields = ("fingerprint", "error_class", "message", "first_seen")
+
+
+@admin.register(SenderDelegation)
+class SenderDelegationAdmin(admin.ModelAdmin):
+    list_display = ("sender", "owner", "daily_limit", "created_at")
+    list_select_related = ("sender", "owner")
+    search_fields = ("sender__email", "owner__email")
+
+
+@admin.register(RecipientList)
+class RecipientListAdmin(admin.ModelAdmin):
+    list_display = ("excel_file", "user", "total_recipients", "created_at")
+    list_select_related = ("user",)
+    search_fields = ("user__email",)
+    readonly_fields = (
+        "content_hash",
+        "excel_file",
+        "snapshot_file",
+        "total_recipients",
+        "created_at",
+    )
+
+
+@admin.register(SuppressedAddress)
+class SuppressedAddressAdmin(admin.ModelAdmin):
+    list_display = ("email", "user", "reason", "campaign", "created_at")
+    list_filter = ("reason",)
+    list_select_related = ("user", "campaign")
+    search_fields = ("email", "user__email")
+    readonly_fields = ("campaign", "created_at")
@@ -0,0 +1,96 @@
+"""
+Attachments sent with every message of a campaign.
+
+An attachment is read and base64-encoded once, when it is uploaded, into a
+ready-made MIME part kept in storage. Campaigns attaching the same file under
+the same name share that part, and a worker reads it once per campaign.
+A message with attachments is its own small head (headers and the rendered
+HTML) followed by the parts as they are, so building it costs the same however
+large the attachments are. Such messages are sent as media uploads, which take
+the message as it is rather than base64url-encoded once more (see
+mailer.utils.send_encoded_email).
+"""
+
+import base64
+import hashlib
+import tempfile
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from functools import lru_cache
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+PART_DIR = "attachments"
+# A multiple of 3 bytes and of the 57 bytes of a 76-character base64 line
+ENCODE_CHUNK_SIZE = 57 * 1024
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def part_headers(filename: str, content_type: str) -> bytes:
+    """Headers of an attachment's MIME part, with the blank line ending them"""
+    maintype, _, subtype = content_type.partition("/")
+    part = MIMEBase(maintype, subtype or "octet-stream")
+    del part["MIME-Version"]
+    part.add_header(
+        "Content-Disposition",
+        "attachment",
+        filename=filename if filename.isascii() else ("utf-8", "", filename),
+    )
+    part["Content-Transfer-Encoding"] = "base64"
+    return part.as_bytes()
+
+
+def save_part(uploaded_file, content_hash: str, filename: str, content_type: str) -> str:
+    """Encode an uploaded file into a MIME part, unless already done, and return its storage name"""
+    name = f"{PART_DIR}/{_digest(content_hash, filename, content_type)}.part"
+    if default_storage.exists(name):
+        return name
+    with tempfile.TemporaryFile() as part:
+        part.write(part_headers(filename, content_type))
+        for chunk in uploaded_file.chunks(ENCODE_CHUNK_SIZE):
+            part.write(base64.encodebytes(chunk))
+        part.seek(0)
+        return default_storage.save(name, File(part))
+
+
+def boundary_for(parts: tuple[str, ...]) -> str:
+    # Fixed per set of attachments, so heads rendered anywhere match the tail
+    return f"=_mailer_{_digest(*parts)[:32]}"
+
+
+def message_head(to_email: str, subject: str, html_content: str, boundary: str) -> bytes:
+    """Headers and HTML part of a message with attachments, message_tail follows it"""
+    message = MIMEMultipart("mixed", boundary=boundary)
+    message["to"] = to_email
+    message["subject"] = subject
+    message.attach(MIMEText(html_content, "html"))
+    # Cut before the closing delimiter, message_tail carries on from there
+    return message.as_bytes().removesuffix(f"\n--{boundary}--\n".encode())
+
+
+@lru_cache(maxsize=2)
+def message_tail(parts: tuple[str, ...]) -> tuple[bytes, ...]:
+    """
+    Attachments of a campaign as the pieces ending each of its messages. Kept
+    for the next chunk, every message holds the same bytes objects.
+    """
+    boundary = boundary_for(parts)
+    pieces = []
+    for name in parts:
+        with default_storage.open(name, "rb") as part:
+            pieces += [f"\n--{boundary}\n".encode(), part.read()]
+    pieces.append(f"\n--{boundary}--\n".encode())
+    return tuple(pieces)
+
+
+def encode_with_attachments(
+    to_email: str, subject: str, html_content: str, parts: tuple[str, ...]
+) -> tuple[bytes, ...]:
+    """A whole message with attachments, as the pieces send_encoded_email takes"""
+    head = message_head(to_email, subject, html_content, boundary_for(parts))
+    return (head, *message_tail(parts))
@@ -0,0 +1,82 @@
+import logging
+from collections import deque
+
+from oauth2.tokens import TokenRefreshError
+from .utils import http_status
+
+logger = logging.getLogger(__name__)
+
+# Gmail error reasons that fail every remaining send of the campaign as well
+SYSTEMIC_REASONS = {
+    "dailyLimitExceeded",
+    "userRateLimitExceeded",
+    "rateLimitExceeded",
+    "quotaExceeded",
+    "authError",
+    "insufficientPermissions",
+}
+
+
+def is_systemic(error: Exception) -> bool:
+    """Whether an error is about the sender (token, quota) rather than the recipient"""
+    from google.auth.exceptions import RefreshError
+
+    if isinstance(error, (RefreshError, TokenRefreshError)):
+        return True
+
+    status = http_status(error)
+    if status in (401, 429):
+        return True
+    if status == 403:
+        details = getattr(error, "error_details", None) or []
+        reasons = {
+            detail.get("reason") for detail in details if isinstance(detail, dict)
+        }
+        return bool(reasons & SYSTEMIC_REASONS) or not reasons
+    return False
+
+
+def is_recipient_error(error: Exception) -> bool:
+    """Whether Gmail refused a send because of its recipient (e.g. a bad address)"""
+    status = http_status(error)
+    return status is not None and 400 <= status < 500 and not is_systemic(error)
+
+
+class CircuitBreaker:
+    """
+    Watches the outcome of every send of a sender. It trips straight away on a
+    systemic error, or once the failure rate over the last `window` sends reaches
+    `failure_ratio` (after at least `min_calls` sends). Errors about a recipient
+    say nothing about the sender and count as sends that went through.
+    """
+
+    def __init__(self, window: int, min_calls: int, failure_ratio: float):
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.tripped_by: Exception | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.tripped_by is not None
+
+    def record(self, error: Exception | None) -> bool:
+        """Record one send, returns True when the breaker trips"""
+        if error is None or is_recipient_error(error):
+            self.outcomes.append(True)
+            return False
+        self.outcomes.append(False)
+
+        if is_systemic(error):
+            self.tripped_by = error
+        else:
+            failures = self.outcomes.count(False)
+            if (
+                len(self.outcomes) >= self.min_calls
+                and failures / len(self.outcomes) >= self.failure_ratio
+            ):
+                self.tripped_by = error
+
+        if self.tripped_by is not None:
+            logger.warning(f"Circuit breaker tripped by {type(error).__name__}: {error}")
+        return self.is_open
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mailer.models import EmailCampaign
+from mailer.simulation import LATENCY, simulate_campaign
+
+
+class Command(BaseCommand):
+    help = (
+        "Dry run of a campaign: parse, render, encode and log every message with "
+        "simulated Gmail sends, then report throughput per stage and the ETA."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("campaign_id", type=int)
+        parser.add_argument("--chunk-size", type=int, help="Rows per chunk (MAILER_CHUNK_SIZE)")
+        parser.add_argument(
+            "--render-processes", type=int, help="Render processes (MAILER_RENDER_PROCESSES)"
+        )
+        parser.add_argument(
+            "--senders", type=int, help="Plan for this many sender accounts instead of the campaign's"
+        )
+        parser.add_argument(
+            "--daily-limit", type=int, help="Daily limit of every sender (MAILER_SENDER_DAILY_LIMIT)"
+        )
+        parser.add_argument(
+            "--latency-ms", type=float, default=LATENCY * 1000, help="Mean latency of a send"
+        )
+        parser.add_argument(
+            "--failure-rate", type=float, default=0.0, help="Share of sends that fail"
+        )
+        parser.add_argument("--seed", type=int, help="Seed for reproducible latencies")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            campaign = EmailCampaign.objects.get(id=options["campaign_id"])
+        except EmailCampaign.DoesNotExist:
+            raise CommandError(f"Campaign {options['campaign_id']} does not exist")
+
+        try:
+            report = simulate_campaign(
+                campaign,
+                chunk_size=options["chunk_size"],
+                render_processes=options["render_processes"],
+                senders=options["senders"],
+                daily_limit=options["daily_limit"],
+                latency=options["latency_ms"] / 1000,
+                failure_rate=options["failure_rate"],
+                seed=options["seed"],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options["json"]:
+            import json
+
+            self.stdout.write(json.dumps(report.as_dict(), indent=2))
+        else:
+            self.stdout.write(report.format())
@@ -0,0 +1,93 @@
+"""
+Memory of worker processes.
+
+Every task ends with a sample of its process' resident memory, kept in the
+shared cache so the latest sample of every worker process can be read in one
+place (/mailer/metrics/memory/). With MAILER_TRACEMALLOC_INTERVAL set, worker
+processes also trace Python allocations and log where memory grew the most
+every that many tasks.
+"""
+
+import logging
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+SAMPLES_KEY = "mailer:memory:samples"
+SAMPLE_TIMEOUT = 3600  # Processes silent for this long are dropped (recycled or gone)
+TRACEMALLOC_FRAMES = 10
+TRACEMALLOC_TOP = 10
+
+_tasks = 0
+_trace_snapshot: tracemalloc.Snapshot | None = None
+
+
+def rss_bytes() -> int:
+    """Current resident set size of this process"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Not Linux, the peak is the best there is
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def start_tracing() -> None:
+    if settings.MAILER_TRACEMALLOC_INTERVAL and not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+
+def _log_trace_growth() -> None:
+    global _trace_snapshot
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    if _trace_snapshot is not None:
+        growth = snapshot.compare_to(_trace_snapshot, "traceback")[:TRACEMALLOC_TOP]
+        lines = [
+            f"{stat.size_diff / 1024:+.1f} KiB in {stat.count_diff:+} blocks at "
+            f"{stat.traceback.format()[-1].strip()}"
+            for stat in growth
+        ]
+        logger.info(
+            f"Allocation growth in process {os.getpid()} over the last "
+            f"{settings.MAILER_TRACEMALLOC_INTERVAL} tasks:\n" + "\n".join(lines)
+        )
+    _trace_snapshot = snapshot
+
+
+def record_sample(worker: str) -> dict:
+    """Sample this process' memory after a task and publish it"""
+    global _tasks
+    _tasks += 1
+    sample = {"rss": rss_bytes(), "tasks": _tasks, "sampled_at": time.time()}
+    if tracemalloc.is_tracing():
+        # Also when started with PYTHONTRACEMALLOC, growth is then never logged
+        sample["traced"], sample["traced_peak"] = tracemalloc.get_traced_memory()
+        interval = settings.MAILER_TRACEMALLOC_INTERVAL
+        if interval and _tasks % interval == 0:
+            _log_trace_growth()
+
+    # One entry per process, a lost update is overwritten by the next task
+    cutoff = sample["sampled_at"] - SAMPLE_TIMEOUT
+    samples = {
+        key: value
+        for key, value in cache.get(SAMPLES_KEY, {}).items()
+        if value["sampled_at"] >= cutoff
+    }
+    samples[f"{worker}:{os.getpid()}"] = sample
+    cache.set(SAMPLES_KEY, samples, timeout=SAMPLE_TIMEOUT)
+    return sample
+
+
+def memory_samples() -> dict[str, dict]:
+    """Latest sample of every worker process, keyed by worker name and pid"""
+    return cache.get(SAMPLES_KEY, {})
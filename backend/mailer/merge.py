@@ -0,0 +1,350 @@
+"""
+Personalised-merge language for campaign templates.
+
+    {{ name }}                   value of the "name" column
+    {{ name|there }}             falls back to "there" when the cell is empty
+    {{ name|title|there }}       filters run left to right, see FILTERS
+    {{ amount|format:.2f }}      filters can take one argument after a colon
+    {% if company %}...{% elif city == "Pune" %}...{% else %}...{% endif %}
+    {% for item in interests %}<li>{{ item }}</li>{% endfor %}
+
+A segment after "|" that is not a known filter is a default value. Loops run
+over a cell's comma separated items.
+
+Templates are compiled once into a Python function taking a row tuple, so
+rendering a row does no parsing or name lookups.
+"""
+
+import re
+import hashlib
+import logging
+from functools import lru_cache
+from typing import Callable, Sequence
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"({{.*?}}|{%.*?%})", re.DOTALL)
+CONDITION_PATTERN = re.compile(
+    r"""^(?P<negate>not\s+)?(?P<tag>.+?)(?:\s*(?P<op>==|!=)\s*(?P<quote>["'])(?P<value>.*)(?P=quote))?$"""
+)
+FOR_PATTERN = re.compile(r"^for\s+(?P<var>\w+)\s+in\s+(?P<tag>.+)$")
+
+
+def cell_text(val) -> str:
+    """Text of a spreadsheet cell, empty cells (None, NaN, NaT, pd.NA) giving """""
+    try:
+        if val is None or val != val:
+            return ""
+    except TypeError:  # pd.NA refuses to be used as a bool
+        return ""
+    return str(val)
+
+
+def _truncate(text: str, length: str) -> str:
+    length = int(length)
+    return text if len(text) <= length else text[:length].rstrip() + "…"
+
+
+def _format(val, spec: str) -> str:
+    # Numeric cells are formatted as they are, text is parsed as a number first
+    try:
+        if val.__class__ not in (int, float):
+            val = float(cell_text(val))
+        return format(val, spec)
+    except ValueError:
+        return cell_text(val)
+
+
+def _check_length(length: str) -> None:
+    if not length.isdigit():
+        raise ValueError(f"expected a number of characters, got {length!r}")
+
+
+def _check_spec(spec: str) -> None:
+    format(0.0, spec)  # Raises ValueError for an invalid format spec
+
+
+FILTERS: dict[str, Callable[..., str]] = {
+    "upper": str.upper,
+    "lower": str.lower,
+    "title": str.title,
+    "capitalize": str.capitalize,
+    "trim": str.strip,
+    "truncate": _truncate,
+    "format": _format,
+}
+
+# Filters taking an argument, with the check it has to pass when parsed
+FILTER_ARGUMENTS: dict[str, Callable[[str], None]] = {
+    "truncate": _check_length,
+    "format": _check_spec,
+}
+
+
+@lru_cache(maxsize=4096)
+def _split_text(text: str) -> tuple[str, ...]:
+    # Loop cells tend to repeat across rows ("music, books"), so cache the split
+    return tuple(item for item in map(str.strip, text.split(",")) if item)
+
+
+def _split_items(val) -> tuple[str, ...]:
+    return _split_text(cell_text(val))
+
+
+class MergeNode:
+    """A {{ ... }} substitution"""
+
+    def __init__(self, tag: str, filters: list[tuple[str, str | None]], default: str):
+        self.tag = tag
+        self.filters = filters
+        self.default = default
+
+
+def _parse_merge(source: str) -> MergeNode:
+    tag, *segments = [segment.strip() for segment in source.split("|")]
+    filters = []
+    default = ""
+    for segment in segments:
+        name, _, arg = segment.partition(":")
+        name, arg = name.strip(), arg.strip() or None
+        if name in FILTERS:
+            # Checked here so a template that renders no row is refused when
+            # ingested, not once it is being sent
+            check = FILTER_ARGUMENTS.get(name)
+            merge = f"{{{{ {source} }}}}"
+            if check is None and arg is not None:
+                raise ValueError(f"Filter {name} takes no argument: {merge}")
+            if check is not None:
+                if arg is None:
+                    raise ValueError(f"Filter {name} needs an argument: {merge}")
+                try:
+                    check(arg)
+                except ValueError as e:
+                    raise ValueError(f"Invalid {name} filter in {merge}: {e}")
+            filters.append((name, arg))
+        else:
+            # Anything that isn't a filter is the fallback for an empty value
+            default = segment
+    return MergeNode(tag, filters, default)
+
+
+def _parse(html_template: str) -> list:
+    """Parse a template into a tree of text, MergeNode and block tuples"""
+    root: list = []
+    stack = [("root", root)]
+    for token in TOKEN_PATTERN.split(html_template):
+        body = stack[-1][1]
+        if token.startswith("{{") and token.endswith("}}"):
+            body.append(_parse_merge(token[2:-2].strip()))
+        elif token.startswith("{%") and token.endswith("%}"):
+            statement = token[2:-2].strip()
+            keyword = statement.split(None, 1)[0] if statement else ""
+            if keyword == "if":
+                branches = [[statement[2:].strip(), []]]
+                body.append(("if", branches))
+                stack.append(("if", branches[0][1], branches))
+            elif keyword in ("elif", "else"):
+                if stack[-1][0] != "if":
+                    raise ValueError(f"Unexpected {{% {keyword} %}} in template")
+                branches = stack[-1][2]
+                if branches[-1][0] is None:
+                    raise ValueError(f"Unexpected {{% {keyword} %}} after {{% else %}}")
+                condition = statement[4:].strip() if keyword == "elif" else None
+                branches.append([condition, []])
+                stack[-1] = ("if", branches[-1][1], branches)
+            elif keyword == "for":
+                match = FOR_PATTERN.match(statement)
+                if not match:
+                    raise ValueError(f"Invalid loop in template: {{% {statement} %}}")
+                loop_body: list = []
+                body.append(("for", match["var"], match["tag"].strip(), loop_body))
+                stack.append(("for", loop_body))
+            elif keyword in ("endif", "endfor"):
+                if stack[-1][0] != keyword[3:]:
+                    raise ValueError(f"Unexpected {{% {keyword} %}} in template")
+                stack.pop()
+            else:
+                raise ValueError(f"Unknown template statement: {{% {statement} %}}")
+        elif token:
+            body.append(token)
+
+    if len(stack) > 1:
+        raise ValueError(f"Missing {{% end{stack[-1][0]} %}} in template")
+    return root
+
+
+def _parse_condition(condition: str) -> re.Match:
+    match = CONDITION_PATTERN.match(condition)
+    if not match:
+        raise ValueError(f"Invalid condition in template: {condition}")
+    return match
+
+
+def template_tags(html_template: str) -> list[str]:
+    """Column tags a template reads, excluding loop variables"""
+    tags: dict[str, None] = {}
+
+    def visit(nodes: list, loop_vars: frozenset):
+        for node in nodes:
+            if isinstance(node, MergeNode):
+                if node.tag not in loop_vars:
+                    tags.setdefault(node.tag)
+            elif isinstance(node, tuple) and node[0] == "if":
+                for condition, body in node[1]:
+                    if condition is not None:
+                        tag = _parse_condition(condition)["tag"].strip()
+                        if tag not in loop_vars:
+                            tags.setdefault(tag)
+                    visit(body, loop_vars)
+            elif isinstance(node, tuple) and node[0] == "for":
+                _, var, tag, body = node
+                if tag not in loop_vars:
+                    tags.setdefault(tag)
+                visit(body, loop_vars | {var})
+
+    visit(_parse(html_template), frozenset())
+    return list(tags)
+
+
+class _Compiler:
+    def __init__(self, positions: dict[str, int | None]):
+        self.positions = {tag.lower(): pos for tag, pos in positions.items()}
+        self.lines = ["def render(v):", "    _o = []"]
+        self.helpers: list[str] = []
+        self.loop_vars: dict[str, str] = {}
+        self.counter = 0
+
+    def value(self, tag: str) -> str:
+        """Python expression for the raw value of a tag"""
+        if tag in self.loop_vars:
+            return self.loop_vars[tag]
+        pos = self.positions.get(tag.lower())
+        return "None" if pos is None else f"v[{pos}]"
+
+    def text(self, tag: str) -> str:
+        """Python expression for the value of a tag as text"""
+        if tag in self.loop_vars:
+            return self.loop_vars[tag]  # Loop items are already text
+        value = self.value(tag)
+        if value == "None":
+            return "''"
+        # Skip the helper call for the common case of a text cell
+        return f"({value} if {value}.__class__ is str else _text({value}))"
+
+    def merge(self, node: MergeNode) -> str:
+        filters = node.filters
+        if filters and filters[0][0] == "format":
+            # Format the raw value so numeric cells aren't turned into text and back
+            expr = f"_f_format({self.value(node.tag)}, {filters[0][1]!r})"
+            filters = filters[1:]
+        else:
+            expr = self.text(node.tag)
+        for name, arg in filters:
+            expr = f"_f_{name}({expr}, {arg!r})" if arg else f"_f_{name}({expr})"
+        if node.default:
+            expr = f"({expr} or {node.default!r})"
+        return expr
+
+    def emit(self, nodes: list, indent: int):
+        pad = "    " * indent
+        run: list[str] = []
+
+        def flush():
+            # Consecutive text and substitutions are appended in one go
+            if run:
+                self.lines.append(f"{pad}_o += ({', '.join(run)},)")
+                run.clear()
+
+        for node in nodes:
+            if isinstance(node, str):
+                run.append(repr(node))
+            elif isinstance(node, MergeNode):
+                run.append(self.merge(node))
+            elif node[0] == "if":
+                flush()
+                for i, (condition, body) in enumerate(node[1]):
+                    if condition is None:
+                        self.lines.append(f"{pad}else:")
+                    else:
+                        keyword = "if" if i == 0 else "elif"
+                        self.lines.append(f"{pad}{keyword} {self.condition(condition)}:")
+                    self.lines.append(f"{pad}    pass")
+                    self.emit(body, indent + 1)
+            elif node[0] == "for" and self.is_pure_loop(node):
+                run.append(self.loop_helper(node, self.text(node[2])))
+            elif node[0] == "for":
+                flush()
+                _, var, tag, body = node
+                self.counter += 1
+                loop_name = f"_l{self.counter}"
+                self.lines.append(f"{pad}for {loop_name} in _split_items({self.value(tag)}):")
+                self.lines.append(f"{pad}    pass")
+                outer = self.loop_vars.get(var)
+                self.loop_vars[var] = loop_name
+                self.emit(body, indent + 1)
+                if outer is None:
+                    del self.loop_vars[var]
+                else:
+                    self.loop_vars[var] = outer
+        flush()
+
+    def is_pure_loop(self, node: tuple) -> bool:
+        """Whether a loop's output depends on nothing but the looped cell"""
+        _, var, _, body = node
+        return not self.loop_vars and all(
+            isinstance(child, str)
+            or (isinstance(child, MergeNode) and child.tag == var)
+            for child in body
+        )
+
+    def loop_helper(self, node: tuple, cell: str) -> str:
+        """Compile a pure loop into a cached helper, returns the call expression"""
+        _, var, _, body = node
+        self.counter += 1
+        name = f"_loop{self.counter}"
+        lines, self.lines = self.lines, self.helpers
+        self.lines += ["@_cache", f"def {name}(_cell):", "    _o = []"]
+        self.lines.append(f"    for _l{self.counter} in _split_text(_cell):")
+        self.loop_vars[var] = f"_l{self.counter}"
+        self.emit(body, 2)
+        del self.loop_vars[var]
+        self.lines += ["    return ''.join(_o)", ""]
+        self.lines = lines
+        return f"{name}({cell})"
+
+    def condition(self, condition: str) -> str:
+        match = _parse_condition(condition)
+        text = f"{self.text(match['tag'].strip())}.strip()"
+        if match["op"]:
+            expr = f"{text} {match['op']} {match['value']!r}"
+        else:
+            expr = f"{text} != ''"
+        return f"not ({expr})" if match["negate"] else expr
+
+    def source(self) -> str:
+        return "\n".join(self.helpers + self.lines + ["    return ''.join(_o)", ""])
+
+
+def compile_template(
+    html_template: str, positions: dict[str, int | None]
+) -> Callable[[Sequence], str]:
+    """
+    Compile a template into a function rendering one row tuple. positions maps
+    each tag from template_tags() to its column position (None when missing).
+    """
+    compiler = _Compiler(positions)
+    compiler.emit(_parse(html_template), 1)
+    source = compiler.source()
+
+    digest = hashlib.sha1(html_template.encode()).hexdigest()[:12]
+    code = compile(source, f"<merge template {digest}>", "exec")
+    namespace = {
+        "_text": cell_text,
+        "_split_items": _split_items,
+        "_split_text": _split_text,
+        "_cache": lru_cache(maxsize=4096),
+        **{f"_f_{name}": func for name, func in FILTERS.items()},
+    }
+    exec(code, namespace)
+    logger.debug(f"Compiled merge template {digest}")
+    return namespace["render"]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-19 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailcampaign',
+            name='next_row',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='emailcampaign',
+            name='priority',
+            field=models.CharField(choices=[('transactional', 'Transactional'), ('standard', 'Standard'), ('bulk', 'Bulk')], default='standard', max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0002_emailcampaign_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailcampaign',
+            name='snapshot_file',
+            field=models.FileField(blank=True, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-19 11:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0003_emailcampaign_snapshot_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailcampaign',
+            name='status_message',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='emailcampaign',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ingesting', 'Ingesting'), ('ready', 'Ready'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2 on 2026-10-19 12:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0004_emailcampaign_status_message'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emaillog',
+            index=models.Index(fields=['campaign', 'sent_at'], name='mailer_emai_campaig_9fe3d5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emaillog',
+            index=models.Index(fields=['campaign', 'success'], name='mailer_emai_campaig_048aea_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-19 12:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0005_emaillog_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailError',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64, unique=True)),
+                ('error_class', models.CharField(max_length=255)),
+                ('message', models.TextField()),
+                ('first_seen', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='emaillog',
+            name='error',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='email_logs', to='mailer.emailerror'),
+        ),
+    ]
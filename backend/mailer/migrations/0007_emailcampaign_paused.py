@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 12:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0006_emailerror'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailcampaign',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ingesting', 'Ingesting'), ('ready', 'Ready'), ('processing', 'Processing'), ('paused', 'Paused'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+    ]
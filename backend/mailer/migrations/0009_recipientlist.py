@@ -0,0 +1,38 @@
+# Generated by Django 5.2 on 2026-10-19 12:19
+
+import django.db.models.deletion
+import mailer.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0008_sender_pool'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipientList',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('excel_file', models.FileField(upload_to=mailer.models.excel_file_path)),
+                ('snapshot_file', models.FileField(blank=True, upload_to='')),
+                ('total_recipients', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipient_lists', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='emailcampaign',
+            name='recipient_list',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='campaigns', to='mailer.recipientlist'),
+        ),
+        migrations.AddConstraint(
+            model_name='recipientlist',
+            constraint=models.UniqueConstraint(fields=('user', 'content_hash'), name='unique_recipient_list'),
+        ),
+    ]
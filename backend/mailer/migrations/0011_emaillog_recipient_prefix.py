@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-19 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0010_suppressedaddress'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emaillog',
+            index=models.Index(fields=['recipient_email'], name='emaillog_recipient_prefix', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
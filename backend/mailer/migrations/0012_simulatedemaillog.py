@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-19 12:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0011_emaillog_recipient_prefix'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimulatedEmailLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient_email', models.EmailField(max_length=254)),
+                ('sent_at', models.DateTimeField(auto_now_add=True)),
+                ('success', models.BooleanField(default=True)),
+                ('error_message', models.TextField(blank=True, null=True)),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mailer.emailcampaign')),
+                ('error', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='mailer.emailerror')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['campaign', 'sent_at'], name='mailer_simu_campaig_159885_idx'), models.Index(fields=['campaign', 'success'], name='mailer_simu_campaig_bcd168_idx'), models.Index(fields=['recipient_email'], name='simlog_recipient_prefix', opclasses=['varchar_pattern_ops'])],
+            },
+        ),
+    ]
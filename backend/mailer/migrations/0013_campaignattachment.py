@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-19 13:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailer', '0012_simulatedemaillog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CampaignAttachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255)),
+                ('content_type', models.CharField(max_length=255)),
+                ('size', models.PositiveIntegerField()),
+                ('content_hash', models.CharField(max_length=64)),
+                ('part_file', models.FileField(upload_to='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='mailer.emailcampaign')),
+            ],
+        ),
+    ]
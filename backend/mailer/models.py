@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
+import hashlib
 import uuid
 import os
 
@@ -11,29 +13,109 @@ def excel_file_path(instance, filename):
     return os.path.join("excel_files", filename)
 
 
+class RecipientList(models.Model):
+    """An uploaded spreadsheet, stored and parsed once however many campaigns send to it"""
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="recipient_lists"
+    )
+    content_hash = models.CharField(max_length=64)  # sha256 of the uploaded file
+    excel_file = models.FileField(upload_to=excel_file_path)
+    # Deduplicated columnar copy shared by the campaigns (see mailer.snapshot)
+    snapshot_file = models.FileField(blank=True)
+    total_recipients = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "content_hash"], name="unique_recipient_list"
+            )
+        ]
+
+    def __str__(self):
+        return f"{os.path.basename(self.excel_file.name)} ({self.total_recipients} recipients)"
+
+
 class EmailCampaign(models.Model):
     STATUS_CHOICES = (
         ("pending", "Pending"),
+        ("ingesting", "Ingesting"),
+        ("ready", "Ready"),
         ("processing", "Processing"),
+        ("paused", "Paused"),
         ("completed", "Completed"),
         ("failed", "Failed"),
     )
+    PRIORITY_CHOICES = (
+        ("transactional", "Transactional"),
+        ("standard", "Standard"),
+        ("bulk", "Bulk"),
+    )
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=255)
     subject = models.CharField(max_length=255)
     html_template = models.TextField()
     excel_file = models.FileField(upload_to=excel_file_path)
+    # Columnar copy of excel_file, parsed once at creation (see mailer.snapshot)
+    snapshot_file = models.FileField(blank=True)
+    # Campaigns uploading the same file share its excel_file and snapshot_file
+    recipient_list = models.ForeignKey(
+        RecipientList,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name="campaigns",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    status_message = models.TextField(blank=True, null=True)  # e.g. validation errors
     total_emails = models.IntegerField(default=0)
     sent_emails = models.IntegerField(default=0)
     failed_emails = models.IntegerField(default=0)
+    priority = models.CharField(
+        max_length=20, choices=PRIORITY_CHOICES, default="standard"
+    )
+    next_row = models.PositiveIntegerField(default=0)  # First row of the next chunk
+    # Bumped by every status change and edit, see mailer.state
+    version = models.PositiveIntegerField(default=0)
+    # Task sending the campaign's current chunk, and until when it holds it
+    lease_owner = models.CharField(max_length=255, blank=True, null=True)
+    lease_expires = models.DateTimeField(blank=True, null=True)
+    # Delegated accounts that send alongside the owner's (see SenderDelegation)
+    senders = models.ManyToManyField(
+        User, blank=True, related_name="sender_campaigns"
+    )
 
     def __str__(self):
         return self.name
 
+    @property
+    def effective_priority(self) -> str:
+        """Priority class used for routing, demoting large standard campaigns to bulk"""
+        if (
+            self.priority == "standard"
+            and self.total_emails >= settings.MAILER_BULK_THRESHOLD
+        ):
+            return "bulk"
+        return self.priority
+
+    @property
+    def has_started(self) -> bool:
+        """Whether the campaign got as far as sending, i.e. passed ingestion"""
+        return bool(self.snapshot_file) and bool(
+            self.next_row or self.sent_emails or self.failed_emails
+        )
+
+    @property
+    def attachment_parts(self) -> tuple[str, ...]:
+        """Storage names of the encoded attachments, in the order they were added"""
+        return tuple(
+            self.attachments.order_by("id").values_list("part_file", flat=True)
+        )
+
 
 class TagMapping(models.Model):
     campaign = models.ForeignKey(
@@ -48,6 +130,116 @@ class TagMapping(models.Model):
         return f"{self.template_tag} -> {self.excel_header}"
 
 
+class CampaignAttachment(models.Model):
+    """A file attached to every message of a campaign"""
+
+    # Messages already sent must match those still to send
+    LOCKED_STATUSES = ("processing", "paused", "completed")
+
+    campaign = models.ForeignKey(
+        EmailCampaign, on_delete=models.CASCADE, related_name="attachments"
+    )
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=255)
+    size = models.PositiveIntegerField()  # Bytes, as uploaded
+    content_hash = models.CharField(max_length=64)  # sha256 of the uploaded file
+    # Pre-encoded MIME part, shared by attachments of the same file and name
+    # (see mailer.attachments)
+    part_file = models.FileField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.filename
+
+
+class SenderDelegation(models.Model):
+    """Permission from a sender (e.g. a society officer) for owner's campaigns to use their Gmail account"""
+
+    owner = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="sender_delegations"
+    )
+    sender = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="delegated_to"
+    )
+    # Messages per day through this account, MAILER_SENDER_DAILY_LIMIT when unset
+    daily_limit = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["owner", "sender"], name="unique_sender_delegation"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.sender} sends for {self.owner}"
+
+
+class SuppressedAddress(models.Model):
+    """An address the user's campaigns no longer send to (see mailer.suppression)"""
+
+    REASON_CHOICES = (
+        ("failed", "Failed permanently"),
+        ("unsubscribed", "Unsubscribed"),
+    )
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="suppressed_addresses"
+    )
+    email = models.EmailField()  # Stored lower-cased
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES)
+    # Campaign the address failed in, for "failed" entries
+    campaign = models.ForeignKey(
+        EmailCampaign, on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "email"], name="unique_suppressed_address"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.email} ({self.get_reason_display()})"
+
+
+class EmailError(models.Model):
+    """A distinct failure, shared by every EmailLog that failed the same way"""
+
+    fingerprint = models.CharField(max_length=64, unique=True)  # sha256 of class and message
+    error_class = models.CharField(max_length=255)
+    message = models.TextField()
+    first_seen = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.error_class}: {self.message[:80]}"
+
+    @classmethod
+    def intern(cls, error_class: str, message: str) -> int:
+        """Id of the catalogue entry for this error, created on first sight"""
+        fingerprint = hashlib.sha256(f"{error_class}\0{message}".encode()).hexdigest()
+        error_id = _interned_errors.get(fingerprint)
+        if error_id is None:
+            error, _ = cls.objects.get_or_create(
+                fingerprint=fingerprint,
+                defaults={"error_class": error_class, "message": message},
+            )
+            error_id = error.id
+            if len(_interned_errors) >= INTERNED_ERRORS_MAX:
+                _interned_errors.clear()
+            _interned_errors[fingerprint] = error_id
+        return error_id
+
+
+# Per-process memo of fingerprint -> EmailError id, so a campaign failing the
+# same way on every row only hits the catalogue table once
+INTERNED_ERRORS_MAX = 1024
+_interned_errors: dict[str, int] = {}
+
+
 class EmailLog(models.Model):
     campaign = models.ForeignKey(
         EmailCampaign, on_delete=models.CASCADE, related_name="email_logs"
@@ -55,7 +247,61 @@ class EmailLog(models.Model):
     recipient_email = models.EmailField()
     sent_at = models.DateTimeField(auto_now_add=True)
     success = models.BooleanField(default=True)
+    error = models.ForeignKey(
+        EmailError,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name="email_logs",
+    )
+    # Only set on logs written before errors were interned into EmailError
     error_message = models.TextField(blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # Per-campaign aggregation (see mailer.stats)
+            models.Index(fields=["campaign", "sent_at"]),
+            models.Index(fields=["campaign", "success"]),
+            # Prefix search in the admin (LIKE 'x%' on PostgreSQL)
+            models.Index(
+                fields=["recipient_email"],
+                name="emaillog_recipient_prefix",
+                opclasses=["varchar_pattern_ops"],
+            ),
+        ]
+
     def __str__(self):
         return f"Email to {self.recipient_email} ({self.sent_at})"
+
+    @property
+    def error_text(self) -> str | None:
+        return self.error.message if self.error_id else self.error_message
+
+
+class SimulatedEmailLog(models.Model):
+    """
+    Scratch log written by dry runs (see mailer.simulation). Same columns and
+    indexes as EmailLog, so its writes load the database the same way.
+    """
+
+    campaign = models.ForeignKey(
+        EmailCampaign, on_delete=models.CASCADE, related_name="+"
+    )
+    recipient_email = models.EmailField()
+    sent_at = models.DateTimeField(auto_now_add=True)
+    success = models.BooleanField(default=True)
+    error = models.ForeignKey(
+        EmailError, on_delete=models.PROTECT, null=True, blank=True, related_name="+"
+    )
+    error_message = models.TextField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["campaign", "sent_at"]),
+            models.Index(fields=["campaign", "success"]),
+            models.Index(
+                fields=["recipient_email"],
+                name="simlog_recipient_prefix",
+                opclasses=["varchar_pattern_ops"],
+            ),
+        ]
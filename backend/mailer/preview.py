@@ -0,0 +1,116 @@
+"""
+Previews of a campaign's messages before it is started.
+
+Previews are rendered from the campaign's snapshot with the compiled
+template, and cached per (template, spreadsheet) so that calls repeated while
+the template is being edited neither read the snapshot nor render again.
+"""
+
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from oauth2.tokens import TokenRefreshError, get_credentials
+from .attachments import encode_with_attachments
+from .merge import cell_text
+from .models import EmailCampaign
+from .senders import SenderPoolExhausted, release_quota, reserve_quota
+from .snapshot import load_recipients
+from .utils import (
+    build_gmail_service,
+    build_template_renderer,
+    encode_message,
+    find_email_column,
+    send_encoded_email,
+    validate_template_and_headers,
+)
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_KEY = "mailer:preview:{template_hash}:{file_hash}:{rows}"
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def _file_hash(campaign: EmailCampaign) -> str:
+    if campaign.recipient_list_id:
+        return campaign.recipient_list.content_hash
+    # Campaigns from before recipient lists, every upload has its own name
+    return _digest(campaign.snapshot_file.name)
+
+
+def render_previews(
+    campaign: EmailCampaign,
+    html_template: str,
+    rows: list[int] | None = None,
+    limit: int = 3,
+) -> list[dict]:
+    """
+    Messages of the given rows (the first `limit` by default) of the campaign's
+    recipients, rendered with html_template. Raises ValueError when the
+    template doesn't fit the spreadsheet or a row is out of range.
+    """
+    tag_mappings = list(
+        campaign.tag_mappings.values_list("template_tag", "excel_header")
+    )
+    key = PREVIEW_KEY.format(
+        template_hash=_digest(html_template, repr(tag_mappings)),
+        file_hash=_file_hash(campaign),
+        rows=",".join(map(str, rows)) if rows else f"first{limit}",
+    )
+    previews = cache.get(key)
+    if previews is not None:
+        return previews
+
+    df = load_recipients(campaign)
+    validate_template_and_headers(html_template, df, tag_mappings)
+    if not rows:
+        rows = list(range(min(limit, len(df))))
+    out_of_range = [row for row in rows if row >= len(df)]
+    if out_of_range:
+        raise ValueError(
+            f"Rows {out_of_range} are out of range, the list has {len(df)} recipients"
+        )
+
+    render = build_template_renderer(html_template, df.columns, tag_mappings)
+    email_pos = find_email_column(df.columns)
+    previews = [
+        {
+            "row": row,
+            "email": cell_text(values[email_pos]).strip() or None,
+            "html": render(values),
+        }
+        for row, values in zip(
+            rows, df.iloc[rows].itertuples(index=False, name=None)
+        )
+    ]
+    cache.set(key, previews, timeout=settings.MAILER_PREVIEW_CACHE_TIMEOUT)
+    return previews
+
+
+def send_test_email(campaign: EmailCampaign, subject: str, html: str) -> Exception | None:
+    """Send a preview to the campaign's owner from their own account, returns the error if any"""
+    user = campaign.user
+    if not reserve_quota(user.id, 1, settings.MAILER_SENDER_DAILY_LIMIT):
+        return SenderPoolExhausted("Today's sending quota is used up")
+    sent = False
+    try:
+        service = build_gmail_service(get_credentials(user.id))
+        parts = campaign.attachment_parts
+        if parts:
+            raw = encode_with_attachments(user.email, f"[Test] {subject}", html, parts)
+        else:
+            raw = encode_message(user.email, f"[Test] {subject}", html)
+        _, error = send_encoded_email(service, user.email, raw)
+        sent = error is None
+        return error
+    except TokenRefreshError as e:
+        return e
+    finally:
+        if not sent:
+            # Only a test email that went out uses up the quota
+            release_quota(user.id, 1)
@@ -0,0 +1,150 @@
+"""
+Render stage of the send path.
+
+Rendering a template and MIME/base64 encoding the result is pure CPU work, so
+with large templates a single worker is bound by the GIL. When
+MAILER_RENDER_PROCESSES is above 1, rows are rendered in blocks by a pool of
+processes that return ready-to-send payloads, while the calling task keeps
+doing the network I/O for the blocks that are already done. The pool lives
+as long as the worker process and each block carries its campaign's context,
+since chunks of different campaigns interleave on the same worker.
+
+Campaigns with attachments render a message head per row, and the attachment
+parts are spliced in by the calling process (see mailer.attachments), so they
+are never copied back and forth between processes.
+"""
+
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from itertools import chain, islice
+from typing import Iterable, Iterator, NamedTuple
+
+from .attachments import boundary_for, message_head, message_tail
+from .merge import cell_text
+from .utils import build_template_renderer, encode_message
+
+logger = logging.getLogger(__name__)
+
+
+class RenderContext(NamedTuple):
+    """Everything a render process needs to know about a campaign"""
+
+    html_template: str
+    subject: str
+    columns: tuple[str, ...]
+    tag_mappings: tuple[tuple[str, str], ...]
+    email_pos: int
+    attachments: tuple[str, ...] = ()  # Storage names of the encoded parts
+
+
+# Payload for one row: (email, raw message), both None when the row has no email.
+# Messages with attachments are a tuple of byte strings instead of a raw string.
+Payload = tuple[str | None, str | tuple[bytes, ...] | None]
+
+BLOCKS_AHEAD_PER_PROCESS = 2  # Blocks submitted ahead of the one being sent
+
+_pool: ProcessPoolExecutor | None = None
+_pool_processes = 0
+
+
+def _render_block(context: RenderContext, rows: list[tuple]) -> list[Payload]:
+    # Renderers are cached per process, a context seen before compiles nothing
+    render = build_template_renderer(
+        context.html_template, context.columns, context.tag_mappings
+    )
+    boundary = boundary_for(context.attachments) if context.attachments else None
+    payloads = []
+    for values in rows:
+        email = cell_text(values[context.email_pos]).strip()
+        if not email:
+            payloads.append((None, None))
+        elif boundary:
+            payloads.append(
+                (email, message_head(email, context.subject, render(values), boundary))
+            )
+        else:
+            payloads.append(
+                (email, encode_message(email, context.subject, render(values)))
+            )
+    return payloads
+
+
+def _blocks(rows: Iterable[tuple], block_size: int) -> Iterator[list[tuple]]:
+    rows = iter(rows)
+    while block := list(islice(rows, block_size)):
+        yield block
+
+
+def _get_pool(processes: int) -> ProcessPoolExecutor:
+    """Pool of the worker process, shared by the chunks of every campaign"""
+    global _pool, _pool_processes
+    if _pool is None or _pool_processes != processes:
+        shutdown_pool()
+        # Spawned processes don't inherit the worker's database connections
+        _pool = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        )
+        _pool_processes = processes
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool, _pool_processes
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+    _pool_processes = 0
+
+
+def render_payloads(
+    context: RenderContext,
+    rows: Iterable[tuple],
+    processes: int = 0,
+    block_size: int = 200,
+) -> Iterator[Payload]:
+    """Render and encode rows, yielding one payload per row in order"""
+    payloads = _render(context, rows, processes, block_size)
+    if not context.attachments:
+        return payloads
+    tail = message_tail(context.attachments)
+    return (
+        (email, head if head is None else (head, *tail)) for email, head in payloads
+    )
+
+
+def _render(
+    context: RenderContext, rows: Iterable[tuple], processes: int, block_size: int
+) -> Iterator[Payload]:
+    blocks = _blocks(rows, block_size)
+    if processes > 1:
+        # The pool renders a few blocks ahead of the one being sent, not the
+        # whole chunk, so memory stays bounded however large chunks are
+        render = partial(_render_block, context)
+        ahead = list(islice(blocks, processes * BLOCKS_AHEAD_PER_PROCESS))
+        try:
+            pool = _get_pool(processes)
+            pending = deque(pool.submit(render, block) for block in ahead)
+        except Exception as e:
+            # e.g. processes can't be started from inside this worker
+            logger.warning(f"Render pool unavailable, rendering in-process: {e}")
+            shutdown_pool()
+            blocks = chain(ahead, blocks)
+        else:
+            try:
+                while pending:
+                    payloads = pending.popleft().result()
+                    block = next(blocks, None)
+                    if block is not None:
+                        pending.append(pool.submit(render, block))
+                    yield from payloads
+            except BrokenProcessPool:
+                shutdown_pool()
+                raise
+            return
+
+    for block in blocks:
+        yield from _render_block(context, block)
@@ -0,0 +1,235 @@
+"""
+Sender pool of a campaign.
+
+A campaign sends through its owner's Gmail account plus the accounts of its
+senders that have delegated to the owner (SenderDelegation). The rows of a
+chunk are spread over the accounts in proportion to the quota each one has
+left today, and every account sends its share on its own thread. Daily
+quotas are counted in the shared cache so they hold across workers and
+campaigns. Every account has a circuit breaker for the whole chunk, one that
+trips on an error about the account itself (token, quota) takes it out of
+every pool for MAILER_CIRCUIT_COOLDOWN while the others carry on.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from oauth2.tokens import TokenRefreshError, get_credentials
+from .circuit import CircuitBreaker, is_systemic
+from .models import EmailCampaign, SenderDelegation
+from .utils import build_gmail_service, send_encoded_email
+
+logger = logging.getLogger(__name__)
+
+QUOTA_KEY = "mailer:sender-quota:{user_id}:{day}"
+QUOTA_TIMEOUT = 2 * 24 * 3600  # Counters outlive their day, then expire
+UNHEALTHY_KEY = "mailer:sender-unhealthy:{user_id}"
+
+# One row to send: (row, email, raw message)
+Job = tuple[int, str, str]
+# One send that was made: (row, email, error or None)
+Attempt = tuple[int, str, Exception | None]
+
+
+class SenderPoolExhausted(Exception):
+    """Raised (as a pause reason) when no sender of a campaign can send right now"""
+
+
+class BatchResult(NamedTuple):
+    """What one sender did with its share of a chunk"""
+
+    attempts: list[Attempt]
+    unsent: list[Job]  # Includes the row a systemic error failed on
+    tripped_by: Exception | None
+
+
+class PoolResult(NamedTuple):
+    attempts: list[Attempt]
+    unsent: list[Job]
+    error: Exception | None  # Why the pool ran dry, when rows are left unsent
+
+
+def sender_limits(campaign: EmailCampaign) -> dict[int, int]:
+    """Daily limit of every account the campaign may send through, owner first"""
+    limits = {campaign.user_id: settings.MAILER_SENDER_DAILY_LIMIT}
+    delegations = SenderDelegation.objects.filter(
+        owner_id=campaign.user_id, sender__in=campaign.senders.all()
+    ).values_list("sender_id", "daily_limit")
+    for sender_id, daily_limit in delegations:
+        limits[sender_id] = daily_limit or settings.MAILER_SENDER_DAILY_LIMIT
+    return limits
+
+
+def _quota_key(user_id: int) -> str:
+    return QUOTA_KEY.format(user_id=user_id, day=timezone.now().date().isoformat())
+
+
+def used_quota(user_id: int) -> int:
+    return cache.get(_quota_key(user_id), 0)
+
+
+def reserve_quota(user_id: int, count: int, limit: int) -> int:
+    """Take up to count sends off an account's quota for today, returns how many were granted"""
+    key = _quota_key(user_id)
+    cache.add(key, 0, timeout=QUOTA_TIMEOUT)
+    used = cache.incr(key, count)
+    granted = max(0, min(count, limit - (used - count)))
+    if granted < count:
+        cache.decr(key, count - granted)
+    return granted
+
+
+def release_quota(user_id: int, count: int) -> None:
+    """Give back reserved sends that were never made"""
+    if count:
+        try:
+            cache.decr(_quota_key(user_id), count)
+        except ValueError:
+            pass  # The day rolled over, the new counter starts from zero anyway
+
+
+def is_healthy(user_id: int) -> bool:
+    return cache.get(UNHEALTHY_KEY.format(user_id=user_id)) is None
+
+
+def mark_unhealthy(user_id: int, error: Exception) -> None:
+    cache.set(
+        UNHEALTHY_KEY.format(user_id=user_id),
+        f"{type(error).__name__}: {error}",
+        timeout=settings.MAILER_CIRCUIT_COOLDOWN,
+    )
+    logger.warning(f"Sender {user_id} taken out of the pool: {error}")
+
+
+def mark_healthy(user_id: int) -> None:
+    cache.delete(UNHEALTHY_KEY.format(user_id=user_id))
+
+
+def build_services(limits: dict[int, int]) -> tuple[dict, Exception | None]:
+    """Gmail clients of the healthy senders, plus the last error building one"""
+    services = {}
+    error = None
+    for sender_id in limits:
+        if not is_healthy(sender_id):
+            continue
+        try:
+            services[sender_id] = build_gmail_service(get_credentials(sender_id))
+        except TokenRefreshError as e:
+            mark_unhealthy(sender_id, e)
+            error = e
+    return services, error
+
+
+def allocate(count: int, quotas: dict[int, int]) -> dict[int, int]:
+    """Split count rows over senders in proportion to the quota they have left"""
+    total = sum(quotas.values())
+    if total <= count:
+        return dict(quotas)
+    shares = {sender_id: count * quota // total for sender_id, quota in quotas.items()}
+    # Rows lost to rounding down go to the senders with the most quota to spare
+    spare = sorted(quotas, key=lambda s: quotas[s] - shares[s], reverse=True)
+    for sender_id in spare[: count - sum(shares.values())]:
+        shares[sender_id] += 1
+    return shares
+
+
+def send_batch(service, jobs: list[Job], breaker: CircuitBreaker) -> BatchResult:
+    """Send one sender's share of a chunk, stopping when its breaker trips"""
+    attempts = []
+    for i, (row, email, raw) in enumerate(jobs):
+        success, error = send_encoded_email(service, email, raw)
+        tripped = breaker.record(error)
+        if tripped and is_systemic(error):
+            # Not this recipient's fault, the row stays pending
+            return BatchResult(attempts, jobs[i:], error)
+        attempts.append((row, email, error))
+        if tripped:
+            return BatchResult(attempts, jobs[i + 1 :], error)
+    return BatchResult(attempts, [], None)
+
+
+def send_batches(batches: dict[int, tuple]) -> dict[int, BatchResult]:
+    """
+    Run send_batch for every sender at once. Each sender has its own Gmail
+    client (they aren't thread-safe) and its own quota, so they don't contend.
+    """
+    if len(batches) == 1:
+        ((sender_id, args),) = batches.items()
+        return {sender_id: send_batch(*args)}
+    with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+        futures = {
+            sender_id: executor.submit(send_batch, *args)
+            for sender_id, args in batches.items()
+        }
+        return {sender_id: future.result() for sender_id, future in futures.items()}
+
+
+def build_breakers(services: dict) -> dict[int, CircuitBreaker]:
+    """Circuit breakers of the senders, kept across the batches of a chunk"""
+    return {
+        sender_id: CircuitBreaker(
+            window=settings.MAILER_CIRCUIT_WINDOW,
+            min_calls=settings.MAILER_CIRCUIT_MIN_CALLS,
+            failure_ratio=settings.MAILER_CIRCUIT_FAILURE_RATIO,
+        )
+        for sender_id in services
+    }
+
+
+def send_with_pool(
+    services: dict,
+    limits: dict[int, int],
+    jobs: list[Job],
+    breakers: dict[int, CircuitBreaker],
+) -> PoolResult:
+    """
+    Send jobs through the pool. Rows of a sender that drops out are handed to
+    the remaining senders, until every row is sent or the pool runs dry.
+    """
+    attempts: list[Attempt] = []
+    error = None
+
+    while jobs:
+        quotas = {
+            sender_id: limits[sender_id] - used_quota(sender_id)
+            for sender_id in services
+            if not breakers[sender_id].is_open and is_healthy(sender_id)
+        }
+        quotas = {sender_id: quota for sender_id, quota in quotas.items() if quota > 0}
+
+        batches = {}
+        offset = 0
+        for sender_id, share in allocate(len(jobs), quotas).items():
+            granted = reserve_quota(sender_id, share, limits[sender_id])
+            if granted:
+                batches[sender_id] = (
+                    services[sender_id],
+                    jobs[offset : offset + granted],
+                    breakers[sender_id],
+                )
+                offset += granted
+        if not batches:
+            error = error or SenderPoolExhausted(
+                "Every sender is out of today's quota or cooling down after errors"
+            )
+            break
+
+        leftover = jobs[offset:]
+        for sender_id, batch in send_batches(batches).items():
+            attempts += batch.attempts
+            leftover += batch.unsent
+            release_quota(sender_id, len(batch.unsent))
+            if batch.tripped_by is not None:
+                error = batch.tripped_by
+                # Only errors about the account keep it out of other campaigns
+                if is_systemic(batch.tripped_by):
+                    mark_unhealthy(sender_id, batch.tripped_by)
+        jobs = sorted(leftover)
+
+    attempts.sort()
+    return PoolResult(attempts, jobs, error if jobs else None)
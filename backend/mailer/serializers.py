@@ -1,5 +1,23 @@
+import mimetypes
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Sum
 from rest_framework import serializers
-from .models import EmailCampaign, TagMapping, EmailLog
+from .attachments import save_part
+from .state import StaleCampaign, sources, transition
+from .models import (
+    CampaignAttachment,
+    EmailCampaign,
+    EmailLog,
+    RecipientList,
+    SenderDelegation,
+    SuppressedAddress,
+    TagMapping,
+)
+from .tasks import ingest_campaign_upload
+from .utils import duplicate_mapped_tags, file_digest
 
 
 class TagMappingSerializer(serializers.ModelSerializer):
@@ -9,15 +27,134 @@ class TagMappingSerializer(serializers.ModelSerializer):
 
 
 class EmailLogSerializer(serializers.ModelSerializer):
+    error_message = serializers.CharField(source="error_text", read_only=True)
+
     class Meta:
         model = EmailLog
         fields = ["id", "recipient_email", "sent_at", "success", "error_message"]
         read_only_fields = fields
 
 
+class RecipientListSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RecipientList
+        fields = ["id", "excel_file", "total_recipients", "created_at"]
+        read_only_fields = fields
+
+
+class CampaignAttachmentSerializer(serializers.ModelSerializer):
+    file = serializers.FileField(write_only=True)
+
+    class Meta:
+        model = CampaignAttachment
+        fields = [
+            "id",
+            "campaign",
+            "file",
+            "filename",
+            "content_type",
+            "size",
+            "created_at",
+        ]
+        read_only_fields = ["filename", "content_type", "size", "created_at"]
+
+    def validate_campaign(self, campaign):
+        if campaign.user_id != self.context["request"].user.id:
+            raise serializers.ValidationError("Campaign not found")
+        if campaign.status in CampaignAttachment.LOCKED_STATUSES:
+            raise serializers.ValidationError(
+                f"Attachments of a campaign that is {campaign.status} can't change"
+            )
+        return campaign
+
+    def validate(self, attrs):
+        attached = (
+            attrs["campaign"].attachments.aggregate(total=Sum("size"))["total"] or 0
+        )
+        if attached + attrs["file"].size > settings.MAILER_MAX_ATTACHMENTS_SIZE:
+            raise serializers.ValidationError(
+                f"Attachments of a campaign can't exceed "
+                f"{settings.MAILER_MAX_ATTACHMENTS_SIZE // (1024 * 1024)} MB in total"
+            )
+        return attrs
+
+    def create(self, validated_data):
+        uploaded_file = validated_data.pop("file")
+        filename = uploaded_file.name
+        content_type = (
+            uploaded_file.content_type
+            or mimetypes.guess_type(filename)[0]
+            or "application/octet-stream"
+        )
+        content_hash = file_digest(uploaded_file)
+        return CampaignAttachment.objects.create(
+            filename=filename,
+            content_type=content_type,
+            size=uploaded_file.size,
+            content_hash=content_hash,
+            # Encoded once here, every message then reuses the part
+            part_file=save_part(uploaded_file, content_hash, filename, content_type),
+            **validated_data,
+        )
+
+
+class SuppressedAddressSerializer(serializers.ModelSerializer):
+    reason = serializers.ChoiceField(
+        choices=SuppressedAddress.REASON_CHOICES, default="unsubscribed"
+    )
+
+    class Meta:
+        model = SuppressedAddress
+        fields = ["id", "email", "reason", "campaign", "created_at"]
+        read_only_fields = ["campaign", "created_at"]
+
+    def validate_email(self, value):
+        value = value.strip().lower()
+        if SuppressedAddress.objects.filter(
+            user=self.context["request"].user, email=value
+        ).exists():
+            raise serializers.ValidationError("Address is already suppressed")
+        return value
+
+
+class SenderDelegationSerializer(serializers.ModelSerializer):
+    owner_email = serializers.EmailField(write_only=True)
+    owner = serializers.EmailField(source="owner.email", read_only=True)
+    sender = serializers.EmailField(source="sender.email", read_only=True)
+
+    class Meta:
+        model = SenderDelegation
+        fields = ["id", "owner_email", "owner", "sender", "daily_limit", "created_at"]
+        read_only_fields = ["created_at"]
+
+    def validate_owner_email(self, value):
+        owner = User.objects.filter(email=value).first()
+        if owner is None:
+            raise serializers.ValidationError("No user with this email")
+        if SenderDelegation.objects.filter(
+            owner=owner, sender=self.context["request"].user
+        ).exists():
+            raise serializers.ValidationError("Already delegated to this user")
+        return owner
+
+    def create(self, validated_data):
+        validated_data["owner"] = validated_data.pop("owner_email")
+        return super().create(validated_data)
+
+
 class EmailCampaignSerializer(serializers.ModelSerializer):
     tag_mappings = TagMappingSerializer(many=True, required=False)
     email_logs = EmailLogSerializer(many=True, read_only=True)
+    senders = serializers.PrimaryKeyRelatedField(
+        many=True, queryset=User.objects.all(), required=False
+    )
+    # A campaign is created from either a new upload or a list uploaded before
+    excel_file = serializers.FileField(required=False)
+    recipient_list = serializers.PrimaryKeyRelatedField(
+        queryset=RecipientList.objects.all(), required=False
+    )
+    # Sent back with an edit, which is refused if the campaign changed since
+    version = serializers.IntegerField(min_value=0, required=False)
 
     class Meta:
         model = EmailCampaign
@@ -27,12 +164,17 @@ class EmailCampaignSerializer(serializers.ModelSerializer):
             "subject",
             "html_template",
             "excel_file",
+            "recipient_list",
             "created_at",
             "updated_at",
             "status",
+            "status_message",
             "total_emails",
             "sent_emails",
             "failed_emails",
+            "priority",
+            "senders",
+            "version",
             "tag_mappings",
             "email_logs",
         ]
@@ -40,16 +182,185 @@ class EmailCampaignSerializer(serializers.ModelSerializer):
             "created_at",
             "updated_at",
             "status",
+            "status_message",
             "total_emails",
             "sent_emails",
             "failed_emails",
         ]
 
+    def validate_senders(self, senders):
+        # Only accounts that delegated to the campaign's owner can send for it
+        owner = self.context["request"].user
+        delegated = set(
+            SenderDelegation.objects.filter(owner=owner, sender__in=senders).values_list(
+                "sender_id", flat=True
+            )
+        )
+        missing = [sender.id for sender in senders if sender.id not in delegated]
+        if missing:
+            raise serializers.ValidationError(
+                f"Users {missing} have not delegated sending to you"
+            )
+        return senders
+
+    def validate_tag_mappings(self, tag_mappings):
+        duplicates = duplicate_mapped_tags(
+            (mapping["template_tag"], mapping["excel_header"]) for mapping in tag_mappings
+        )
+        if duplicates:
+            raise serializers.ValidationError(
+                f"Tags mapped more than once: {', '.join(duplicates)}"
+            )
+        return tag_mappings
+
+    def validate_recipient_list(self, recipient_list):
+        if recipient_list.user_id != self.context["request"].user.id:
+            raise serializers.ValidationError("Recipient list not found")
+        return recipient_list
+
+    def validate(self, attrs):
+        if self.instance is None and not (
+            attrs.get("excel_file") or attrs.get("recipient_list")
+        ):
+            raise serializers.ValidationError(
+                "Either excel_file or recipient_list is required"
+            )
+        if (
+            self.instance is not None
+            and self.instance.status not in sources("ingesting")
+            and self._edits_content(attrs)
+        ):
+            raise serializers.ValidationError(
+                f"Recipients and template of a campaign that is "
+                f"{self.instance.status} can't change"
+            )
+        return attrs
+
+    def _edits_content(self, attrs) -> bool:
+        """Whether attrs change what ingestion validated, the recipients or template"""
+        instance = self.instance
+        if "tag_mappings" in attrs and sorted(
+            (mapping["template_tag"], mapping["excel_header"])
+            for mapping in attrs["tag_mappings"]
+        ) != sorted(instance.tag_mappings.values_list("template_tag", "excel_header")):
+            return True
+        return (
+            "excel_file" in attrs
+            or attrs.get("html_template", instance.html_template)
+            != instance.html_template
+            or attrs.get("recipient_list", instance.recipient_list)
+            != instance.recipient_list
+        )
+
+    def _recipient_list(self, user, excel_file) -> RecipientList:
+        # The same spreadsheet uploaded again reuses the stored file and, once
+        # ingested, its snapshot
+        recipient_list, _ = RecipientList.objects.get_or_create(
+            user=user,
+            content_hash=file_digest(excel_file),
+            defaults={"excel_file": excel_file},
+        )
+        return recipient_list
+
     def create(self, validated_data):
         tag_mappings_data = validated_data.pop("tag_mappings", [])
-        campaign = EmailCampaign.objects.create(**validated_data)
+        senders = validated_data.pop("senders", [])
+        validated_data.pop("version", None)
+        excel_file = validated_data.pop("excel_file", None)
+        with transaction.atomic():
+            if excel_file is not None:
+                validated_data["recipient_list"] = self._recipient_list(
+                    validated_data["user"], excel_file
+                )
+            recipient_list = validated_data["recipient_list"]
+            validated_data["excel_file"] = recipient_list.excel_file.name
+            campaign = EmailCampaign.objects.create(status="ingesting", **validated_data)
+            campaign.senders.set(senders)
+            TagMapping.objects.bulk_create(
+                TagMapping(campaign=campaign, **tag_mapping_data)
+                for tag_mapping_data in tag_mappings_data
+            )
 
-        for tag_mapping_data in tag_mappings_data:
-            TagMapping.objects.create(campaign=campaign, **tag_mapping_data)
+            # Parsing and validating the upload happens in the background, the
+            # campaign moves to "ready" (or "failed") once that is done
+            transaction.on_commit(
+                lambda: ingest_campaign_upload.delay(
+                    campaign.id, priority=campaign.priority
+                )
+            )
 
         return campaign
+
+    def update(self, instance, validated_data):
+        # Only the edited fields are saved, so counters the tasks wrote since
+        # the campaign was read are left alone
+        reingest = self._edits_content(validated_data)
+        tag_mappings_data = validated_data.pop("tag_mappings", None)
+        serializers.raise_errors_on_nested_writes("update", self, validated_data)
+        senders = validated_data.pop("senders", None)
+        version = validated_data.pop("version", instance.version)
+        excel_file = validated_data.pop("excel_file", None)
+        with transaction.atomic():
+            if excel_file is not None:
+                validated_data["recipient_list"] = self._recipient_list(
+                    instance.user, excel_file
+                )
+            if "recipient_list" in validated_data:
+                validated_data["excel_file"] = validated_data[
+                    "recipient_list"
+                ].excel_file.name
+
+            if reingest:
+                # Validated again like a new upload, until then the campaign
+                # has no snapshot and can't be started. Rows may have moved, a
+                # restart goes over them all again skipping those already logged
+                validated_data.update(
+                    snapshot_file="", status_message=None, total_emails=0, next_row=0
+                )
+                changed = transition(instance.id, "ingesting", version=version)
+                instance.status = "ingesting"
+            else:
+                changed = EmailCampaign.objects.filter(
+                    id=instance.id, version=version
+                ).update(version=F("version") + 1)
+            if not changed:
+                raise StaleCampaign("Campaign was changed by another request, reload it")
+
+            for attr, value in validated_data.items():
+                setattr(instance, attr, value)
+            instance.version = version + 1
+            instance.save(update_fields=[*validated_data, "updated_at"])
+            if tag_mappings_data is not None:
+                instance.tag_mappings.all().delete()
+                TagMapping.objects.bulk_create(
+                    TagMapping(campaign=instance, **tag_mapping_data)
+                    for tag_mapping_data in tag_mappings_data
+                )
+            if senders is not None:
+                instance.senders.set(senders)
+            if reingest:
+                transaction.on_commit(
+                    lambda: ingest_campaign_upload.delay(
+                        instance.id, priority=instance.priority
+                    )
+                )
+        return instance
+
+
+class CampaignPreviewSerializer(serializers.Serializer):
+    """Options of a preview, the template and subject default to the campaign's"""
+
+    html_template = serializers.CharField(required=False)
+    subject = serializers.CharField(required=False)
+    rows = serializers.ListField(
+        child=serializers.IntegerField(min_value=0),
+        min_length=1,
+        max_length=settings.MAILER_PREVIEW_MAX_ROWS,
+        required=False,
+    )
+    limit = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.MAILER_PREVIEW_MAX_ROWS,
+        default=settings.MAILER_PREVIEW_ROWS,
+    )
+    test_send = serializers.BooleanField(default=False)
@@ -0,0 +1,27 @@
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from oauth2.signals import token_refreshed
+from .models import EmailCampaign, SuppressedAddress
+from .senders import mark_healthy
+from .suppression import invalidate
+from .tasks import resume_campaign
+
+
+@receiver(token_refreshed)
+def resume_paused_campaigns(sender, user_id, **kwargs):
+    """A fresh token may fix what paused campaigns sending as the user, retry them right away"""
+    mark_healthy(user_id)
+    paused = EmailCampaign.objects.filter(
+        Q(user_id=user_id) | Q(senders=user_id), status="paused"
+    ).distinct()
+    for campaign in paused.only("id", "priority", "total_emails"):
+        resume_campaign.delay(campaign.id, priority=campaign.effective_priority)
+
+
+@receiver(post_save, sender=SuppressedAddress)
+@receiver(post_delete, sender=SuppressedAddress)
+def invalidate_suppressed_addresses(sender, instance, **kwargs):
+    """Edits through the API or the admin reach running campaigns on their next chunk"""
+    invalidate(instance.user_id)
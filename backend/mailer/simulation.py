@@ -0,0 +1,420 @@
+"""
+Dry runs of a campaign, for capacity planning.
+
+A dry run goes through the whole send path of a campaign: parsing and
+deduplicating the spreadsheet, writing and reading its snapshot, dropping
+suppressed recipients, rendering and encoding every message, and writing a
+log row per recipient (to SimulatedEmailLog). Only the Gmail calls are
+simulated. Each sender's sends take a random latency and count against its
+daily quota on a virtual clock, so a campaign spread over several days is
+planned in seconds.
+
+The CPU and database stages are timed for real and move the virtual clock on
+by the time they took, sending moves it on by the simulated time, as chunks
+are rendered, sent and logged one after the other. The ETA is where the clock
+ends up.
+"""
+
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import EmailCampaign, EmailError, SimulatedEmailLog
+from .render_pool import RenderContext, render_payloads
+from .senders import allocate, sender_limits, used_quota
+from .snapshot import read_recipient_snapshot, write_recipient_snapshot
+from .suppression import suppressed_addresses, suppressed_mask
+from .utils import (
+    dedupe_recipients,
+    find_email_column,
+    parse_excel_file,
+    validate_template_and_headers,
+)
+
+logger = logging.getLogger(__name__)
+
+LATENCY = 0.25  # Mean seconds of a Gmail send
+LATENCY_SIGMA = 0.3  # Spread of the (log-normal) latency
+
+
+@dataclass
+class Stage:
+    name: str
+    rows: int = 0
+    seconds: float = 0.0
+    simulated: bool = False  # Seconds on the virtual clock rather than measured
+
+    @property
+    def rate(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+@dataclass
+class SimulationReport:
+    campaign_id: int
+    recipients: int
+    chunks: int
+    chunk_size: int
+    render_processes: int
+    senders: dict[int, int]  # Daily limit of every sender
+    sent: int = 0
+    failed: int = 0
+    suppressed: int = 0
+    missing: int = 0
+    quota_waits: int = 0  # Times every sender ran out of quota until the next day
+    eta_seconds: float = 0.0
+    db_queries: int = 0
+    db_seconds: float = 0.0
+    stages: dict[str, Stage] = field(default_factory=dict)
+
+    def stage(self, name: str, simulated: bool = False) -> Stage:
+        return self.stages.setdefault(name, Stage(name, simulated=simulated))
+
+    def as_dict(self) -> dict:
+        return {
+            "campaign": self.campaign_id,
+            "recipients": self.recipients,
+            "chunks": self.chunks,
+            "chunk_size": self.chunk_size,
+            "render_processes": self.render_processes,
+            "senders": self.senders,
+            "sent": self.sent,
+            "failed": self.failed,
+            "suppressed": self.suppressed,
+            "missing": self.missing,
+            "quota_waits": self.quota_waits,
+            "eta_seconds": round(self.eta_seconds, 1),
+            "db": {"queries": self.db_queries, "seconds": round(self.db_seconds, 3)},
+            "stages": [
+                {
+                    "name": stage.name,
+                    "rows": stage.rows,
+                    "seconds": round(stage.seconds, 3),
+                    "rows_per_second": round(stage.rate, 1),
+                    "simulated": stage.simulated,
+                }
+                for stage in self.stages.values()
+            ],
+        }
+
+    def format(self) -> str:
+        lines = [
+            f"Campaign {self.campaign_id}: {self.recipients:,} recipients in "
+            f"{self.chunks} chunks of {self.chunk_size}, "
+            f"{len(self.senders)} sender(s), {self.render_processes or 1} render process(es)",
+            f"{'stage':<18}{'rows':>10}{'seconds':>12}{'rows/s':>12}",
+        ]
+        for stage in self.stages.values():
+            label = f"{stage.name}{' *' if stage.simulated else ''}"
+            lines.append(
+                f"{label:<18}{stage.rows:>10,}{stage.seconds:>12.2f}{stage.rate:>12,.0f}"
+            )
+        lines += [
+            "* on the simulated clock",
+            f"sent {self.sent:,}, failed {self.failed:,}, suppressed {self.suppressed:,}, "
+            f"missing email {self.missing:,}, quota exhausted {self.quota_waits} time(s)",
+            f"database: {self.db_queries:,} queries, {self.db_seconds:.2f}s",
+            f"ETA: {timedelta(seconds=round(self.eta_seconds))}",
+        ]
+        return "\n".join(lines)
+
+
+class VirtualClock:
+    """Time as the campaign would experience it, with Gmail quotas resetting at UTC midnight"""
+
+    def __init__(self, start: datetime):
+        self.now = start
+
+    def advance(self, seconds: float) -> None:
+        self.now += timedelta(seconds=seconds)
+
+    def next_day(self) -> float:
+        """Jump to the next quota reset, returns the seconds waited"""
+        midnight = datetime.combine(
+            self.now.date() + timedelta(days=1), datetime.min.time(), self.now.tzinfo
+        )
+        waited = (midnight - self.now).total_seconds()
+        self.now = midnight
+        return waited
+
+
+class SimulatedTransport:
+    """Gmail as seen by a campaign: a latency per send, daily quotas and random failures"""
+
+    def __init__(
+        self,
+        limits: dict[int, int],
+        clock: VirtualClock,
+        latency: float = LATENCY,
+        failure_rate: float = 0.0,
+        seed: int | None = None,
+    ):
+        self.limits = limits
+        self.clock = clock
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        # Log-normal latencies with the given mean
+        self.mu = math.log(latency) - LATENCY_SIGMA**2 / 2
+        self.day = clock.now.date()
+        # Sends already made today count, later days start from zero
+        self.left = {
+            sender_id: max(0, limit - used_quota(sender_id))
+            for sender_id, limit in limits.items()
+        }
+
+    def quotas(self) -> dict[int, int]:
+        if self.clock.now.date() != self.day:
+            self.day = self.clock.now.date()
+            self.left = dict(self.limits)
+        return {sender_id: left for sender_id, left in self.left.items() if left > 0}
+
+    def send(self, sender_id: int, count: int) -> tuple[float, int]:
+        """Seconds the sender takes to send count messages, and how many fail"""
+        self.left[sender_id] -= count
+        seconds = sum(
+            self.random.lognormvariate(self.mu, LATENCY_SIGMA) for _ in range(count)
+        )
+        failures = sum(self.random.random() < self.failure_rate for _ in range(count))
+        return seconds, failures
+
+
+class QueryCounter:
+    """Counts database queries and their time without keeping their SQL"""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - started
+
+
+def simulate_campaign(
+    campaign: EmailCampaign,
+    chunk_size: int | None = None,
+    render_processes: int | None = None,
+    senders: int | None = None,
+    daily_limit: int | None = None,
+    latency: float = LATENCY,
+    failure_rate: float = 0.0,
+    seed: int | None = None,
+) -> SimulationReport:
+    """
+    Dry run of the campaign. By default it sends through the campaign's real
+    sender pool with the current settings. `senders` and `daily_limit` plan
+    for a pool of that many accounts instead.
+    """
+    chunk_size = chunk_size or settings.MAILER_CHUNK_SIZE
+    if render_processes is None:
+        render_processes = settings.MAILER_RENDER_PROCESSES
+    if senders:
+        # Planned accounts get negative ids, so no real account's quota counts
+        limits = {
+            -i: daily_limit or settings.MAILER_SENDER_DAILY_LIMIT
+            for i in range(1, senders + 1)
+        }
+    else:
+        limits = sender_limits(campaign)
+        if daily_limit:
+            limits = dict.fromkeys(limits, daily_limit)
+
+    clock = VirtualClock(timezone.now())
+    start = clock.now
+    transport = SimulatedTransport(
+        limits, clock, latency=latency, failure_rate=failure_rate, seed=seed
+    )
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        report = _simulate(campaign, chunk_size, render_processes, limits, transport)
+    report.eta_seconds = (clock.now - start).total_seconds()
+    report.db_queries = counter.queries
+    report.db_seconds = counter.seconds
+    logger.info(f"Simulated campaign {campaign.id}: ETA {report.eta_seconds:.0f}s")
+    return report
+
+
+def _simulate(
+    campaign: EmailCampaign,
+    chunk_size: int,
+    render_processes: int,
+    limits: dict[int, int],
+    transport: SimulatedTransport,
+) -> SimulationReport:
+    tag_mappings = list(
+        campaign.tag_mappings.values_list("template_tag", "excel_header")
+    )
+
+    # Ingest, as a fresh upload of the spreadsheet would be
+    started = time.perf_counter()
+    df = dedupe_recipients(parse_excel_file(campaign.excel_file.path))
+    validate_template_and_headers(campaign.html_template, df, tag_mappings)
+    parse_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as scratch:
+        snapshot_path = os.path.join(scratch, "recipients.arrow")
+        write_recipient_snapshot(df, snapshot_path)
+        df = read_recipient_snapshot(snapshot_path)
+        snapshot_seconds = time.perf_counter() - started
+
+        report = SimulationReport(
+            campaign_id=campaign.id,
+            recipients=len(df),
+            chunks=math.ceil(len(df) / chunk_size),
+            chunk_size=chunk_size,
+            render_processes=render_processes,
+            senders=limits,
+        )
+        report.stage("parse + dedupe").rows = len(df)
+        report.stage("parse + dedupe").seconds = parse_seconds
+        report.stage("snapshot").rows = len(df)
+        report.stage("snapshot").seconds = snapshot_seconds
+        for name in ("suppression", "render + encode"):
+            report.stage(name)
+        report.stage("send", simulated=True)
+        report.stage("log writes")
+        report.stage("quota waits", simulated=True)
+        transport.clock.advance(parse_seconds + snapshot_seconds)
+
+        try:
+            _simulate_chunks(campaign, df, report, transport, tag_mappings)
+        finally:
+            SimulatedEmailLog.objects.filter(campaign=campaign).delete()
+    return report
+
+
+def _simulate_chunks(
+    campaign: EmailCampaign,
+    df,
+    report: SimulationReport,
+    transport: SimulatedTransport,
+    tag_mappings: list[tuple[str, str]],
+) -> None:
+    """Mirror of send_campaign_chunk for every chunk of the campaign"""
+    stages = report.stages
+    context = RenderContext(
+        html_template=campaign.html_template,
+        subject=campaign.subject,
+        columns=tuple(str(col) for col in df.columns),
+        tag_mappings=tuple(tag_mappings),
+        email_pos=find_email_column(df.columns),
+        attachments=campaign.attachment_parts,
+    )
+    failure_id = EmailError.intern("SimulatedFailure", "Simulated send failure")
+    missing_id = EmailError.intern("MissingEmail", "Email missing in row")
+    suppressed_id = EmailError.intern(
+        "Suppressed", "Address is on the suppression list"
+    )
+
+    for start in range(0, len(df), report.chunk_size):
+        chunk_started = time.perf_counter()
+        rows = df.iloc[start : start + report.chunk_size]
+        suppressed = []
+        if context.email_pos is not None:
+            emails = rows.iloc[:, context.email_pos]
+            mask = suppressed_mask(emails, suppressed_addresses(campaign.user_id))
+            if mask.any():
+                suppressed = emails[mask].astype("string").str.strip().tolist()
+                rows = rows[~mask]
+        stages["suppression"].rows += len(rows) + len(suppressed)
+        stages["suppression"].seconds += time.perf_counter() - chunk_started
+
+        started = time.perf_counter()
+        payloads = list(
+            render_payloads(
+                context,
+                rows.itertuples(index=False, name=None),
+                processes=report.render_processes,
+                block_size=settings.MAILER_RENDER_BLOCK_SIZE,
+            )
+        )
+        stages["render + encode"].rows += len(payloads)
+        stages["render + encode"].seconds += time.perf_counter() - started
+
+        emails = [email for email, _ in payloads if email is not None]
+        missing = len(payloads) - len(emails)
+        send_seconds, failed = _send_chunk(len(emails), report, transport)
+        stages["send"].rows += len(emails)
+        stages["send"].seconds += send_seconds
+
+        started = time.perf_counter()
+        logs = [
+            SimulatedEmailLog(
+                campaign=campaign,
+                recipient_email="missing_email",
+                success=False,
+                error_id=missing_id,
+            )
+            for _ in range(missing)
+        ]
+        logs += [
+            SimulatedEmailLog(
+                campaign=campaign,
+                recipient_email=email,
+                success=False,
+                error_id=suppressed_id,
+            )
+            for email in suppressed
+        ]
+        # Which rows fail doesn't matter to the database, the first ones do
+        logs += [
+            SimulatedEmailLog(
+                campaign=campaign,
+                recipient_email=email,
+                success=i >= failed,
+                error_id=failure_id if i < failed else None,
+            )
+            for i, email in enumerate(emails)
+        ]
+        SimulatedEmailLog.objects.bulk_create(logs)
+        stages["log writes"].rows += len(logs)
+        stages["log writes"].seconds += time.perf_counter() - started
+
+        report.sent += len(emails) - failed
+        report.failed += failed
+        report.suppressed += len(suppressed)
+        report.missing += missing
+        # Sending already moved the clock on, the measured stages haven't
+        transport.clock.advance(time.perf_counter() - chunk_started)
+
+
+def _send_chunk(
+    count: int, report: SimulationReport, transport: SimulatedTransport
+) -> tuple[float, int]:
+    """Seconds the pool takes to send count messages (quota waits aside), and the failures"""
+    seconds = 0.0
+    failed = 0
+    while count:
+        quotas = transport.quotas()
+        if not quotas:
+            # Every sender is out of quota, the campaign waits for tomorrow
+            waited = transport.clock.next_day()
+            report.quota_waits += 1
+            report.stages["quota waits"].seconds += waited
+            continue
+        # Senders send their shares at the same time, the slowest one sets the pace
+        shares = allocate(count, quotas)
+        durations = []
+        for sender_id, share in shares.items():
+            duration, failures = transport.send(sender_id, share)
+            durations.append(duration)
+            failed += failures
+        slowest = max(durations, default=0.0)
+        transport.clock.advance(slowest)
+        seconds += slowest
+        count -= sum(shares.values())
+    return seconds, failed
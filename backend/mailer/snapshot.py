@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import os
+import logging
+from typing import TYPE_CHECKING
+
+from django.core.files.storage import default_storage
+
+from .utils import dedupe_recipients, parse_excel_file
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_EXTENSION = "arrow"
+
+
+def snapshot_path_for(excel_name: str) -> str:
+    """Storage name of the snapshot stored next to an uploaded spreadsheet"""
+    root, _ = os.path.splitext(excel_name)
+    return f"{root}.{SNAPSHOT_EXTENSION}"
+
+
+def _normalise_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # Arrow needs string headers and one type per column, while spreadsheet
+    # columns often mix numbers and text. Mixed columns are stored as strings.
+    df = df.copy()
+    df.columns = [str(col) for col in df.columns]
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype("string")
+    return df
+
+
+def write_recipient_snapshot(df: pd.DataFrame, file_path: str) -> None:
+    """Write a DataFrame as an uncompressed Arrow IPC file that can be memory-mapped"""
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(_normalise_frame(df), preserve_index=False)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    # Write to a temporary file first so readers never see a partial snapshot
+    temp_path = f"{file_path}.tmp"
+    with pa.OSFile(temp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, file_path)
+    logger.debug(f"Wrote recipient snapshot {file_path} with {table.num_rows} rows")
+
+
+def read_recipient_snapshot(file_path: str) -> pd.DataFrame:
+    """Memory-map a recipient snapshot, the columns are backed by the mapped file"""
+    import pandas as pd
+    import pyarrow as pa
+
+    with pa.memory_map(file_path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def store_recipient_snapshot(excel_name: str, df: pd.DataFrame) -> str:
+    """Write the snapshot of a spreadsheet's recipients, returns its storage name"""
+    snapshot_name = snapshot_path_for(excel_name)
+    write_recipient_snapshot(df, default_storage.path(snapshot_name))
+    return snapshot_name
+
+
+def build_recipient_snapshot(campaign, df: pd.DataFrame | None = None) -> pd.DataFrame:
+    """Store the campaign's recipients (parsed from its spreadsheet unless given) as a snapshot"""
+    if df is None:
+        # Deduped as at ingestion, so rows keep the numbers progress was saved at
+        df = dedupe_recipients(parse_excel_file(campaign.excel_file.path))
+    snapshot_name = store_recipient_snapshot(campaign.excel_file.name, df)
+
+    campaign.snapshot_file.name = snapshot_name
+    type(campaign).objects.filter(pk=campaign.pk).update(snapshot_file=snapshot_name)
+    return read_recipient_snapshot(campaign.snapshot_file.path)
+
+
+def load_recipients(campaign) -> pd.DataFrame:
+    """Recipients of a campaign, read from its snapshot (built on first use if missing)"""
+    if campaign.snapshot_file and os.path.exists(campaign.snapshot_file.path):
+        return read_recipient_snapshot(campaign.snapshot_file.path)
+    return build_recipient_snapshot(campaign)
@@ -0,0 +1,106 @@
+"""
+Status transitions of campaigns.
+
+Every status change is a single conditional UPDATE, matching only the
+statuses it may come from (and the version the caller read, when given), that
+also bumps the campaign's version. Of two requests or workers racing for the
+same transition one updates the row and the other updates nothing, and backs
+off instead of acting on a status it only thought the campaign had.
+
+Sending is further guarded by a lease on the campaign row. The task sending a
+chunk takes it, renews it at every checkpoint and gives it up when it hands
+over to the next chunk, so no second task sends the same rows meanwhile. The
+same task redelivered after its worker died takes it back right away, anyone
+else only once it expired.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import EmailCampaign
+
+TRANSITIONS = {
+    # Campaigns created before uploads were ingested in the background
+    "pending": ("ingesting", "processing", "failed"),
+    "ingesting": ("ready", "failed"),
+    # Edits to the recipients or template send a campaign back to ingestion
+    "ready": ("ingesting", "processing"),
+    "processing": ("paused", "completed", "failed"),
+    "paused": ("processing", "failed"),
+    "failed": ("ingesting", "processing"),
+    "completed": (),
+}
+
+
+class StaleCampaign(Exception):
+    """The campaign changed since it was read"""
+
+
+def sources(status: str) -> list[str]:
+    """Statuses a campaign can move to status from"""
+    return [source for source, targets in TRANSITIONS.items() if status in targets]
+
+
+def transition(
+    campaign_id: int,
+    status: str,
+    source: str | None = None,
+    version: int | None = None,
+    lease: str | None = None,
+    **fields,
+) -> bool:
+    """
+    Move a campaign to status, only from a status allowed to lead there (or
+    just from source) and, when given, at the version read or while holding
+    the lease. Returns whether this call made the change.
+    """
+    allowed = sources(status)
+    if source is not None:
+        if source not in allowed:
+            raise ValueError(f"Campaigns can't go from {source} to {status}")
+        allowed = [source]
+    campaigns = EmailCampaign.objects.filter(id=campaign_id, status__in=allowed)
+    if version is not None:
+        campaigns = campaigns.filter(version=version)
+    if lease is not None:
+        campaigns = campaigns.filter(lease_owner=lease)
+    return bool(campaigns.update(status=status, version=F("version") + 1, **fields))
+
+
+def _expiry():
+    return timezone.now() + timedelta(seconds=settings.MAILER_LEASE_TIMEOUT)
+
+
+def acquire_lease(campaign_id: int, lease: str, start: int) -> bool:
+    """Take a processing campaign for the chunk at start, unless another task holds it"""
+    return bool(
+        EmailCampaign.objects.filter(
+            Q(lease_owner__isnull=True)
+            | Q(lease_owner=lease)
+            | Q(lease_expires__lt=timezone.now()),
+            id=campaign_id,
+            status="processing",
+            # Only the chunk the campaign is at, a stale duplicate of an
+            # earlier one finds nothing left to claim
+            next_row__gte=start,
+            next_row__lt=start + settings.MAILER_CHUNK_SIZE,
+        ).update(lease_owner=lease, lease_expires=_expiry())
+    )
+
+
+def renew_lease(campaign_id: int, lease: str, **fields) -> bool:
+    """Extend a lease still held, saving fields with it, returns False once lost"""
+    return bool(
+        EmailCampaign.objects.filter(id=campaign_id, lease_owner=lease).update(
+            lease_expires=_expiry(), **fields
+        )
+    )
+
+
+def release_lease(campaign_id: int, lease: str) -> None:
+    EmailCampaign.objects.filter(id=campaign_id, lease_owner=lease).update(
+        lease_owner=None, lease_expires=None
+    )
@@ -0,0 +1,121 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Min, Q, QuerySet
+from django.db.models.functions import Trunc
+
+from .models import EmailCampaign, EmailError, EmailLog
+
+logger = logging.getLogger(__name__)
+
+CAMPAIGN_STATS_KEY = "mailer:stats:campaign:{campaign_id}"
+USER_STATS_KEY = "mailer:stats:user:{user_id}"
+TOP_ERRORS = 20
+# Failed campaigns can be started again, only completed ones are final
+FINISHED_STATUSES = ("completed",)
+
+
+def _bucket_size(first, last) -> str:
+    # Keep the throughput series to a few hundred points at most
+    span = (last - first) if first and last else timedelta(0)
+    if span <= timedelta(hours=6):
+        return "minute"
+    if span <= timedelta(days=7):
+        return "hour"
+    return "day"
+
+
+def _log_stats(logs: QuerySet) -> dict:
+    """Aggregate a set of EmailLog rows in the database"""
+    totals = logs.aggregate(
+        sent=Count("id", filter=Q(success=True)),
+        failed=Count("id", filter=Q(success=False)),
+        first_sent_at=Min("sent_at"),
+        last_sent_at=Max("sent_at"),
+    )
+
+    # Failures are grouped by their EmailError id, logs from before errors
+    # were interned have none and are grouped by their own message instead
+    errors = list(
+        logs.filter(success=False)
+        .values("error_id", "error_message")
+        .annotate(count=Count("id"))
+        .order_by("-count")[:TOP_ERRORS]
+    )
+    catalogue = EmailError.objects.in_bulk(
+        [row["error_id"] for row in errors if row["error_id"]]
+    )
+
+    bucket = _bucket_size(totals["first_sent_at"], totals["last_sent_at"])
+    throughput = (
+        logs.annotate(bucket=Trunc("sent_at", bucket))
+        .values("bucket")
+        .annotate(
+            sent=Count("id", filter=Q(success=True)),
+            failed=Count("id", filter=Q(success=False)),
+        )
+        .order_by("bucket")
+    )
+
+    return {
+        **totals,
+        "errors": [
+            {
+                "error_class": error.error_class if error else None,
+                "error": error.message if error else row["error_message"],
+                "count": row["count"],
+            }
+            for row in errors
+            for error in [catalogue.get(row["error_id"])]
+        ],
+        "throughput": {"bucket": bucket, "series": list(throughput)},
+    }
+
+
+def campaign_stats(campaign: EmailCampaign) -> dict:
+    """Delivery statistics of a campaign, cached until it finishes"""
+    key = CAMPAIGN_STATS_KEY.format(campaign_id=campaign.id)
+    stats = cache.get(key)
+    if stats is not None:
+        return stats
+
+    stats = {
+        "campaign": campaign.id,
+        "status": campaign.status,
+        "total_emails": campaign.total_emails,
+        **_log_stats(EmailLog.objects.filter(campaign_id=campaign.id)),
+    }
+    # Stats of a finished campaign never change, in-flight ones are refreshed
+    # every few seconds so progress polls stay cheap
+    timeout = (
+        None
+        if campaign.status in FINISHED_STATUSES
+        else settings.MAILER_STATS_CACHE_TIMEOUT
+    )
+    cache.set(key, stats, timeout=timeout)
+    return stats
+
+
+def user_stats(user) -> dict:
+    """Delivery statistics across all campaigns of a user"""
+    key = USER_STATS_KEY.format(user_id=user.id)
+    stats = cache.get(key)
+    if stats is not None:
+        return stats
+
+    stats = {
+        "campaigns": EmailCampaign.objects.filter(user=user).count(),
+        **_log_stats(EmailLog.objects.filter(campaign__user=user)),
+    }
+    cache.set(key, stats, timeout=settings.MAILER_STATS_CACHE_TIMEOUT)
+    return stats
+
+
+def invalidate_campaign_stats(campaign_id: int, user_id: int | None = None) -> None:
+    """Drop cached stats, called when a campaign finishes or starts again"""
+    keys = [CAMPAIGN_STATS_KEY.format(campaign_id=campaign_id)]
+    if user_id is not None:
+        keys.append(USER_STATS_KEY.format(user_id=user_id))
+    cache.delete_many(keys)
@@ -0,0 +1,118 @@
+"""
+Per-user suppression list.
+
+Addresses that failed permanently or asked to unsubscribe are stored as
+SuppressedAddress rows. For sending, a user's list is loaded as a frozenset
+cached in the shared cache under a version that changes whenever the list
+does, and kept in process memory until then, so every chunk of a campaign
+checks its recipients against an in-memory hash set.
+"""
+
+from __future__ import annotations
+
+import logging
+import uuid
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+from django.core.cache import cache
+
+from .models import SuppressedAddress
+from .utils import http_status
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "mailer:suppressed-version:{user_id}"
+ADDRESSES_KEY = "mailer:suppressed:{user_id}:{version}"
+ADDRESSES_TIMEOUT = 24 * 3600
+
+# Gmail rejects a message for its recipient with a 400 and one of these
+PERMANENT_MARKERS = ("invalid to header", "invalid recipient")
+
+# Per-process copy of each user's list: user_id -> (version, addresses)
+_loaded: dict[int, tuple[str, frozenset[str]]] = {}
+
+
+def normalise(email: str) -> str:
+    return email.strip().lower()
+
+
+def is_permanent(error: Exception) -> bool:
+    """Whether a send failed because of the address itself, so retrying can't help"""
+    return http_status(error) == 400 and any(
+        marker in str(error).lower() for marker in PERMANENT_MARKERS
+    )
+
+
+def _version(user_id: int) -> str:
+    key = VERSION_KEY.format(user_id=user_id)
+    cache.add(key, uuid.uuid4().hex, timeout=None)
+    return cache.get(key)
+
+
+def invalidate(user_id: int) -> None:
+    """Make every process reload the user's list on its next use"""
+    cache.set(VERSION_KEY.format(user_id=user_id), uuid.uuid4().hex, timeout=None)
+
+
+def suppressed_addresses(user_id: int) -> frozenset[str]:
+    """The user's suppressed addresses, from process memory, the cache or the database"""
+    version = _version(user_id)
+    loaded = _loaded.get(user_id)
+    if loaded is not None and loaded[0] == version:
+        return loaded[1]
+
+    key = ADDRESSES_KEY.format(user_id=user_id, version=version)
+    addresses = cache.get(key)
+    if addresses is None:
+        addresses = frozenset(
+            SuppressedAddress.objects.filter(user_id=user_id)
+            .values_list("email", flat=True)
+            .iterator(chunk_size=10000)
+        )
+        cache.set(key, addresses, timeout=ADDRESSES_TIMEOUT)
+    _loaded[user_id] = (version, addresses)
+    return addresses
+
+
+def suppressed_mask(emails: pd.Series, addresses: frozenset[str]) -> np.ndarray:
+    """Boolean mask of the emails on the list, blank emails are never suppressed"""
+    import numpy as np
+
+    if not addresses:
+        return np.zeros(len(emails), dtype=bool)
+    normalised = emails.str.strip().str.lower()
+    if len(addresses) <= len(emails):
+        return normalised.isin(addresses).to_numpy(dtype=bool, na_value=False)
+    # Series.isin hashes the whole list on every call, when it's longer than
+    # the column (a chunk against a big list) look every row up instead
+    return np.fromiter(
+        (email in addresses for email in normalised.fillna("").tolist()),
+        dtype=bool,
+        count=len(normalised),
+    )
+
+
+def suppress(
+    user_id: int, emails: Iterable[str], reason: str, campaign_id: int | None = None
+) -> int:
+    """Add addresses to the user's list, returns how many were given"""
+    emails = {normalise(email) for email in emails if email}
+    if not emails:
+        return 0
+    SuppressedAddress.objects.bulk_create(
+        [
+            SuppressedAddress(
+                user_id=user_id, email=email, reason=reason, campaign_id=campaign_id
+            )
+            for email in emails
+        ],
+        ignore_conflicts=True,
+    )
+    invalidate(user_id)
+    logger.info(f"Suppressed {len(emails)} addresses of user {user_id} ({reason})")
+    return len(emails)
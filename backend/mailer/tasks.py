@@ -1,86 +1,465 @@
-import pandas as pd
 import logging
+import uuid
 from celery import shared_task
-from django.db import connection
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
 
-from oauth2.models import GoogleCredential
-from .models import EmailCampaign, EmailLog
+from oauth2.tokens import refresh_expiring_tokens
+from .models import EmailCampaign, EmailError, EmailLog, RecipientList
+from .render_pool import RenderContext, render_payloads
+from .senders import (
+    SenderPoolExhausted,
+    build_breakers,
+    build_services,
+    send_with_pool,
+    sender_limits,
+)
+from .snapshot import load_recipients, read_recipient_snapshot, store_recipient_snapshot
+from .simulation import simulate_campaign
+from .state import acquire_lease, release_lease, renew_lease, transition
+from .stats import invalidate_campaign_stats
+from .suppression import is_permanent, suppress, suppressed_addresses, suppressed_mask
 from .utils import (
     parse_excel_file,
+    dedupe_recipients,
+    find_email_column,
     validate_template_and_headers,
-    replace_tags_in_template,
-    send_email_with_gmail_api,
 )
 
 logger = logging.getLogger(__name__)
 
 
+class LeaseLost(Exception):
+    """Another task took over the campaign this chunk was sending"""
+
+
+def _mark_failed(campaign_id: int, lease: str | None = None) -> None:
+    try:
+        # A chunk only fails the campaign while it is the one sending it
+        transition(
+            campaign_id, "failed", lease=lease, lease_owner=None, lease_expires=None
+        )
+        invalidate_campaign_stats(campaign_id)
+    except Exception:
+        pass
+
+
+def _tag_mappings(campaign: EmailCampaign) -> list[tuple[str, str]]:
+    return list(campaign.tag_mappings.values_list("template_tag", "excel_header"))
+
+
+def _ingest(campaign: EmailCampaign) -> int:
+    """Parse, validate and dedupe the upload into a snapshot, returns the recipient count"""
+    recipient_list = campaign.recipient_list
+    if recipient_list is not None and recipient_list.snapshot_file:
+        # The same file was uploaded before, only the template needs checking
+        df = read_recipient_snapshot(recipient_list.snapshot_file.path)
+        validate_template_and_headers(
+            campaign.html_template, df, _tag_mappings(campaign)
+        )
+        campaign.snapshot_file.name = recipient_list.snapshot_file.name
+        EmailCampaign.objects.filter(id=campaign.id).update(
+            snapshot_file=recipient_list.snapshot_file.name
+        )
+        return recipient_list.total_recipients
+
+    df = dedupe_recipients(parse_excel_file(campaign.excel_file.path))
+    snapshot_name = store_recipient_snapshot(campaign.excel_file.name, df)
+    if recipient_list is not None:
+        # Snapshot the list before validating, a campaign with a broken
+        # template shouldn't make the next one parse the file again
+        RecipientList.objects.filter(id=recipient_list.id).update(
+            snapshot_file=snapshot_name, total_recipients=len(df)
+        )
+    # Only a campaign that passed validation gets the snapshot, which is what
+    # lets it be started
+    validate_template_and_headers(
+        campaign.html_template, df, _tag_mappings(campaign)
+    )
+    campaign.snapshot_file.name = snapshot_name
+    EmailCampaign.objects.filter(id=campaign.id).update(snapshot_file=snapshot_name)
+    return len(df)
+
+
+@shared_task
+def ingest_campaign_upload(campaign_id: int, priority: str = "standard") -> str:
+    """Turn a freshly uploaded campaign into a "ready" one (or "failed" with the reason)"""
+    try:
+        campaign = EmailCampaign.objects.get(id=campaign_id)
+        total_emails = _ingest(campaign)
+        transition(
+            campaign_id, "ready", status_message=None, total_emails=total_emails
+        )
+        summary = f"Ingested campaign {campaign_id}: total={total_emails}"
+        logger.info(summary)
+        return summary
+
+    except Exception as e:
+        logger.error(f"Error in ingest_campaign_upload for {campaign_id}: {e}")
+        transition(campaign_id, "failed", status_message=str(e))
+        return f"Error in campaign {campaign_id}: {e}"
+
+    finally:
+        connection.close()
+
+
 @shared_task
-def process_email_campaign(campaign_id: int) -> str:
+def process_email_campaign(
+    campaign_id: int,
+    priority: str = "standard",
+    dry_run: bool = False,
+    version: int | None = None,
+) -> str:
+    """
+    Enqueue the first chunk of a campaign on the matching queue. version is
+    the campaign's once started, the task dispatches it only once however many
+    times it was enqueued.
+    """
     try:
         campaign = EmailCampaign.objects.get(id=campaign_id)
-        campaign.status = "processing"
-        campaign.save()
 
-        # Parse and validate
-        df = parse_excel_file(campaign.excel_file.path)
-        validate_template_and_headers(campaign.html_template, df)
+        if dry_run:
+            # Goes through the whole send path without sending
+            report = simulate_campaign(campaign)
+            logger.info(report.format())
+            return f"Simulated campaign {campaign_id}: ETA {report.eta_seconds:.0f}s"
+
+        # Campaigns created before uploads were ingested in the background
+        if not campaign.snapshot_file:
+            campaign.total_emails = _ingest(campaign)
+
+        if version is None:
+            # Enqueued before start requests passed the version
+            version = campaign.version
+        # A failed campaign started again carries on from its last checkpoint,
+        # only a fresh one starts from the first row with clean counters
+        restart = campaign.has_started
+        progress = {} if restart else {"next_row": 0, "sent_emails": 0, "failed_emails": 0}
+        dispatched = EmailCampaign.objects.filter(
+            id=campaign_id, status="processing", version=version
+        ).update(
+            version=F("version") + 1,
+            total_emails=campaign.total_emails,
+            lease_owner=None,
+            lease_expires=None,
+            **progress,
+        )
+        if not dispatched:
+            return f"Campaign {campaign_id} was already dispatched, or stopped since"
+
+        chunk_priority = campaign.effective_priority
+        if restart:
+            # Resumed like a redelivered chunk, rows already logged are skipped
+            send_campaign_chunk.delay(
+                campaign_id, campaign.next_row, priority=chunk_priority, resumed=True
+            )
+        else:
+            send_campaign_chunk.delay(campaign_id, 0, priority=chunk_priority)
+
+        start = campaign.next_row if restart else 0
+        summary = f"Dispatched campaign {campaign_id} at row {start}: total={campaign.total_emails}, priority={chunk_priority}"
+        logger.info(summary)
+        return summary
+
+    except Exception as e:
+        logger.error(f"Error in process_email_campaign for {campaign_id}: {e}")
+        if not dry_run:
+            _mark_failed(campaign_id)
+        return f"Error in campaign {campaign_id}: {e}"
+
+    finally:
+        connection.close()
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def send_campaign_chunk(
+    self,
+    campaign_id: int,
+    start: int,
+    priority: str = "standard",
+    resumed: bool = False,
+) -> str:
+    """
+    Send one chunk of a campaign, then re-enqueue the campaign for the next one.
+    Only the task holding the campaign's lease sends (see mailer.state).
+    Progress is checkpointed every MAILER_CHECKPOINT_SIZE rows, and a chunk
+    redelivered because its worker process died carries on from the last one.
+    """
+    # A redelivered task keeps its id, and with it the lease
+    lease = self.request.id or uuid.uuid4().hex
+    try:
+        if not acquire_lease(campaign_id, lease, start):
+            return f"Campaign {campaign_id} isn't at row {start} or is being sent by another task, skipping chunk"
 
-        campaign.total_emails = len(df)
-        campaign.save()
+        campaign = EmailCampaign.objects.select_related("user").get(id=campaign_id)
+        df = load_recipients(campaign)
+        stop = min(start + settings.MAILER_CHUNK_SIZE, len(df))
+        if campaign.next_row > start:
+            # Redelivered, rows before the checkpoint are done and the batch
+            # after it may have been sent without being logged
+            start = campaign.next_row
+            resumed = True
 
-        # Loop through each row
-        for idx, row in df.iterrows():
-            # Ensure email exists
-            email = next(
-                (row.get(col) for col in df.columns if col.lower() == "email"), None
+        limits = sender_limits(campaign)
+        services, error = build_services(limits)
+        if not services:
+            # Every send would fail, don't even start
+            return _pause_campaign(
+                campaign,
+                start,
+                error or SenderPoolExhausted("Every sender is cooling down after errors"),
+                priority,
+                lease,
             )
-            if pd.isna(email) or not email:
-                EmailLog.objects.create(
-                    campaign=campaign,
-                    recipient_email="missing_email",
-                    success=False,
-                    error_message="Email missing in row",
+
+        context = RenderContext(
+            html_template=campaign.html_template,
+            subject=campaign.subject,
+            columns=tuple(str(col) for col in df.columns),
+            tag_mappings=tuple(_tag_mappings(campaign)),
+            email_pos=find_email_column(df.columns),
+            attachments=campaign.attachment_parts,
+        )
+
+        # Drop suppressed recipients before spending any time rendering them
+        rows = df.iloc[start:stop]
+        row_numbers = list(range(start, stop))
+        suppressed = []
+        if context.email_pos is not None:
+            emails = rows.iloc[:, context.email_pos]
+            mask = suppressed_mask(emails, suppressed_addresses(campaign.user_id))
+            if mask.any():
+                suppressed = list(
+                    zip(
+                        (start + mask.nonzero()[0]).tolist(),
+                        emails[mask].astype("string").str.strip().tolist(),
+                    )
                 )
-                campaign.failed_emails += 1
-                campaign.save()
-                continue
-
-            html_content = replace_tags_in_template(campaign.html_template, row)
-            success, error_msg = send_email_with_gmail_api(
-                GoogleCredential.objects.get(user=campaign.user),
-                email,
-                campaign.subject,
-                html_content,
+                row_numbers = (start + (~mask).nonzero()[0]).tolist()
+                rows = rows[~mask]
+
+        # Rendered lazily, only a few blocks ahead of the batch being sent
+        payloads = render_payloads(
+            context,
+            rows.itertuples(index=False, name=None),
+            processes=settings.MAILER_RENDER_PROCESSES,
+            block_size=settings.MAILER_RENDER_BLOCK_SIZE,
+        )
+        breakers = build_breakers(services)
+        batch_size = settings.MAILER_CHECKPOINT_SIZE
+        checkpoint = start
+        for offset in range(0, len(row_numbers), batch_size) or [0]:
+            batch_rows = row_numbers[offset : offset + batch_size]
+            batch_stop = (
+                row_numbers[offset + batch_size]
+                if offset + batch_size < len(row_numbers)
+                else stop
             )
 
-            EmailLog.objects.create(
-                campaign=campaign,
-                recipient_email=email,
-                success=success,
-                error_message=error_msg,
+            jobs = []
+            missing_rows = []
+            for row, (email, raw) in zip(batch_rows, payloads):
+                # Ensure email exists
+                if email is None:
+                    missing_rows.append(row)
+                else:
+                    jobs.append((row, email, raw))
+
+            if resumed:
+                # A pool cut short mid-chunk leaves sent and unsent rows interleaved,
+                # recipients are unique so the sent ones are those already logged
+                logged = set(
+                    EmailLog.objects.filter(
+                        campaign_id=campaign_id,
+                        recipient_email__in=[email for _, email, _ in jobs],
+                    ).values_list("recipient_email", flat=True)
+                )
+                jobs = [job for job in jobs if job[1] not in logged]
+
+            pool = send_with_pool(services, limits, jobs, breakers)
+            next_row = min((row for row, _, _ in pool.unsent), default=batch_stop)
+            _checkpoint(
+                campaign,
+                next_row,
+                [row for row in missing_rows if row < next_row],
+                [
+                    (row, email)
+                    for row, email in suppressed
+                    if checkpoint <= row < next_row
+                ],
+                pool.attempts,
+                lease,
             )
-            if success:
-                campaign.sent_emails += 1
-            else:
-                campaign.failed_emails += 1
-            campaign.save()
-
-        campaign.status = "completed"
-        campaign.save()
+            checkpoint = next_row
+
+            if pool.unsent:
+                return _pause_campaign(campaign, next_row, pool.error, priority, lease)
+
+        if stop < len(df):
+            # Re-enqueue instead of looping so that higher-priority work waiting
+            # on the same pool gets picked up before this campaign's next chunk.
+            release_lease(campaign_id, lease)
+            send_campaign_chunk.delay(campaign_id, stop, priority=priority)
+            return f"Sent rows {start}-{stop} of campaign {campaign_id}"
+
+        transition(
+            campaign_id, "completed", lease=lease, lease_owner=None, lease_expires=None
+        )
+        invalidate_campaign_stats(campaign_id, campaign.user_id)
+        campaign.refresh_from_db()
         summary = f"Completed campaign {campaign_id}: sent={campaign.sent_emails}, failed={campaign.failed_emails}"
         logger.info(summary)
         return summary
 
+    except LeaseLost:
+        summary = f"Campaign {campaign_id} was taken over by another task at row {start}"
+        logger.warning(summary)
+        return summary
+
     except Exception as e:
-        logger.error(f"Error in process_email_campaign for {campaign_id}: {e}")
-        try:
-            campaign = EmailCampaign.objects.get(id=campaign_id)
-            campaign.status = "failed"
-            campaign.save()
-        except:
-            pass
+        logger.error(f"Error in send_campaign_chunk for {campaign_id} at row {start}: {e}")
+        _mark_failed(campaign_id, lease)
+        return f"Error in campaign {campaign_id}: {e}"
+
+    finally:
+        connection.close()
+
+
+def _checkpoint(
+    campaign: EmailCampaign,
+    next_row: int,
+    missing_rows: list[int],
+    suppressed: list[tuple[int, str]],
+    attempts: list,
+    lease: str,
+) -> None:
+    """
+    Log a batch of rows and move the campaign on to next_row, both or neither.
+    Raises LeaseLost, after logging the rows, when another task took over.
+    """
+    logs = [
+        EmailLog(
+            campaign=campaign,
+            recipient_email="missing_email",
+            success=False,
+            error_id=EmailError.intern("MissingEmail", "Email missing in row"),
+        )
+        for _ in missing_rows
+    ]
+    logs += [
+        EmailLog(
+            campaign=campaign,
+            recipient_email=email,
+            success=False,
+            error_id=EmailError.intern(
+                "Suppressed", "Address is on the suppression list"
+            ),
+        )
+        for _, email in suppressed
+    ]
+    logs += [
+        EmailLog(
+            campaign=campaign,
+            recipient_email=email,
+            success=error is None,
+            error_id=(
+                EmailError.intern(type(error).__name__, str(error)) if error else None
+            ),
+        )
+        for _, email, error in attempts
+    ]
+    sent = sum(error is None for _, _, error in attempts)
+    failed = len(logs) - sent
+
+    counters = {
+        "sent_emails": F("sent_emails") + sent,
+        "failed_emails": F("failed_emails") + failed,
+    }
+
+    with transaction.atomic():
+        EmailLog.objects.bulk_create(logs)
+        owned = renew_lease(campaign.id, lease, next_row=next_row, **counters)
+        if not owned:
+            # The rows were sent all the same, only the owner moves next_row
+            EmailCampaign.objects.filter(id=campaign.id).update(**counters)
+    suppress(
+        campaign.user_id,
+        [email for _, email, error in attempts if error and is_permanent(error)],
+        reason="failed",
+        campaign_id=campaign.id,
+    )
+    if not owned:
+        raise LeaseLost()
+
+
+def _pause_campaign(
+    campaign: EmailCampaign, next_row: int, error: Exception, priority: str, lease: str
+) -> str:
+    """Pause a campaign at next_row and schedule a retry after the cooldown"""
+    message = f"Paused at row {next_row} after {type(error).__name__}: {error}"
+    if not transition(
+        campaign.id,
+        "paused",
+        lease=lease,
+        status_message=message,
+        next_row=next_row,
+        lease_owner=None,
+        lease_expires=None,
+    ):
+        return f"Campaign {campaign.id} was taken over by another task at row {next_row}"
+    invalidate_campaign_stats(campaign.id, campaign.user_id)
+    resume_campaign.apply_async(
+        (campaign.id,),
+        {"priority": priority},
+        countdown=settings.MAILER_CIRCUIT_COOLDOWN,
+    )
+    summary = f"Campaign {campaign.id} {message}"
+    logger.warning(summary)
+    return summary
+
+
+@shared_task
+def resume_campaign(campaign_id: int, priority: str = "standard") -> str:
+    """Pick a paused campaign back up at the row its circuit breaker stopped at"""
+    try:
+        # Both the cooldown and a token refresh resume campaigns, only one may win
+        resumed = transition(
+            campaign_id, "processing", source="paused", status_message=None
+        )
+        if not resumed:
+            return f"Campaign {campaign_id} is not paused, nothing to resume"
+
+        next_row = EmailCampaign.objects.values_list("next_row", flat=True).get(
+            id=campaign_id
+        )
+        send_campaign_chunk.delay(campaign_id, next_row, priority=priority, resumed=True)
+
+        summary = f"Resumed campaign {campaign_id} at row {next_row}"
+        logger.info(summary)
+        return summary
+
+    except Exception as e:
+        logger.error(f"Error in resume_campaign for {campaign_id}: {e}")
+        _mark_failed(campaign_id)
         return f"Error in campaign {campaign_id}: {e}"
 
     finally:
         connection.close()
+
+
+@shared_task
+def refresh_sender_tokens() -> str:
+    """Refresh the Google tokens of users sending campaigns in flight before they expire"""
+    try:
+        in_flight = EmailCampaign.objects.filter(
+            status__in=["ready", "processing", "paused"]
+        )
+        user_ids = set(in_flight.values_list("user_id", flat=True)) | set(
+            in_flight.filter(senders__isnull=False).values_list("senders", flat=True)
+        )
+        refreshed = refresh_expiring_tokens(list(user_ids))
+        return f"Refreshed {refreshed} Google tokens"
+
+    finally:
+        connection.close()
@@ -1,3 +1,1109 @@
-from django.test import TestCase
+import base64
+import csv
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from email import message_from_bytes
+from unittest import mock
 
-# Create your tests here.
+import pandas as pd
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from google.auth.exceptions import RefreshError
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+from openpyxl import load_workbook
+from rest_framework.test import APIClient
+
+from oauth2.models import GoogleCredential
+from oauth2.tokens import TokenRefreshError
+from .attachments import encode_with_attachments, message_tail, save_part
+from .circuit import CircuitBreaker, is_systemic
+from .merge import compile_template, template_tags
+from .export import EXPORT_COLUMNS, EXPORT_CONTENT_TYPES
+from .models import EmailCampaign, EmailError, EmailLog, SuppressedAddress
+from .preview import send_test_email
+from .senders import (
+    SenderPoolExhausted,
+    allocate,
+    build_breakers,
+    is_healthy,
+    mark_healthy,
+    release_quota,
+    reserve_quota,
+    send_with_pool,
+    used_quota,
+)
+from .snapshot import build_recipient_snapshot, load_recipients
+from .suppression import suppress, suppressed_addresses, suppressed_mask
+from .tasks import (
+    ingest_campaign_upload,
+    process_email_campaign,
+    resume_campaign,
+    send_campaign_chunk,
+)
+from .utils import (
+    build_template_renderer,
+    resolve_tag_columns,
+    validate_template_and_headers,
+)
+
+WORKERS = 8
+
+
+def run_in_parallel(func, times: int = WORKERS) -> list:
+    """Call func from many threads at once, returning what each returned (or raised)"""
+    barrier = threading.Barrier(times)
+    results = [None] * times
+
+    def run(i):
+        try:
+            barrier.wait()
+            results[i] = func()
+        except Exception as e:
+            results[i] = e
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(times)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class FakeGmail:
+    """Gmail client counting the messages sent through it"""
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body):
+        with self.lock:
+            self.sent.append(body["raw"])
+        return self
+
+    def execute(self):
+        # Slow enough for the other threads to catch up
+        time.sleep(0.001)
+        return {"id": "fake"}
+
+
+def gmail_error(status: int, message: str = "Error", reason: str | None = None):
+    """An HttpError as the Gmail client raises it"""
+    error = {"code": status, "message": message}
+    if reason:
+        error["errors"] = [{"reason": reason}]
+    content = json.dumps({"error": error}).encode()
+    return HttpError(Response({"status": status}), content)
+
+
+class ScriptedGmail(FakeGmail):
+    """Gmail client failing the sends to some addresses (or all, under None)"""
+
+    def __init__(self, errors: dict | None = None):
+        super().__init__()
+        self.errors = errors or {}
+
+    def send(self, userId, body):
+        self.raw = body["raw"]
+        return self
+
+    def execute(self):
+        error = self.errors.get(self.raw, self.errors.get(None))
+        if error is not None:
+            raise error
+        with self.lock:
+            self.sent.append(self.raw)
+        return {"id": "fake"}
+
+
+class FlakyGmail(FakeGmail):
+    """Gmail client raising error on every send after the first `after`"""
+
+    def __init__(self, error: Exception, after: int = 0):
+        super().__init__()
+        self.error = error
+        self.after = after
+
+    def send(self, userId, body):
+        self.raw = body["raw"]
+        return self
+
+    def execute(self):
+        with self.lock:
+            if len(self.sent) >= self.after:
+                raise self.error
+            self.sent.append(self.raw)
+        return {"id": "fake"}
+
+
+class BouncingGmail(FakeGmail):
+    """Gmail client failing the sends to some recipients, by address"""
+
+    def __init__(self, errors: dict):
+        super().__init__()
+        self.errors = errors
+
+    def send(self, userId, body):
+        self.raw = body["raw"]
+        return self
+
+    def execute(self):
+        message = message_from_bytes(base64.urlsafe_b64decode(self.raw))
+        error = self.errors.get(message["to"])
+        if error is not None:
+            raise error
+        with self.lock:
+            self.sent.append(self.raw)
+        return {"id": "fake"}
+
+
+class CampaignTransactionTestCase(TransactionTestCase):
+    """A ready campaign of 50 recipients, for tests running its tasks"""
+
+    def setUp(self):
+        cache.clear()
+        # Error ids memoised by earlier tests point at rows flushed since
+        interned = mock.patch.dict("mailer.models._interned_errors", clear=True)
+        interned.start()
+        self.addCleanup(interned.stop)
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.user = User.objects.create_user("owner", "owner@example.com")
+        GoogleCredential.objects.create(
+            user=self.user,
+            access_token="token",
+            refresh_token="refresh",
+            token_expiry=timezone.now() + timedelta(hours=1),
+        )
+        self.campaign = EmailCampaign.objects.create(
+            user=self.user,
+            name="Newsletter",
+            subject="News",
+            html_template="<p>Hi</p>",
+            excel_file="members.xlsx",
+            status="ready",
+        )
+        build_recipient_snapshot(
+            self.campaign,
+            pd.DataFrame({"Email": [f"member{i}@example.com" for i in range(50)]}),
+        )
+        EmailCampaign.objects.filter(id=self.campaign.id).update(total_emails=50)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class CampaignConcurrencyTests(CampaignTransactionTestCase):
+    """The same campaign started, dispatched or sent many times at once goes out once"""
+
+    def test_concurrent_starts_start_once(self):
+        def start():
+            client = APIClient()
+            client.force_authenticate(self.user)
+            return client.post(
+                f"/mailer/campaigns/{self.campaign.id}/start_campaign/"
+            ).status_code
+
+        with mock.patch("mailer.views.process_email_campaign") as process:
+            codes = run_in_parallel(start)
+
+        self.assertEqual(codes.count(200), 1, codes)
+        self.assertEqual(process.delay.call_count, 1)
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.status, "processing")
+
+    def test_enqueued_many_times_dispatches_once(self):
+        EmailCampaign.objects.filter(id=self.campaign.id).update(status="processing")
+
+        # The task proxy resolves per thread, the module's name is shared
+        with mock.patch("mailer.tasks.send_campaign_chunk") as chunk:
+            run_in_parallel(
+                lambda: process_email_campaign(
+                    self.campaign.id, version=self.campaign.version
+                )
+            )
+
+        chunk.delay.assert_called_once_with(self.campaign.id, 0, priority="standard")
+
+    def test_duplicate_chunks_send_every_row_once(self):
+        EmailCampaign.objects.filter(id=self.campaign.id).update(status="processing")
+        gmail = FakeGmail()
+
+        with (
+            mock.patch("mailer.senders.build_gmail_service", return_value=gmail),
+            mock.patch("mailer.tasks.send_campaign_chunk"),
+        ):
+            # Every apply runs as a task of its own id, as duplicates would
+            run_in_parallel(lambda: send_campaign_chunk.apply((self.campaign.id, 0)))
+
+        self.assertEqual(len(gmail.sent), 50)
+        self.assertEqual(EmailLog.objects.filter(campaign=self.campaign).count(), 50)
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.status, "completed")
+        self.assertEqual(self.campaign.sent_emails, 50)
+        self.assertIsNone(self.campaign.lease_owner)
+
+    def test_restart_after_partial_send_sends_the_rest(self):
+        # Failed after checkpointing 20 rows, with 5 more sent and logged
+        # (e.g. before the recipients were ingested again)
+        EmailLog.objects.bulk_create(
+            EmailLog(
+                campaign=self.campaign,
+                recipient_email=f"member{i}@example.com",
+                success=True,
+            )
+            for i in range(25)
+        )
+        EmailCampaign.objects.filter(id=self.campaign.id).update(
+            status="failed", next_row=20, sent_emails=25
+        )
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch("mailer.views.process_email_campaign"):
+            started = client.post(f"/mailer/campaigns/{self.campaign.id}/start_campaign/")
+        self.assertEqual(started.status_code, 200)
+        self.campaign.refresh_from_db()
+
+        with mock.patch("mailer.tasks.send_campaign_chunk") as chunk:
+            process_email_campaign(self.campaign.id, version=self.campaign.version)
+        chunk.delay.assert_called_once_with(
+            self.campaign.id, 20, priority="standard", resumed=True
+        )
+
+        gmail = FakeGmail()
+        with (
+            mock.patch("mailer.senders.build_gmail_service", return_value=gmail),
+            mock.patch("mailer.tasks.send_campaign_chunk"),
+        ):
+            send_campaign_chunk.apply((self.campaign.id, 20), {"resumed": True})
+
+        self.assertEqual(len(gmail.sent), 25)
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.status, "completed")
+        self.assertEqual(self.campaign.sent_emails, 50)
+        self.assertEqual(self.campaign.total_emails, 50)
+        self.assertEqual(EmailLog.objects.filter(campaign=self.campaign).count(), 50)
+
+    def test_edit_keeps_counters_written_meanwhile(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        version = self.campaign.version
+        # A chunk checkpoints while the edit is being made
+        EmailCampaign.objects.filter(id=self.campaign.id).update(sent_emails=20)
+
+        response = client.patch(
+            f"/mailer/campaigns/{self.campaign.id}/",
+            {"name": "Renamed", "version": version},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.name, "Renamed")
+        self.assertEqual(self.campaign.sent_emails, 20)
+
+        stale = client.patch(
+            f"/mailer/campaigns/{self.campaign.id}/",
+            {"name": "Stale", "version": version},
+            format="json",
+        )
+        self.assertEqual(stale.status_code, 409)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class CampaignIngestTests(TestCase):
+    """Only a campaign whose upload passed validation can be started"""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.user = User.objects.create_user("owner", "owner@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        os.makedirs(os.path.join(media_root.name, "excel_files"))
+        pd.DataFrame({"Email": ["a@example.com", "b@example.com"]}).to_excel(
+            os.path.join(media_root.name, "excel_files", "members.xlsx"), index=False
+        )
+
+    def ingested(self, html_template: str) -> EmailCampaign:
+        campaign = EmailCampaign.objects.create(
+            user=self.user,
+            name="Newsletter",
+            subject="News",
+            html_template=html_template,
+            excel_file="excel_files/members.xlsx",
+            status="ingesting",
+        )
+        ingest_campaign_upload(campaign.id)
+        campaign.refresh_from_db()
+        return campaign
+
+    def test_failed_validation_leaves_no_snapshot(self):
+        campaign = self.ingested("<p>Hi {{missing}}</p>")
+
+        self.assertEqual(campaign.status, "failed")
+        self.assertFalse(campaign.snapshot_file)
+        with mock.patch("mailer.views.process_email_campaign") as process:
+            response = self.client.post(
+                f"/mailer/campaigns/{campaign.id}/start_campaign/"
+            )
+        self.assertEqual(response.status_code, 400)
+        process.delay.assert_not_called()
+
+    def test_valid_upload_is_ready(self):
+        campaign = self.ingested("<p>Hi</p>")
+
+        self.assertEqual(campaign.status, "ready")
+        self.assertEqual(campaign.total_emails, 2)
+        self.assertTrue(campaign.snapshot_file)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class CampaignQueryTests(TestCase):
+    """Actions on one campaign don't load its logs unless they return them"""
+
+    def test_stats_skip_the_logs(self):
+        user = User.objects.create_user("owner", "owner@example.com")
+        campaign = EmailCampaign.objects.create(
+            user=user,
+            name="Newsletter",
+            subject="News",
+            html_template="<p>Hi</p>",
+            excel_file="members.xlsx",
+            status="completed",
+        )
+        EmailLog.objects.bulk_create(
+            EmailLog(campaign=campaign, recipient_email=f"m{i}@example.com", success=True)
+            for i in range(3)
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+
+        url = f"/mailer/campaigns/{campaign.id}/stats/"
+        client.get(url)  # Caches the stats
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["stats"]["sent"], 3)
+        self.assertFalse([q["sql"] for q in queries if "mailer_emaillog" in q["sql"]])
+
+
+@override_settings(MAILER_EXPORT_CHUNK_SIZE=2)
+class ExportTests(TestCase):
+    """Delivery logs stream out as CSV or xlsx, to the campaign's owner only"""
+
+    def setUp(self):
+        self.user = User.objects.create_user("owner", "owner@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.campaign = EmailCampaign.objects.create(
+            user=self.user,
+            name="Newsletter",
+            subject="News",
+            html_template="<p>Hi</p>",
+            excel_file="members.xlsx",
+            status="completed",
+        )
+        error = EmailError.objects.create(
+            fingerprint="invalid-to",
+            error_class="HttpError",
+            message="Invalid To header",
+        )
+        EmailLog.objects.bulk_create(
+            EmailLog(
+                campaign=self.campaign,
+                recipient_email=f"m{i}@example.com",
+                success=i != 3,
+                error=error if i == 3 else None,
+            )
+            for i in range(5)
+        )
+
+    def export(self, file_format: str, campaign_id: int | None = None):
+        response = self.client.get(
+            f"/mailer/campaigns/{campaign_id or self.campaign.id}/export/",
+            {"file_format": file_format},
+        )
+        if response.status_code != 200:
+            return response, None
+        self.assertTrue(response.is_async)
+
+        async def read():
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        return response, async_to_sync(read)()
+
+    def test_csv(self):
+        response, content = self.export("csv")
+
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(csv.reader(io.StringIO(content.decode())))
+        self.assertEqual(tuple(rows[0]), EXPORT_COLUMNS)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[4][0], "m3@example.com")
+        self.assertEqual(rows[4][2:], ["False", "Invalid To header"])
+
+    def test_xlsx(self):
+        response, content = self.export("xlsx")
+
+        self.assertEqual(response["Content-Type"], EXPORT_CONTENT_TYPES["xlsx"])
+        sheet = load_workbook(io.BytesIO(content), read_only=True).active
+        rows = list(sheet.values)
+        self.assertEqual(rows[0], EXPORT_COLUMNS)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[4][0], "m3@example.com")
+        self.assertEqual(rows[4][2:], (False, "Invalid To header"))
+
+    def test_other_users_campaign_is_not_found(self):
+        other = User.objects.create_user("other", "other@example.com")
+        campaign = EmailCampaign.objects.create(
+            user=other,
+            name="Theirs",
+            subject="News",
+            html_template="<p>Hi</p>",
+            excel_file="members.xlsx",
+            status="completed",
+        )
+        for file_format in EXPORT_CONTENT_TYPES:
+            with self.subTest(file_format):
+                response, _ = self.export(file_format, campaign.id)
+                self.assertEqual(response.status_code, 404)
+
+    def test_unknown_format_is_refused(self):
+        response, _ = self.export("pdf")
+
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class CampaignEditTests(TestCase):
+    """Edits to the recipients or template are ingested again, only before sending"""
+
+    def setUp(self):
+        self.user = User.objects.create_user("owner", "owner@example.com")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.campaign = EmailCampaign.objects.create(
+            user=self.user,
+            name="Newsletter",
+            subject="News",
+            html_template="<p>Hi</p>",
+            excel_file="members.xlsx",
+            snapshot_file="members.arrow",
+            status="ready",
+            total_emails=2,
+        )
+
+    def edit(self, data):
+        with (
+            mock.patch("mailer.serializers.ingest_campaign_upload") as ingest,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            response = self.client.patch(
+                f"/mailer/campaigns/{self.campaign.id}/", data, format="json"
+            )
+        self.campaign.refresh_from_db()
+        return response, ingest
+
+    def test_template_edit_is_ingested_again(self):
+        response, ingest = self.edit({"html_template": "<p>Hi {{name}}</p>"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.campaign.status, "ingesting")
+        self.assertFalse(self.campaign.snapshot_file)
+        ingest.delay.assert_called_once_with(self.campaign.id, priority="standard")
+
+    def test_other_edits_keep_the_snapshot(self):
+        response, ingest = self.edit({"name": "Renamed", "html_template": "<p>Hi</p>"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.campaign.status, "ready")
+        self.assertEqual(self.campaign.snapshot_file.name, "members.arrow")
+        ingest.delay.assert_not_called()
+
+    def test_tag_mapped_twice_is_refused(self):
+        response, ingest = self.edit(
+            {
+                "tag_mappings": [
+                    {"template_tag": "name", "excel_header": "First Name"},
+                    {"template_tag": "{{ Name }}", "excel_header": "Nickname"},
+                ]
+            }
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Tags mapped more than once: name", str(response.data))
+        self.assertFalse(self.campaign.tag_mappings.exists())
+        ingest.delay.assert_not_called()
+
+    def test_content_of_a_sent_campaign_is_locked(self):
+        EmailCampaign.objects.filter(id=self.campaign.id).update(status="completed")
+
+        response, ingest = self.edit({"html_template": "<p>Hi {{zzz}}</p>"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.campaign.html_template, "<p>Hi</p>")
+        ingest.delay.assert_not_called()
+
+
+class RecipientSnapshotTests(TestCase):
+    """A snapshot rebuilt from the spreadsheet has the rows ingestion counted"""
+
+    def test_rebuild_drops_duplicates(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        pd.DataFrame(
+            {"Email": ["a@example.com", "A@example.com ", "b@example.com"]}
+        ).to_excel(os.path.join(media_root.name, "members.xlsx"), index=False)
+        campaign = EmailCampaign(excel_file="members.xlsx")
+
+        with override_settings(MEDIA_ROOT=media_root.name):
+            df = load_recipients(campaign)
+
+        self.assertEqual(df["Email"].tolist(), ["a@example.com", "b@example.com"])
+
+
+class MergeTemplateTests(SimpleTestCase):
+    """Templates compiled by mailer.merge render rows as the merge language says"""
+
+    COLUMNS = ("email", "name", "company", "city", "interests", "amount")
+
+    def render(self, html_template: str, *row) -> str:
+        positions = {
+            tag: self.COLUMNS.index(tag) if tag in self.COLUMNS else None
+            for tag in template_tags(html_template)
+        }
+        row += (None,) * (len(self.COLUMNS) - len(row))
+        return compile_template(html_template, positions)(row)
+
+    def test_substitutions_and_defaults(self):
+        self.assertEqual(self.render("Dear {{ name }}", "a@x.org", "Asha"), "Dear Asha")
+        self.assertEqual(self.render("Dear {{name|there}}", "a@x.org"), "Dear there")
+        self.assertEqual(
+            self.render("Dear {{name|there}}", "a@x.org", float("nan")), "Dear there"
+        )
+        self.assertEqual(self.render("Dear {{ unknown }}!", "a@x.org"), "Dear !")
+
+    def test_filters(self):
+        row = ("a@x.org", "  asha rao ", None, None, None, 1234.5)
+        self.assertEqual(self.render("{{name|trim|title}}", *row), "Asha Rao")
+        self.assertEqual(self.render("{{name|trim|upper}}", *row), "ASHA RAO")
+        self.assertEqual(self.render("{{name|trim|truncate:4}}", *row), "asha…")
+        self.assertEqual(self.render("{{amount|format:,.2f}}", *row), "1,234.50")
+        self.assertEqual(self.render("{{amount|format:.1f}}", *row[:5], "12"), "12.0")
+        self.assertEqual(self.render("{{company|upper|none}}", *row), "none")
+
+    def test_invalid_filter_arguments_are_refused_when_parsed(self):
+        for html_template in (
+            "{{name|truncate}}",
+            "{{name|truncate:abc}}",
+            "{{name|upper:3}}",
+            "{{amount|format}}",
+            "{{amount|format:zz}}",
+        ):
+            with self.subTest(html_template), self.assertRaises(ValueError):
+                template_tags(html_template)
+
+    def test_conditions(self):
+        html_template = (
+            '{% if company %}at {{company}}{% elif city == "Pune" %}in Pune'
+            "{% elif not city %}nowhere{% else %}in {{city}}{% endif %}"
+        )
+        self.assertEqual(self.render(html_template, "", "", "Acme"), "at Acme")
+        self.assertEqual(self.render(html_template, "", "", "", "Pune"), "in Pune")
+        self.assertEqual(self.render(html_template, "", "", "", "Goa"), "in Goa")
+        self.assertEqual(self.render(html_template, "", "", None, None), "nowhere")
+        self.assertEqual(template_tags(html_template), ["company", "city"])
+
+    def test_loops(self):
+        pure = "{% for item in interests %}<li>{{item}}</li>{% endfor %}"
+        mixed = "{% for item in interests %}{{item}} for {{name}}; {% endfor %}"
+        row = ("", "Asha", None, None, "music, , books")
+        self.assertEqual(self.render(pure, *row), "<li>music</li><li>books</li>")
+        self.assertEqual(self.render(mixed, *row), "music for Asha; books for Asha; ")
+        self.assertEqual(self.render(pure, "", "Asha"), "")
+        self.assertEqual(template_tags(mixed), ["interests", "name"])
+
+    def test_nesting_errors(self):
+        for html_template in (
+            "{% if name %}open",
+            "{% for item in interests %}open",
+            "{% endif %}",
+            "{% if name %}{% endfor %}",
+            "{% else %}",
+            "{% if name %}{% else %}{% elif city %}{% endif %}",
+            "{% for in interests %}{% endfor %}",
+            "{% while name %}",
+        ):
+            with self.subTest(html_template), self.assertRaises(ValueError):
+                template_tags(html_template)
+
+
+class TagMappingTests(SimpleTestCase):
+    """TagMapping rows point template tags at differently named columns"""
+
+    COLUMNS = ("Email", "Full Name", "City")
+
+    def test_mapped_tag_reads_its_column(self):
+        mappings = [("{{ name }}", " full name ")]
+        self.assertEqual(
+            resolve_tag_columns(["name", "city"], self.COLUMNS, mappings),
+            {"name": 1, "city": 2},
+        )
+        render = build_template_renderer(
+            "{{name}} from {{city}}", self.COLUMNS, mappings
+        )
+        self.assertEqual(render(("a@x.org", "Asha", "Pune")), "Asha from Pune")
+
+    def test_mapping_wins_over_a_matching_header(self):
+        columns = ("Email", "Name", "Nickname")
+        self.assertEqual(
+            resolve_tag_columns(["name"], columns, [("name", "Nickname")]),
+            {"name": 2},
+        )
+
+    def test_unknown_columns(self):
+        self.assertEqual(
+            resolve_tag_columns(["name", "zip"], self.COLUMNS, [("name", "Surname")]),
+            {"name": None, "zip": None},
+        )
+        df = pd.DataFrame(columns=list(self.COLUMNS))
+        with self.assertRaisesMessage(ValueError, "Missing columns for tags: name"):
+            validate_template_and_headers(
+                "{{name}} {{city}}", df, [("name", "Surname")]
+            )
+        with self.assertRaisesMessage(ValueError, "Missing tags for columns: full name"):
+            validate_template_and_headers("{{city}}", df)
+
+    def test_tag_used_twice_resolves_once(self):
+        html_template = "{{name}}, {{ name|there }}"
+        self.assertEqual(template_tags(html_template), ["name"])
+        df = pd.DataFrame(columns=list(self.COLUMNS))
+        validate_template_and_headers(
+            html_template + " {{city}}", df, [("name", "Full Name")]
+        )
+
+
+class AttachmentTests(SimpleTestCase):
+    """Messages spliced from a rendered head and stored parts are valid MIME"""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.addCleanup(message_tail.cache_clear)
+
+    def part(self, filename: str, content: bytes, content_type: str) -> str:
+        return save_part(
+            SimpleUploadedFile(filename, content, content_type),
+            content_hash=filename,
+            filename=filename,
+            content_type=content_type,
+        )
+
+    def test_spliced_message_parses(self):
+        # Larger than one encoding chunk, so the part is encoded in several
+        brochure = os.urandom(200_000)
+        parts = (
+            self.part("brochure.pdf", brochure, "application/pdf"),
+            self.part("reçu.txt", "Merci\n".encode(), "text/plain"),
+        )
+
+        pieces = encode_with_attachments("a@example.com", "News", "<p>Hi</p>", parts)
+        message = message_from_bytes(b"".join(pieces))
+
+        self.assertEqual(message.get_content_type(), "multipart/mixed")
+        self.assertEqual(message["to"], "a@example.com")
+        self.assertEqual(message.defects, [])
+        self.assertEqual(len(message.get_payload()), 3)
+        html, pdf, text = message.get_payload()
+        self.assertEqual(html.get_content_type(), "text/html")
+        self.assertEqual(html.get_payload(decode=True), b"<p>Hi</p>")
+        self.assertEqual(pdf.get_filename(), "brochure.pdf")
+        self.assertEqual(pdf.get_content_type(), "application/pdf")
+        self.assertEqual(pdf.get_payload(decode=True), brochure)
+        self.assertEqual(text.get_filename(), "reçu.txt")
+        self.assertEqual(text.get_payload(decode=True), b"Merci\n")
+
+    def test_messages_share_the_encoded_parts(self):
+        parts = (self.part("brochure.pdf", b"%PDF-1.4", "application/pdf"),)
+
+        first = encode_with_attachments("a@example.com", "News", "<p>A</p>", parts)
+        second = encode_with_attachments("b@example.com", "News", "<p>B</p>", parts)
+
+        self.assertNotEqual(first[0], second[0])
+        self.assertTrue(all(a is b for a, b in zip(first[1:], second[1:])))
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class CampaignStatsTests(TestCase):
+    """Cached stats follow a failed campaign that is started again"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_restart_refreshes_failed_stats(self):
+        user = User.objects.create_user("owner", "owner@example.com")
+        campaign = EmailCampaign.objects.create(
+            user=user,
+            name="Newsletter",
+            subject="News",
+            html_template="<p>Hi</p>",
+            excel_file="members.xlsx",
+            snapshot_file="members.arrow",
+            status="failed",
+            total_emails=10,
+            sent_emails=4,
+            next_row=4,
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+        url = f"/mailer/campaigns/{campaign.id}/stats/"
+        self.assertEqual(client.get(url).data["stats"]["status"], "failed")
+
+        with mock.patch("mailer.views.process_email_campaign"):
+            response = client.post(f"/mailer/campaigns/{campaign.id}/start_campaign/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.get(url).data["stats"]["status"], "processing")
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class TestSendQuotaTests(TestCase):
+    """A test email only uses up quota when it was sent"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("owner", "owner@example.com")
+        self.campaign = EmailCampaign.objects.create(
+            user=self.user,
+            name="Newsletter",
+            subject="News",
+            html_template="<p>Hi</p>",
+            excel_file="members.xlsx",
+        )
+
+    def send(self, gmail=None, error=None) -> Exception | None:
+        with (
+            mock.patch("mailer.preview.get_credentials"),
+            mock.patch(
+                "mailer.preview.build_gmail_service",
+                return_value=gmail,
+                side_effect=error,
+            ),
+        ):
+            return send_test_email(self.campaign, "News", "<p>Hi</p>")
+
+    def test_sent(self):
+        self.assertIsNone(self.send(FakeGmail()))
+        self.assertEqual(used_quota(self.user.id), 1)
+
+    def test_quota_given_back_on_errors(self):
+        failing = mock.Mock()
+        failing.users().messages().send().execute.side_effect = OSError("Gmail down")
+
+        revoked = TokenRefreshError("Revoked")
+        self.assertIsInstance(self.send(error=revoked), TokenRefreshError)
+        self.assertIsInstance(self.send(failing), OSError)
+        self.assertEqual(used_quota(self.user.id), 0)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MAILER_CIRCUIT_WINDOW=50,
+    MAILER_CIRCUIT_MIN_CALLS=10,
+    MAILER_CIRCUIT_FAILURE_RATIO=0.5,
+)
+class SenderPoolTests(SimpleTestCase):
+    """Rows are spread over the senders' quotas and moved off senders that drop out"""
+
+    def setUp(self):
+        cache.clear()
+
+    def jobs(self, count: int) -> list:
+        # The raw message is the address, so the fake client can tell rows apart
+        emails = [f"m{row}@example.com" for row in range(count)]
+        return [(row, email, email) for row, email in enumerate(emails)]
+
+    def send(self, services: dict, limits: dict, jobs: list, breakers=None):
+        breakers = breakers or build_breakers(services)
+        return send_with_pool(services, limits, jobs, breakers)
+
+    def test_allocate_in_proportion_to_quota(self):
+        self.assertEqual(allocate(10, {1: 300, 2: 100}), {1: 8, 2: 2})
+        self.assertEqual(allocate(10, {1: 3, 2: 4}), {1: 3, 2: 4})
+        self.assertEqual(allocate(10, {}), {})
+
+    def test_reserve_and_release_quota(self):
+        self.assertEqual(reserve_quota(1, 3, 5), 3)
+        self.assertEqual(reserve_quota(1, 3, 5), 2)
+        self.assertEqual(reserve_quota(1, 1, 5), 0)
+        self.assertEqual(used_quota(1), 5)
+        release_quota(1, 2)
+        self.assertEqual(used_quota(1), 3)
+
+    def test_quota_exhaustion_leaves_rows_unsent(self):
+        gmails = {1: ScriptedGmail(), 2: ScriptedGmail()}
+
+        pool = self.send(gmails, {1: 3, 2: 4}, self.jobs(10))
+
+        self.assertEqual((len(gmails[1].sent), len(gmails[2].sent)), (3, 4))
+        self.assertEqual([row for row, _, _ in pool.unsent], [7, 8, 9])
+        self.assertIsInstance(pool.error, SenderPoolExhausted)
+        self.assertEqual((used_quota(1), used_quota(2)), (3, 4))
+
+    def test_rows_of_a_tripped_sender_go_to_the_others(self):
+        gmails = {1: ScriptedGmail({None: gmail_error(429)}), 2: ScriptedGmail()}
+
+        pool = self.send(gmails, {1: 100, 2: 100}, self.jobs(10))
+
+        self.assertEqual(len(gmails[2].sent), 10)
+        self.assertEqual(pool.unsent, [])
+        self.assertEqual(sorted(row for row, _, _ in pool.attempts), list(range(10)))
+        # Its share is given back, the failed row was never sent
+        self.assertEqual(used_quota(1), 0)
+        self.assertFalse(is_healthy(1))
+        self.assertTrue(is_healthy(2))
+
+    def test_recipient_errors_keep_the_sender(self):
+        gmail = ScriptedGmail({None: gmail_error(400, "Invalid To header")})
+
+        pool = self.send({1: gmail}, {1: 100}, self.jobs(20))
+
+        self.assertEqual(len(pool.attempts), 20)
+        self.assertEqual(pool.unsent, [])
+        self.assertTrue(is_healthy(1))
+
+    def test_breaker_window_spans_the_batches_of_a_chunk(self):
+        gmail = ScriptedGmail({None: gmail_error(500, "Backend Error")})
+        breakers = build_breakers({1: gmail})
+
+        first = self.send({1: gmail}, {1: 100}, self.jobs(6), breakers)
+        second = self.send({1: gmail}, {1: 100}, self.jobs(6), breakers)
+
+        self.assertEqual(first.unsent, [])
+        # The 10th failure in a row trips the breaker, 4 sends into the batch
+        self.assertEqual(len(second.attempts), 4)
+        self.assertEqual(len(second.unsent), 2)
+        self.assertIsNotNone(second.error)
+        # Not an error about the account, other campaigns can still use it
+        self.assertTrue(is_healthy(1))
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MAILER_CHUNK_SIZE=500,
+    MAILER_CHECKPOINT_SIZE=100,
+    MAILER_RENDER_PROCESSES=0,
+    MAILER_CIRCUIT_WINDOW=50,
+    MAILER_CIRCUIT_MIN_CALLS=10,
+    MAILER_CIRCUIT_FAILURE_RATIO=0.5,
+)
+class CircuitBreakerTests(CampaignTransactionTestCase):
+    """Errors about the sender pause the campaign until the cooldown is over"""
+
+    SYSTEMIC = {
+        "401": gmail_error(401, "Invalid Credentials"),
+        "429": gmail_error(429, "Too Many Requests"),
+        "refresh": RefreshError("Token has been expired or revoked"),
+        "403 quota": gmail_error(403, "Daily Limit Exceeded", "dailyLimitExceeded"),
+    }
+
+    def breaker(self) -> CircuitBreaker:
+        return CircuitBreaker(window=50, min_calls=10, failure_ratio=0.5)
+
+    def send_chunk(self, gmail, start: int = 0, resumed: bool = False):
+        with (
+            mock.patch("mailer.senders.build_gmail_service", return_value=gmail),
+            mock.patch("mailer.tasks.send_campaign_chunk"),
+            mock.patch("mailer.tasks.resume_campaign") as resume,
+        ):
+            send_campaign_chunk.apply((self.campaign.id, start), {"resumed": resumed})
+        self.campaign.refresh_from_db()
+        return resume
+
+    def test_systemic_errors_open_the_breaker(self):
+        for name, error in self.SYSTEMIC.items():
+            with self.subTest(name):
+                self.assertTrue(is_systemic(error))
+                breaker = self.breaker()
+                self.assertTrue(breaker.record(error))
+                self.assertIs(breaker.tripped_by, error)
+
+    def test_recipient_errors_dont(self):
+        for error in (gmail_error(400, "Invalid To header"), gmail_error(404)):
+            with self.subTest(error.resp.status):
+                self.assertFalse(is_systemic(error))
+                breaker = self.breaker()
+                self.assertFalse(any(breaker.record(error) for _ in range(50)))
+                self.assertFalse(breaker.is_open)
+
+    def test_systemic_errors_pause_the_campaign(self):
+        for name, error in self.SYSTEMIC.items():
+            with self.subTest(name):
+                cache.clear()
+                EmailCampaign.objects.filter(id=self.campaign.id).update(
+                    status="processing", next_row=0, lease_owner=None
+                )
+
+                resume = self.send_chunk(FlakyGmail(error))
+
+                self.assertEqual(self.campaign.status, "paused")
+                self.assertEqual(self.campaign.next_row, 0)
+                logs = EmailLog.objects.filter(campaign=self.campaign)
+                self.assertFalse(logs.exists())
+                self.assertFalse(is_healthy(self.user.id))
+                resume.apply_async.assert_called_once_with(
+                    (self.campaign.id,),
+                    {"priority": "standard"},
+                    countdown=settings.MAILER_CIRCUIT_COOLDOWN,
+                )
+
+    def test_recipient_errors_dont_pause_the_campaign(self):
+        EmailCampaign.objects.filter(id=self.campaign.id).update(status="processing")
+
+        self.send_chunk(FlakyGmail(gmail_error(400, "Invalid To header")))
+
+        self.assertEqual(self.campaign.status, "completed")
+        self.assertEqual(self.campaign.failed_emails, 50)
+        self.assertTrue(is_healthy(self.user.id))
+
+    def test_resumes_where_it_paused_once_cooled_down(self):
+        EmailCampaign.objects.filter(id=self.campaign.id).update(status="processing")
+        self.send_chunk(FlakyGmail(gmail_error(429, "Too Many Requests"), after=20))
+        self.assertEqual(self.campaign.status, "paused")
+        self.assertEqual(self.campaign.next_row, 20)
+
+        # Half-open: resumed while the sender still cools down, it pauses again
+        with mock.patch("mailer.tasks.send_campaign_chunk") as chunk:
+            resume_campaign(self.campaign.id)
+        chunk.delay.assert_called_once_with(
+            self.campaign.id, 20, priority="standard", resumed=True
+        )
+        self.send_chunk(FakeGmail(), start=20, resumed=True)
+        self.assertEqual(self.campaign.status, "paused")
+        self.assertEqual(self.campaign.next_row, 20)
+
+        # Once the cooldown is over the rest goes out
+        mark_healthy(self.user.id)
+        with mock.patch("mailer.tasks.send_campaign_chunk"):
+            resume_campaign(self.campaign.id)
+        gmail = FakeGmail()
+        self.send_chunk(gmail, start=20, resumed=True)
+
+        self.assertEqual(len(gmail.sent), 30)
+        self.assertEqual(self.campaign.status, "completed")
+        self.assertEqual(self.campaign.sent_emails, 50)
+        self.assertEqual(EmailLog.objects.filter(campaign=self.campaign).count(), 50)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MAILER_RENDER_PROCESSES=0,
+)
+class SuppressionTests(CampaignTransactionTestCase):
+    """Suppressed addresses are skipped by every later chunk of the user's campaigns"""
+
+    def test_suppress_invalidates_the_cached_list(self):
+        self.assertEqual(suppressed_addresses(self.user.id), frozenset())
+        with self.assertNumQueries(0):
+            suppressed_addresses(self.user.id)
+
+        suppress(self.user.id, [" Member3@Example.com "], reason="unsubscribed")
+        self.assertEqual(
+            suppressed_addresses(self.user.id), frozenset({"member3@example.com"})
+        )
+
+        SuppressedAddress.objects.filter(user=self.user).delete()
+        self.assertEqual(suppressed_addresses(self.user.id), frozenset())
+
+    def test_addresses_are_normalised_before_matching(self):
+        emails = pd.Series(
+            [" A@Example.com", "b@example.com", "A@EXAMPLE.COM\t", None, ""]
+        )
+        expected = [True, False, True, False, False]
+        short = frozenset({"a@example.com"})
+        # Longer than the column, so every row is looked up instead of Series.isin
+        long = short | {f"other{i}@example.com" for i in range(10)}
+        for addresses in (short, long):
+            with self.subTest(len(addresses)):
+                self.assertEqual(suppressed_mask(emails, addresses).tolist(), expected)
+
+    def test_permanent_bounce_is_suppressed(self):
+        EmailCampaign.objects.filter(id=self.campaign.id).update(status="processing")
+        gmail = BouncingGmail(
+            {
+                "member3@example.com": gmail_error(400, "Invalid To header"),
+                "member4@example.com": gmail_error(404, "Not Found"),
+            }
+        )
+        with (
+            mock.patch("mailer.senders.build_gmail_service", return_value=gmail),
+            mock.patch("mailer.tasks.send_campaign_chunk"),
+        ):
+            send_campaign_chunk.apply((self.campaign.id, 0))
+
+        suppressed = SuppressedAddress.objects.get(user=self.user)
+        self.assertEqual(suppressed.email, "member3@example.com")
+        self.assertEqual(suppressed.reason, "failed")
+        self.assertEqual(suppressed.campaign_id, self.campaign.id)
+
+        # Sending to the list again skips the bounced address without trying it
+        EmailCampaign.objects.filter(id=self.campaign.id).update(
+            status="processing", next_row=0, sent_emails=0, failed_emails=0
+        )
+        EmailLog.objects.filter(campaign=self.campaign).delete()
+        gmail = BouncingGmail({})
+        with (
+            mock.patch("mailer.senders.build_gmail_service", return_value=gmail),
+            mock.patch("mailer.tasks.send_campaign_chunk"),
+        ):
+            send_campaign_chunk.apply((self.campaign.id, 0))
+
+        self.assertEqual(len(gmail.sent), 49)
+        log = EmailLog.objects.get(
+            campaign=self.campaign, recipient_email="member3@example.com"
+        )
+        self.assertFalse(log.success)
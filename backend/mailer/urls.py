@@ -1,10 +1,26 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import EmailCampaignViewSet
+from .views import (
+    CampaignAttachmentViewSet,
+    EmailCampaignViewSet,
+    RecipientListViewSet,
+    SenderDelegationViewSet,
+    SuppressedAddressViewSet,
+    campaign_progress,
+    memory_metrics,
+)
 
 router = DefaultRouter()
 router.register(r"campaigns", EmailCampaignViewSet, basename="campaign")
+router.register(r"attachments", CampaignAttachmentViewSet, basename="attachment")
+router.register(r"recipient-lists", RecipientListViewSet, basename="recipient-list")
+router.register(r"delegations", SenderDelegationViewSet, basename="delegation")
+router.register(r"suppressions", SuppressedAddressViewSet, basename="suppression")
 
 urlpatterns = [
+    path(
+        "campaigns/<int:pk>/progress/", campaign_progress, name="campaign-progress"
+    ),
+    path("metrics/memory/", memory_metrics, name="memory-metrics"),
     path("", include(router.urls)),
 ]
@@ -1,29 +1,40 @@
-import re
-import pandas as pd
+from __future__ import annotations
+
 import base64
+import hashlib
+import io
 import logging
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Iterable, Sequence
 
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from email.mime.text import MIMEText
+
 from django.conf import settings
 
+from .merge import compile_template, template_tags
+
+# pandas and the Google client are imported on first use, so processes that
+# never parse a spreadsheet or send mail (e.g. serving auth) don't load them
+if TYPE_CHECKING:
+    import pandas as pd
+    from google.oauth2.credentials import Credentials
+
 logger = logging.getLogger(__name__)
 
 
 def extract_tags_from_template(html_template: str) -> list[str]:
-    """Extract tags like {{tag}} from HTML template"""
-    tag_pattern = re.compile(r"{{\s*(.*?)\s*}}")
-    tags = tag_pattern.findall(html_template)
-    tags_set = {tag.strip() for tag in tags}
-    logger.debug(f"Extracted tags from template: {tags_set}")
-    return list(tags_set)
+    """Extract column tags like {{tag}} (including those in conditions and loops) from HTML template"""
+    tags = template_tags(html_template)
+    logger.debug(f"Extracted tags from template: {tags}")
+    return tags
+
 
+def parse_excel_file(file_path: str, nrows: int | None = None) -> pd.DataFrame:
+    """Parse Excel file and return DataFrame, optionally only the first nrows rows"""
+    import pandas as pd
 
-def parse_excel_file(file_path: str) -> pd.DataFrame:
-    """Parse Excel file and return DataFrame"""
     try:
-        df = pd.read_excel(file_path)
+        df = pd.read_excel(file_path, nrows=nrows)
         logger.debug(f"Excel file parsed with columns: {list(df.columns)}")
         return df
     except Exception as e:
@@ -31,14 +42,68 @@ def parse_excel_file(file_path: str) -> pd.DataFrame:
         raise ValueError(f"Error parsing Excel file: {e}")
 
 
-def validate_template_and_headers(html_template: str, df: pd.DataFrame) -> None:
+def file_digest(uploaded_file) -> str:
+    """sha256 of an uploaded file, read in chunks"""
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+
+def _normalise_tag(tag: str) -> str:
+    # TagMapping rows may store the tag with or without its braces
+    return tag.strip().strip("{}").strip().lower()
+
+
+def duplicate_mapped_tags(tag_mappings: Iterable[tuple[str, str]]) -> list[str]:
+    """Tags that more than one (template_tag, excel_header) mapping points somewhere"""
+    seen, duplicates = set(), []
+    for tag, _ in tag_mappings:
+        tag = _normalise_tag(tag)
+        if tag in seen and tag not in duplicates:
+            duplicates.append(tag)
+        seen.add(tag)
+    return duplicates
+
+
+def resolve_tag_columns(
+    tags: Iterable[str],
+    columns: Sequence,
+    tag_mappings: Iterable[tuple[str, str]] = (),
+) -> dict[str, int | None]:
+    """
+    Resolve each template tag to the position of the column holding its value.
+    Explicit (template_tag, excel_header) mappings win, other tags fall back to a
+    case-insensitive header match. Unresolvable tags map to None.
+    """
+    positions = {}
+    for pos, col in enumerate(columns):
+        positions.setdefault(str(col).strip().lower(), pos)
+    mapped_headers = {
+        _normalise_tag(tag): header.strip().lower() for tag, header in tag_mappings
+    }
+
+    resolved = {}
+    for tag in tags:
+        header = mapped_headers.get(tag.lower(), tag.lower())
+        resolved[tag] = positions.get(header)
+    return resolved
+
+
+def validate_template_and_headers(
+    html_template: str,
+    df: pd.DataFrame,
+    tag_mappings: Iterable[tuple[str, str]] = (),
+) -> None:
     """
     Ensure that template tags match exactly the DataFrame columns (excluding 'email', which must exist).
+    Tags can be pointed at differently named columns through tag_mappings.
     Raises ValueError listing missing tags/headers if mismatch.
     """
     tags = extract_tags_from_template(html_template)
-    headers = list(df.columns)
-    headers_lower = {h.lower(): h for h in headers}
+    headers = [str(h) for h in df.columns]
+    headers_lower = [h.strip().lower() for h in headers]
 
     logger.debug(f"Validating tags {tags} against headers {headers}")
 
@@ -48,12 +113,13 @@ def validate_template_and_headers(html_template: str, df: pd.DataFrame) -> None:
         logger.error(error_msg)
         raise ValueError(error_msg)
 
-    # Compare tag set (lowercased) against headers (lowercased)
-    missing_in_excel = [t for t in tags if t.lower() not in headers_lower]
+    resolved = resolve_tag_columns(tags, headers, tag_mappings)
+    used_positions = {pos for pos in resolved.values() if pos is not None}
+    missing_in_excel = [tag for tag, pos in resolved.items() if pos is None]
     missing_in_template = [
         h
-        for h, orig in headers_lower.items()
-        if h not in {t.lower() for t in tags} and h != "email"
+        for pos, h in enumerate(headers_lower)
+        if pos not in used_positions and h != "email"
     ]
 
     if missing_in_excel or missing_in_template:
@@ -69,49 +135,115 @@ def validate_template_and_headers(html_template: str, df: pd.DataFrame) -> None:
         raise ValueError(error_msg)
 
 
-def replace_tags_in_template(html_template: str, df_row: pd.Series) -> str:
-    """Replace tags in HTML template with values from a DataFrame row"""
-    content = html_template
-    tags = extract_tags_from_template(html_template)
-    for tag in tags:
-        # case-insensitive lookup
-        val = None
-        for col in df_row.index:
-            if col.lower() == tag.lower():
-                val = df_row[col]
-                break
-        if pd.isna(val) or val is None:
-            replacement = ""
-        else:
-            replacement = str(val)
-        # replace all occurrences
-        content = re.sub(rf"{{{{\s*{re.escape(tag)}\s*}}}}", replacement, content)
-    logger.debug(f"Replaced content for row: {content[:50]}...")
-    return content
+def dedupe_recipients(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop rows repeating an earlier email address (case-insensitive), keeping the first"""
+    email_col = next((col for col in df.columns if str(col).lower() == "email"), None)
+    if email_col is None:
+        return df
+    normalised = df[email_col].astype("string").str.strip().str.lower()
+    # Rows without an email are kept so they still get logged as missing
+    duplicated = normalised.duplicated() & normalised.notna()
+    if duplicated.any():
+        logger.debug(f"Dropping {int(duplicated.sum())} duplicate recipients")
+    return df[~duplicated].reset_index(drop=True)
+
+
+def find_email_column(columns: Sequence) -> int | None:
+    """Position of the (case-insensitive) 'email' column"""
+    return next(
+        (pos for pos, col in enumerate(columns) if str(col).strip().lower() == "email"),
+        None,
+    )
+
+
+@lru_cache(maxsize=32)
+def _compiled_renderer(
+    html_template: str, columns: tuple[str, ...], tag_mappings: tuple[tuple[str, str], ...]
+) -> Callable[[Sequence], str]:
+    tags = template_tags(html_template)
+    return compile_template(
+        html_template, resolve_tag_columns(tags, columns, tag_mappings)
+    )
+
+
+def build_template_renderer(
+    html_template: str,
+    columns: Sequence,
+    tag_mappings: Iterable[tuple[str, str]] = (),
+) -> Callable[[Sequence], str]:
+    """
+    Build a renderer for one campaign. Tags are resolved to column positions and the
+    template is compiled once (see mailer.merge), the returned function then fills a
+    row given as a tuple of values in column order. Renderers are cached per process.
+    """
+    return _compiled_renderer(
+        html_template,
+        tuple(str(col) for col in columns),
+        tuple((tag, header) for tag, header in tag_mappings),
+    )
+
+
+def encode_message(to_email: str, subject: str, html_content: str) -> str:
+    """Build the MIME message and return it base64url encoded, as the Gmail API expects"""
+    message = MIMEText(html_content, "html")
+    message["to"] = to_email
+    message["subject"] = subject
+    return base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+
+@lru_cache(maxsize=1)
+def gmail_discovery_document() -> str:
+    """Gmail API description shipped with googleapiclient, read once per process"""
+    from googleapiclient.discovery_cache import get_static_doc
+
+    return get_static_doc("gmail", "v1")
+
+
+def build_gmail_service(credentials: Credentials):
+    """Gmail API client, reusable for many sends (see oauth2.tokens.get_credentials)"""
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(gmail_discovery_document(), credentials=credentials)
 
 
-def send_email_with_gmail_api(
-    user_credentials, to_email: str, subject: str, html_content: str
-) -> tuple[bool, str | None]:
-    """Send email using Gmail API"""
+def _upload_request(messages, pieces: tuple[bytes, ...]):
+    from googleapiclient.http import MediaIoBaseUpload
+
+    message = b"".join(pieces)
+    # Large messages are sent in a resumable session, a dropped connection
+    # then doesn't start the upload over
+    media = MediaIoBaseUpload(
+        io.BytesIO(message),
+        mimetype="message/rfc822",
+        resumable=len(message) >= settings.MAILER_RESUMABLE_UPLOAD_SIZE,
+    )
+    return messages.send(userId="me", media_body=media)
+
+
+def http_status(error: Exception) -> int | None:
+    """HTTP status of a failed Gmail API call, None for any other error"""
+    # googleapiclient's HttpError, checked by shape to keep the import lazy
+    return getattr(getattr(error, "resp", None), "status", None)
+
+
+def send_encoded_email(
+    service, to_email: str, raw: str | tuple[bytes, ...]
+) -> tuple[bool, Exception | None]:
+    """
+    Send a message produced by encode_message, or the pieces of one with
+    attachments (see mailer.attachments), returning the exception on failure
+    """
     try:
-        creds = Credentials(
-            token=user_credentials.access_token,
-            refresh_token=user_credentials.refresh_token,
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY,
-            client_secret=settings.SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET,
-        )
-        service = build("gmail", "v1", credentials=creds)
-
-        message = MIMEText(html_content, "html")
-        message["to"] = to_email
-        message["subject"] = subject
-
-        raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        sent = service.users().messages().send(userId="me", body={"raw": raw}).execute()
+        messages = service.users().messages()
+        if isinstance(raw, str):
+            request = messages.send(userId="me", body={"raw": raw})
+        else:
+            # Uploaded as it is, instead of base64url-encoded into the body
+            request = _upload_request(messages, raw)
+        sent = request.execute()
         logger.info(f"Email sent to {to_email}: id {sent.get('id')}")
         return True, None
     except Exception as e:
         logger.error(f"Failed to send email to {to_email}: {e}")
-        return False, str(e)
+        return False, e
+
@@ -1,13 +1,37 @@
 from rest_framework import viewsets, status
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from django.conf import settings
+from django.db.models import Prefetch, Q
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
 
-from .serializers import EmailCampaignSerializer
-from .models import EmailCampaign
+from oauth2.authentication import bearer_token_required
+
+from .serializers import (
+    CampaignAttachmentSerializer,
+    CampaignPreviewSerializer,
+    EmailCampaignSerializer,
+    RecipientListSerializer,
+    SenderDelegationSerializer,
+    SuppressedAddressSerializer,
+)
+from .models import (
+    CampaignAttachment,
+    EmailCampaign,
+    EmailLog,
+    RecipientList,
+    SenderDelegation,
+    SuppressedAddress,
+)
+from .export import EXPORT_CONTENT_TYPES, csv_chunks, xlsx_chunks
+from .memory import memory_samples
+from .preview import render_previews, send_test_email
+from .state import StaleCampaign, transition
+from .stats import campaign_stats, invalidate_campaign_stats, user_stats
 from .utils import extract_tags_from_template, parse_excel_file
-from .tasks import process_email_campaign
+from .tasks import process_email_campaign, resume_campaign
 
 
 class EmailCampaignViewSet(viewsets.ModelViewSet):
@@ -15,13 +39,28 @@ class EmailCampaignViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return EmailCampaign.objects.filter(user=self.request.user).order_by(
+        queryset = EmailCampaign.objects.filter(user=self.request.user).order_by(
             "-created_at"
         )
+        if self.action not in ("list", "retrieve"):
+            # Only the serialized campaigns include their logs
+            return queryset
+        return queryset.prefetch_related(
+            Prefetch("email_logs", queryset=EmailLog.objects.select_related("error"))
+        )
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    def update(self, request, *args, **kwargs):
+        try:
+            return super().update(request, *args, **kwargs)
+        except StaleCampaign as e:
+            return Response(
+                {"status": "error", "message": str(e)},
+                status=status.HTTP_409_CONFLICT,
+            )
+
     @action(detail=True, methods=["post"])
     def start_campaign(self, request, pk=None):
         campaign = self.get_object()
@@ -36,17 +75,134 @@ class EmailCampaignViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Start the campaign processing task
-        process_email_campaign.delay(campaign.id)
+        # Paused by the circuit breaker, carry on where it stopped
+        if campaign.status == "paused":
+            resume_campaign.delay(campaign.id, priority=campaign.effective_priority)
+            return Response(
+                {"status": "success", "message": "Campaign resumed successfully"}
+            )
 
-        # Update status
-        campaign.status = "processing"
-        campaign.save()
+        if campaign.status == "ingesting":
+            return Response(
+                {
+                    "status": "error",
+                    "message": "Campaign upload is still being processed",
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # A failed campaign is only restarted once it got to sending, one that
+        # failed before (e.g. on its template) has to be edited first
+        if campaign.status == "failed" and not campaign.has_started:
+            return Response(
+                {
+                    "status": "error",
+                    "message": campaign.status_message
+                    or "Campaign failed before sending, edit it to try again",
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # Only one of concurrent start requests (e.g. a double click) gets
+        # to move the campaign on, the others find it changed
+        if not transition(campaign.id, "processing", version=campaign.version):
+            return Response(
+                {
+                    "status": "error",
+                    "message": "Campaign was changed by another request, reload it",
+                },
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        invalidate_campaign_stats(campaign.id, campaign.user_id)
+        # Start the campaign processing task
+        process_email_campaign.delay(
+            campaign.id, priority=campaign.priority, version=campaign.version + 1
+        )
 
         return Response(
             {"status": "success", "message": "Campaign started successfully"}
         )
 
+    @action(detail=True, methods=["post"])
+    def preview(self, request, pk=None):
+        """
+        Render the first `limit` rows (or the chosen `rows`) of the campaign,
+        optionally with an edited template, and test-send the first to the owner.
+        """
+        campaign = self.get_object()
+        serializer = CampaignPreviewSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        options = serializer.validated_data
+
+        if not campaign.snapshot_file:
+            return Response(
+                {
+                    "status": "error",
+                    "message": campaign.status_message
+                    or "Campaign upload is still being processed",
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            previews = render_previews(
+                campaign,
+                options.get("html_template", campaign.html_template),
+                rows=options.get("rows"),
+                limit=options["limit"],
+            )
+        except ValueError as e:
+            return Response(
+                {"status": "error", "message": str(e)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        data = {"status": "success", "previews": previews}
+        if options["test_send"] and previews:
+            error = send_test_email(
+                campaign, options.get("subject", campaign.subject), previews[0]["html"]
+            )
+            data["test_send"] = {
+                "to": campaign.user.email,
+                "success": error is None,
+                "error": str(error) if error else None,
+            }
+        return Response(data)
+
+    @action(detail=True, methods=["get"])
+    def stats(self, request, pk=None):
+        campaign = self.get_object()
+        return Response({"status": "success", "stats": campaign_stats(campaign)})
+
+    @action(detail=True, methods=["get"])
+    def export(self, request, pk=None):
+        """Delivery logs of the campaign as a CSV (default) or xlsx download"""
+        campaign = self.get_object()
+        # "format" is taken by DRF's content negotiation
+        file_format = request.query_params.get("file_format", "csv")
+        if file_format not in EXPORT_CONTENT_TYPES:
+            return Response(
+                {
+                    "status": "error",
+                    "message": f"file_format must be one of {', '.join(EXPORT_CONTENT_TYPES)}",
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        chunks = csv_chunks if file_format == "csv" else xlsx_chunks
+        response = StreamingHttpResponse(
+            chunks(campaign.id), content_type=EXPORT_CONTENT_TYPES[file_format]
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="campaign-{campaign.id}-logs.{file_format}"'
+        )
+        return response
+
+    @action(detail=False, methods=["get"], url_path="stats")
+    def user_stats(self, request):
+        return Response({"status": "success", "stats": user_stats(request.user)})
+
     @action(detail=False, methods=["post"])
     def extract_template_tags(self, request):
         html_template = request.data.get("html_template", "")
@@ -57,7 +213,13 @@ class EmailCampaignViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        tags = extract_tags_from_template(html_template)
+        try:
+            tags = extract_tags_from_template(html_template)
+        except ValueError as e:
+            return Response(
+                {"status": "error", "message": str(e)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
         return Response({"status": "success", "tags": tags})
 
@@ -82,8 +244,8 @@ class EmailCampaignViewSet(viewsets.ModelViewSet):
                 for chunk in excel_file.chunks():
                     destination.write(chunk)
 
-            # Parse the Excel file
-            df = parse_excel_file(temp_file_path)
+            # Only the header row is needed here
+            df = parse_excel_file(temp_file_path, nrows=0)
 
             # Clean up the temp file
             os.remove(temp_file_path)
@@ -95,3 +257,121 @@ class EmailCampaignViewSet(viewsets.ModelViewSet):
                 {"status": "error", "message": str(e)},
                 status=status.HTTP_400_BAD_REQUEST,
             )
+
+
+class RecipientListViewSet(viewsets.ReadOnlyModelViewSet):
+    """Spreadsheets the user uploaded, to start another campaign from without re-uploading"""
+
+    serializer_class = RecipientListSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return RecipientList.objects.filter(user=self.request.user).order_by(
+            "-created_at"
+        )
+
+
+class CampaignAttachmentViewSet(viewsets.ModelViewSet):
+    """Files attached to every message of the user's campaigns, `?campaign=` lists one campaign's"""
+
+    serializer_class = CampaignAttachmentSerializer
+    permission_classes = [IsAuthenticated]
+    http_method_names = ["get", "post", "delete"]
+
+    def get_queryset(self):
+        queryset = CampaignAttachment.objects.filter(campaign__user=self.request.user)
+        campaign = self.request.query_params.get("campaign")
+        if campaign:
+            queryset = queryset.filter(campaign_id=campaign)
+        return queryset.select_related("campaign").order_by("id")
+
+    def destroy(self, request, *args, **kwargs):
+        attachment = self.get_object()
+        if attachment.campaign.status in CampaignAttachment.LOCKED_STATUSES:
+            return Response(
+                {
+                    "status": "error",
+                    "message": f"Attachments of a campaign that is {attachment.campaign.status} can't change",
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return super().destroy(request, *args, **kwargs)
+
+
+class SuppressedAddressViewSet(viewsets.ModelViewSet):
+    """
+    Addresses the user's campaigns skip. Permanent send failures are added
+    automatically, unsubscribe requests are added (or entries removed) here.
+    """
+
+    serializer_class = SuppressedAddressSerializer
+    permission_classes = [IsAuthenticated]
+    http_method_names = ["get", "post", "delete"]
+
+    def get_queryset(self):
+        queryset = SuppressedAddress.objects.filter(user=self.request.user)
+        email = self.request.query_params.get("email")
+        if email:
+            queryset = queryset.filter(email=email.strip().lower())
+        return queryset.order_by("-created_at")
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+
+class SenderDelegationViewSet(viewsets.ModelViewSet):
+    """
+    Delegations granted by the user (their Gmail account sending for someone
+    else) and to the user. Only the sender can create or change one, either
+    side can revoke it.
+    """
+
+    serializer_class = SenderDelegationSerializer
+    permission_classes = [IsAuthenticated]
+    http_method_names = ["get", "post", "patch", "delete"]
+
+    def get_queryset(self):
+        user = self.request.user
+        queryset = SenderDelegation.objects.select_related("owner", "sender")
+        if self.action == "partial_update":
+            return queryset.filter(sender=user)
+        return queryset.filter(Q(owner=user) | Q(sender=user))
+
+    def perform_create(self, serializer):
+        serializer.save(sender=self.request.user)
+
+
+@require_GET
+@bearer_token_required
+async def campaign_progress(request, pk):
+    """
+    Progress of a campaign for frontends polling while it sends. A plain async
+    view on a single query, so polls don't tie up a worker thread each.
+    """
+    progress = await (
+        EmailCampaign.objects.filter(pk=pk, user=request.user)
+        .values(
+            "id",
+            "status",
+            "status_message",
+            "total_emails",
+            "sent_emails",
+            "failed_emails",
+            "next_row",
+            "updated_at",
+        )
+        .afirst()
+    )
+    if progress is None:
+        return JsonResponse(
+            {"status": "error", "message": "Campaign not found"},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+    return JsonResponse({"status": "success", "progress": progress})
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def memory_metrics(request):
+    """Latest memory sample of every worker process, for watching long campaigns"""
+    return Response({"status": "success", "workers": memory_samples()})
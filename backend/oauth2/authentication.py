@@ -1,20 +1,48 @@
-import requests
+import hashlib
+from functools import wraps
+
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.http import JsonResponse
 from rest_framework import exceptions
 from rest_framework.authentication import BaseAuthentication
 
+from .http import TIMEOUT, USERINFO_URL, get_async_client, get_session
+
 User = get_user_model()
 
+BEARER_CACHE_KEY = "oauth2:bearer:{digest}"
+BEARER_CACHE_TIMEOUT = 300  # Seconds a validated token is trusted without asking Google
+
+
+def _cache_key(token: str) -> str:
+    # Never put the raw token in the cache
+    return BEARER_CACHE_KEY.format(digest=hashlib.sha256(token.encode()).hexdigest())
+
+
+def _userinfo_email(resp) -> str:
+    """Email of a userinfo response, from requests or httpx alike"""
+    # Error responses aren't always JSON, check the status before parsing
+    if resp.status_code != 200:
+        raise exceptions.AuthenticationFailed("Invalid or expired token")
+    try:
+        email = resp.json().get("email")
+    except ValueError:
+        raise exceptions.AuthenticationFailed("Invalid response from Google")
+    if not email:
+        raise exceptions.AuthenticationFailed("No email in token")
+    return email
+
 
 class GoogleTokenAuthentication(BaseAuthentication):
     """
     DRF Authentication class that:
     - Reads 'Authorization: Bearer <token>' header
-    - Validates it against Google’s userinfo endpoint
+    - Validates it against Google’s userinfo endpoint, remembering valid tokens for a few minutes
     - Returns (user, token) if valid
     """
 
-    def authenticate(self, request):
+    def get_token(self, request) -> str | None:
         auth = request.headers.get("Authorization", "")
         if not auth.startswith("Bearer "):
             return None  # we’re not handling this request
@@ -22,28 +50,76 @@ class GoogleTokenAuthentication(BaseAuthentication):
         token = auth.split(" ", 1)[1].strip()
         if not token:
             raise exceptions.AuthenticationFailed("Empty Bearer token")
+        return token
 
-        # hit Google
-        resp = requests.get(
-            "https://www.googleapis.com/oauth2/v3/userinfo",
-            headers={"Authorization": f"Bearer {token}"},
-            timeout=5,
-        )
-        if resp.status_code != 200:
-            raise exceptions.AuthenticationFailed("Invalid or expired token")
-
-        data = resp.json()
-        email = data.get("email")
-        if not email:
-            raise exceptions.AuthenticationFailed("No email in token")
-
-        # lookup the user
-        try:
-            user = User.objects.get(email=email)
-        except User.DoesNotExist:
+    def authenticate(self, request):
+        token = self.get_token(request)
+        if token is None:
+            return None
+
+        key = _cache_key(token)
+        user_id = cache.get(key)
+        if user_id is not None:
+            user = User.objects.filter(pk=user_id).first()
+        else:
+            # hit Google
+            resp = get_session().get(
+                USERINFO_URL,
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=TIMEOUT,
+            )
+            email = _userinfo_email(resp)
+            # lookup the user
+            user = User.objects.filter(email=email).first()
+            if user is not None:
+                # Not refreshed on hits, so a revoked token expires from the cache
+                cache.set(key, user.pk, timeout=BEARER_CACHE_TIMEOUT)
+
+        if user is None:
             raise exceptions.AuthenticationFailed("No user matches this token")
+        return (user, token)
+
+    async def aauthenticate(self, request):
+        """authenticate() for async views"""
+        token = self.get_token(request)
+        if token is None:
+            return None
 
+        key = _cache_key(token)
+        user_id = await cache.aget(key)
+        if user_id is not None:
+            user = await User.objects.filter(pk=user_id).afirst()
+        else:
+            resp = await get_async_client().get(
+                USERINFO_URL, headers={"Authorization": f"Bearer {token}"}
+            )
+            email = _userinfo_email(resp)
+            user = await User.objects.filter(email=email).afirst()
+            if user is not None:
+                await cache.aset(key, user.pk, timeout=BEARER_CACHE_TIMEOUT)
+
+        if user is None:
+            raise exceptions.AuthenticationFailed("No user matches this token")
         return (user, token)
 
     def authenticate_header(self, request):
         return "Bearer"
+
+
+def bearer_token_required(view):
+    """GoogleTokenAuthentication for plain async Django views, which DRF can't serve"""
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            result = await GoogleTokenAuthentication().aauthenticate(request)
+        except exceptions.AuthenticationFailed as e:
+            return JsonResponse({"detail": str(e.detail)}, status=401)
+        if result is None:
+            return JsonResponse(
+                {"detail": "Authentication credentials were not provided."}, status=401
+            )
+        request.user, request.auth = result
+        return await view(request, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,36 @@
+"""
+Pooled HTTP clients for calls to Google from web processes, so logins and
+bearer token checks reuse connections instead of opening one per request.
+"""
+
+import asyncio
+import weakref
+
+import httpx
+import requests
+
+USERINFO_URL = "https://www.googleapis.com/oauth2/v3/userinfo"
+TIMEOUT = 5  # Seconds
+
+_session = requests.Session()
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_session() -> requests.Session:
+    """Shared client for sync views"""
+    return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Shared client for async views, one per event loop as connections can't move between loops"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=TIMEOUT,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+        _async_clients[loop] = client
+    return client
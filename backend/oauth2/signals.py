@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent with user_id whenever a user gets a fresh access token (login or refresh)
+token_refreshed = Signal()
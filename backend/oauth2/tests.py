@@ -1,6 +1,144 @@
-from django.test import TestCase
-from os import path
-# Create your tests here.
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
 
-print(path.join(path.dirname(__name__), "client_secrets.json"))
-print(path.dirname(__file__))
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .models import GoogleCredential
+from .tokens import (
+    REFRESH_LOCK_KEY,
+    cache_credential,
+    get_access_token,
+    refresh_access_token,
+    refresh_expiring_tokens,
+)
+
+
+class FakeRefresh:
+    """Stands in for Credentials.refresh, handing out numbered tokens"""
+
+    def __init__(self, delay: float = 0):
+        self.calls = 0
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def __call__(self, creds, request):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        time.sleep(self.delay)
+        creds.token = f"fresh-{calls}"
+        # google-auth keeps naive UTC expiries
+        creds.expiry = datetime.now(dt_timezone.utc).replace(tzinfo=None) + timedelta(
+            hours=1
+        )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    GOOGLE_TOKEN_REFRESH_MARGIN=600,
+    GOOGLE_TOKEN_CACHE_TIMEOUT=3600,
+)
+class TokenRefreshTests(TransactionTestCase):
+    """Access tokens are refreshed once however many processes need them"""
+
+    def setUp(self):
+        cache.clear()
+        self.refresh = FakeRefresh(delay=0.05)
+        patches = (
+            mock.patch(
+                "google.oauth2.credentials.Credentials.refresh",
+                lambda creds, request: self.refresh(creds, request),
+            ),
+            mock.patch("oauth2.tokens.LOCK_POLL_INTERVAL", 0.01),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def credential(self, username: str, expires_in: timedelta, refresh_token="refresh"):
+        return GoogleCredential.objects.create(
+            user=User.objects.create_user(username, f"{username}@example.com"),
+            access_token=f"{username}-token",
+            refresh_token=refresh_token,
+            token_expiry=timezone.now() + expires_in,
+        )
+
+    def test_concurrent_callers_refresh_once(self):
+        credential = self.credential("owner", timedelta(minutes=1))
+        barrier = threading.Barrier(4)
+        tokens = []
+
+        def call():
+            try:
+                barrier.wait()
+                tokens.append(get_access_token(credential.user_id))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.refresh.calls, 1)
+        self.assertEqual(tokens, ["fresh-1"] * 4)
+        credential.refresh_from_db()
+        self.assertEqual(credential.access_token, "fresh-1")
+
+    def test_caller_losing_the_lock_gets_the_refreshed_token(self):
+        credential = self.credential("owner", timedelta(minutes=1))
+        lock_key = REFRESH_LOCK_KEY.format(user_id=credential.user_id)
+        cache.add(lock_key, True)  # Another process is refreshing
+        result = {}
+
+        def call():
+            try:
+                result["info"] = refresh_access_token(credential.user_id)
+            finally:
+                connection.close()
+
+        waiter = threading.Thread(target=call)
+        waiter.start()
+        time.sleep(0.05)
+        # The other process publishes its token and lets go of the lock
+        credential.access_token = "published"
+        credential.token_expiry = timezone.now() + timedelta(hours=1)
+        credential.save()
+        cache_credential(credential)
+        cache.delete(lock_key)
+        waiter.join()
+
+        self.assertEqual(result["info"]["access_token"], "published")
+        self.assertEqual(self.refresh.calls, 0)
+
+    def test_refresh_expiring_tokens_only_refreshes_within_the_margin(self):
+        expiring = self.credential("expiring", timedelta(minutes=5))
+        later = self.credential("later", timedelta(hours=2))
+        no_refresh = self.credential("norefresh", timedelta(minutes=5), None)
+        other = self.credential("other", timedelta(minutes=5))
+
+        refreshed = refresh_expiring_tokens(
+            [expiring.user_id, later.user_id, no_refresh.user_id]
+        )
+
+        self.assertEqual(refreshed, 1)
+        self.assertEqual(self.refresh.calls, 1)
+        tokens = dict(
+            GoogleCredential.objects.values_list("user__username", "access_token")
+        )
+        self.assertEqual(
+            tokens,
+            {
+                "expiring": "fresh-1",
+                "later": "later-token",
+                "norefresh": "norefresh-token",
+                "other": "other-token",
+            },
+        )
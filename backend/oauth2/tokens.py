@@ -0,0 +1,184 @@
+"""
+Google access token management.
+
+Access tokens are served from the shared cache, so workers and web processes
+don't have to hit the database for them. Shortly before token_expiry the
+first process to take the refresh lock refreshes the token, writes it back to
+GoogleCredential and the cache, and everybody else picks up the new one.
+"""
+
+from __future__ import annotations
+
+import time
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import GoogleCredential
+from .signals import token_refreshed
+
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+
+logger = logging.getLogger(__name__)
+
+TOKEN_URI = "https://oauth2.googleapis.com/token"
+TOKEN_CACHE_KEY = "oauth2:google-token:{user_id}"
+REFRESH_LOCK_KEY = "oauth2:google-token-refresh:{user_id}"
+MISSING_CREDENTIAL_TIMEOUT = 60  # Seconds to remember that a user has no credential
+LOCK_TIMEOUT = 30  # Seconds before a crashed refresher's lock expires
+LOCK_POLL_INTERVAL = 0.2
+
+
+class TokenRefreshError(Exception):
+    """Raised when no usable access token can be obtained for a user"""
+
+
+def _as_aware(expiry: datetime | None) -> datetime | None:
+    # google-auth works with naive UTC datetimes, the database with aware ones
+    if expiry is not None and timezone.is_naive(expiry):
+        return timezone.make_aware(expiry, dt_timezone.utc)
+    return expiry
+
+
+def cache_credential(credential: GoogleCredential) -> dict:
+    """Publish a credential's current access token to the shared cache"""
+    expiry = _as_aware(credential.token_expiry)
+    info = {
+        "has_credential": True,
+        "access_token": credential.access_token,
+        "token_expiry": expiry.timestamp() if expiry else None,
+    }
+    cache.set(
+        TOKEN_CACHE_KEY.format(user_id=credential.user_id),
+        info,
+        timeout=settings.GOOGLE_TOKEN_CACHE_TIMEOUT,
+    )
+    return info
+
+
+def get_token_info(user_id: int) -> dict:
+    """Cached token details for a user, falling back to the database on a miss"""
+    key = TOKEN_CACHE_KEY.format(user_id=user_id)
+    info = cache.get(key)
+    if info is not None:
+        return info
+
+    try:
+        return cache_credential(GoogleCredential.objects.get(user_id=user_id))
+    except GoogleCredential.DoesNotExist:
+        info = {"has_credential": False, "access_token": None, "token_expiry": None}
+        cache.set(key, info, timeout=MISSING_CREDENTIAL_TIMEOUT)
+        return info
+
+
+def is_expired(info: dict, margin: float = 0) -> bool:
+    expiry = info.get("token_expiry")
+    return not info.get("access_token") or (
+        expiry is not None and expiry - margin <= time.time()
+    )
+
+
+def refresh_access_token(user_id: int) -> dict:
+    """
+    Refresh a user's access token. Only the holder of the refresh lock talks to
+    Google, concurrent callers wait for it to publish the new token.
+    """
+    lock_key = REFRESH_LOCK_KEY.format(user_id=user_id)
+    margin = settings.GOOGLE_TOKEN_REFRESH_MARGIN
+
+    if not cache.add(lock_key, True, timeout=LOCK_TIMEOUT):
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            info = get_token_info(user_id)
+            if not is_expired(info, margin):
+                return info
+            if not cache.get(lock_key):
+                break  # The other refresher gave up, fall through and try ourselves
+        if not cache.add(lock_key, True, timeout=LOCK_TIMEOUT):
+            raise TokenRefreshError(f"Timed out waiting for token refresh of user {user_id}")
+
+    try:
+        credential = GoogleCredential.objects.get(user_id=user_id)
+        # Someone may have refreshed it while we were waiting for the lock
+        info = cache_credential(credential)
+        if not is_expired(info, margin):
+            return info
+        if not credential.refresh_token:
+            raise TokenRefreshError(f"User {user_id} has no refresh token")
+
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+
+        creds = Credentials(
+            token=None,
+            refresh_token=credential.refresh_token,
+            token_uri=TOKEN_URI,
+            client_id=settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY,
+            client_secret=settings.SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET,
+        )
+        try:
+            creds.refresh(Request())
+        except Exception as e:
+            raise TokenRefreshError(f"Token refresh failed for user {user_id}: {e}") from e
+
+        credential.access_token = creds.token
+        credential.token_expiry = _as_aware(creds.expiry) or (
+            timezone.now() + timedelta(hours=1)
+        )
+        GoogleCredential.objects.filter(pk=credential.pk).update(
+            access_token=credential.access_token,
+            token_expiry=credential.token_expiry,
+        )
+        logger.info(f"Refreshed Google access token for user {user_id}")
+        info = cache_credential(credential)
+        token_refreshed.send(sender=GoogleCredential, user_id=user_id)
+        return info
+
+    except GoogleCredential.DoesNotExist:
+        raise TokenRefreshError(f"User {user_id} has no Google credential")
+
+    finally:
+        cache.delete(lock_key)
+
+
+def get_access_token(user_id: int) -> str:
+    """A valid access token for the user, refreshed first if it is about to expire"""
+    info = get_token_info(user_id)
+    if not info["has_credential"]:
+        raise TokenRefreshError(f"User {user_id} has no Google credential")
+    if is_expired(info, settings.GOOGLE_TOKEN_REFRESH_MARGIN):
+        info = refresh_access_token(user_id)
+    return info["access_token"]
+
+
+def get_credentials(user_id: int) -> Credentials:
+    """
+    google-auth credentials for the Gmail client. They carry no refresh token, so
+    the client library can't refresh behind our back and throw the new token away.
+    """
+    from google.oauth2.credentials import Credentials
+
+    return Credentials(token=get_access_token(user_id))
+
+
+def refresh_expiring_tokens(user_ids) -> int:
+    """Refresh the tokens of the given users that expire within the refresh margin"""
+    soon = timezone.now() + timedelta(seconds=settings.GOOGLE_TOKEN_REFRESH_MARGIN)
+    user_ids = GoogleCredential.objects.filter(
+        user_id__in=user_ids, token_expiry__lte=soon, refresh_token__isnull=False
+    ).values_list("user_id", flat=True)
+
+    refreshed = 0
+    for user_id in user_ids:
+        try:
+            refresh_access_token(user_id)
+            refreshed += 1
+        except TokenRefreshError as e:
+            logger.error(str(e))
+    return refreshed
@@ -1,94 +1,122 @@
 # This file handles the authorization of the user, for more info about
 # Google's API read the documentation at
 # https://developers.google.com/identity/protocols/oauth2/web-server#python_4
+#
+# Only the login and callback views are async, they wait on Google. The status
+# and user info views are ordinary DRF views, run in a thread under ASGI.
 
-import requests
+import json
+import logging
+from functools import lru_cache
 from os import path
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.auth import login, get_user_model
+from django.contrib.auth import alogin, get_user_model
+from django.http import JsonResponse
 from django.urls import reverse
 from django.utils import timezone
+from django.views import View
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny
 from rest_framework.authtoken.models import Token
 from rest_framework import status
 
 from social_django.models import UserSocialAuth
 from datetime import timedelta
-from google_auth_oauthlib.flow import Flow
 
+from .http import USERINFO_URL, get_async_client
 from .models import GoogleCredential
+from .signals import token_refreshed
+from .tokens import TOKEN_URI, cache_credential, get_token_info, is_expired
 
 CLIENT_SECRETS = path.join(path.dirname(__file__), "client_secrets.json")
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
 
-class GoogleAuthCallbackView(APIView):
-    permission_classes = [AllowAny]
 
-    def get(self, request):
+@lru_cache(maxsize=1)
+def _client_secrets() -> dict:
+    # Read once per process rather than on every login
+    with open(CLIENT_SECRETS) as f:
+        return json.load(f)
+
+
+def _client_config() -> dict:
+    secrets = _client_secrets()
+    return secrets.get("web") or secrets["installed"]
+
+
+class GoogleAuthCallbackView(View):
+    """
+    Async so that waiting on Google's token and userinfo endpoints doesn't hold
+    up a worker, both calls go through the shared pooled client.
+    """
+
+    async def get(self, request):
         code = request.GET.get("code")
         if not code:
-            return Response(
+            return JsonResponse(
                 {"error": "Authorization code not found"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
         try:
-            # Set up the OAuth flow
-            redirect_uri = request.build_absolute_uri(reverse("oauth2:callback"))
-            flow = Flow.from_client_secrets_file(
-                client_secrets_file=CLIENT_SECRETS,
-                scopes=settings.SOCIAL_AUTH_GOOGLE_OAUTH2_SCOPE,
-                redirect_uri=redirect_uri,
-            )
+            client = get_async_client()
+            config = _client_config()
 
             # Exchange code for tokens
-            flow.fetch_token(code=code)
-            credentials = flow.credentials
+            redirect_uri = request.build_absolute_uri(reverse("oauth2:callback"))
+            response = await client.post(
+                config.get("token_uri", TOKEN_URI),
+                data={
+                    "code": code,
+                    "client_id": config["client_id"],
+                    "client_secret": config["client_secret"],
+                    "redirect_uri": redirect_uri,
+                    "grant_type": "authorization_code",
+                },
+            )
+            response.raise_for_status()
+            tokens = response.json()
 
             # Get tokens and expiry
-            access_token = credentials.token
-            refresh_token = credentials.refresh_token
-            token_expiry = (
-                credentials.expiry
-                if credentials.expiry
-                else timezone.now() + timedelta(hours=1)
+            access_token = tokens["access_token"]
+            refresh_token = tokens.get("refresh_token")
+            token_expiry = timezone.now() + timedelta(
+                seconds=tokens.get("expires_in", 3600)
             )
 
             # Get user info from Google API
-            userinfo_url = "https://www.googleapis.com/oauth2/v3/userinfo"
             headers = {"Authorization": f"Bearer {access_token}"}
 
-            response = requests.get(userinfo_url, headers=headers)
+            response = await client.get(USERINFO_URL, headers=headers)
             response.raise_for_status()
             user_data = response.json()
 
             email = user_data.get("email")
             if not email:
-                return Response(
+                return JsonResponse(
                     {"error": "Email not found in Google profile"},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
             # Find or create user
-            try:
-                user = User.objects.get(email=email)
-            except User.DoesNotExist:
+            user = await User.objects.filter(email=email).afirst()
+            if user is None:
                 # Create new user with standard User model
                 username = f"google_{email.split('@')[0]}"
                 # Check if username already exists, append numbers if needed
                 base_username = username
                 counter = 1
-                while User.objects.filter(username=username).exists():
+                while await User.objects.filter(username=username).aexists():
                     username = f"{base_username}_{counter}"
                     counter += 1
 
                 # Create the user
-                user = User.objects.create(
+                user = await User.objects.acreate(
                     username=username,
                     email=email,
                     first_name=user_data.get("given_name", ""),
@@ -96,7 +124,7 @@ class GoogleAuthCallbackView(APIView):
                 )
 
                 # Create social auth entry - user is now a User instance
-                UserSocialAuth.objects.create(
+                await UserSocialAuth.objects.acreate(
                     user=user,  # This is now correctly a User instance
                     provider="google-oauth2",
                     uid=email,
@@ -109,11 +137,11 @@ class GoogleAuthCallbackView(APIView):
                 )
 
             # Log the user in
-            login(request, user)
+            await alogin(request, user)
 
             # Save Google credentials - CAREFUL here, don't assign the result to user
             # This returns (instance, created) tuple
-            cred_instance, _ = GoogleCredential.objects.update_or_create(
+            cred_instance, _ = await GoogleCredential.objects.aupdate_or_create(
                 user=user,
                 defaults={
                     "access_token": access_token,
@@ -121,58 +149,54 @@ class GoogleAuthCallbackView(APIView):
                     "token_expiry": token_expiry,
                 },
             )
+            await sync_to_async(cache_credential)(cred_instance)
+            await token_refreshed.asend(sender=GoogleCredential, user_id=user.id)
 
             # Create DRF token
-            token, _ = Token.objects.get_or_create(user=user)
+            token, _ = await Token.objects.aget_or_create(user=user)
 
             # For debugging, return token as JSON
-            return Response(
+            return JsonResponse(
                 {"token": token.key, "user": user.username, "email": user.email},
                 status=status.HTTP_200_OK,
             )
 
         except Exception as e:
-            print(f"OAuth callback error: {e}")
-            import traceback
-
-            traceback.print_exc()
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            logger.exception(f"OAuth callback error: {e}")
+            return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
 class GoogleAuthStatusView(APIView):
     def get(self, request):
-        try:
-            google_cred = GoogleCredential.objects.get(user=request.user)
-            is_expired = google_cred.token_expiry < timezone.now()
-
+        # Served from the shared token cache, not the database
+        token_info = get_token_info(request.user.id)
+        if token_info["has_credential"]:
             return Response(
                 {
                     "authenticated": True,
                     "email": request.user.email,
-                    "token_expired": is_expired,
-                }
-            )
-        except GoogleCredential.DoesNotExist:
-            return Response(
-                {
-                    "authenticated": False,
-                    "email": request.user.email if request.user.email else None,
-                    "token_expired": None,
+                    "token_expired": is_expired(token_info),
                 }
             )
+        return Response(
+            {
+                "authenticated": False,
+                "email": request.user.email if request.user.email else None,
+                "token_expired": None,
+            }
+        )
 
 
-class GoogleLoginView(APIView):
-    permission_classes = [AllowAny]
-
-    def get(self, request):
+class GoogleLoginView(View):
+    async def get(self, request):
         """
         Return the Google OAuth2 login URL for the frontend to redirect to
         """
+        from google_auth_oauthlib.flow import Flow
 
         redirect_uri = request.build_absolute_uri(reverse("oauth2:callback"))
-        flow = Flow.from_client_secrets_file(
-            client_secrets_file=CLIENT_SECRETS,
+        flow = Flow.from_client_config(
+            _client_secrets(),
             scopes=settings.SOCIAL_AUTH_GOOGLE_OAUTH2_SCOPE,
         )
         flow.redirect_uri = redirect_uri
@@ -181,7 +205,7 @@ class GoogleLoginView(APIView):
             access_type="offline", include_granted_scopes="true", prompt="consent"
         )
 
-        return Response({"login_url": authorization_url}, status=status.HTTP_200_OK)
+        return JsonResponse({"login_url": authorization_url}, status=status.HTTP_200_OK)
 
 
 class UserInfoView(APIView):
@@ -195,12 +219,7 @@ class UserInfoView(APIView):
             )
 
         # Check if user has Google credentials
-        has_google_credentials = False
-        try:
-            GoogleCredential.objects.get(user=request.user)
-            has_google_credentials = True
-        except GoogleCredential.DoesNotExist:
-            pass
+        has_google_credentials = get_token_info(request.user.id)["has_credential"]
 
         return Response(
             {